@@ -0,0 +1,183 @@
+import argparse
+import time
+
+from tabulate import tabulate
+
+from common.backend_pool import (
+    POOL_SELECTIONS,
+    BackendPool,
+    CircuitBreakerRule,
+    PoolBackend,
+    SimpleRoundRobinFragment,
+    ThrottleWindow,
+    WeightedRandomFragment,
+    default_pools,
+    generate_backends,
+    simulate,
+)
+
+# the v1 fragments and the v2 pools they correspond to
+FRAGMENT_POOLS = {
+    "simple-round-robin": "simple-round-robin-backend-pool",
+    "weighted-round-robin": "weighted-round-robin-backend-pool",
+}
+
+
+def parse_throttle_window(value: str) -> ThrottleWindow:
+    """
+    Parse BACKEND:START-END[:RETRY_AFTER] (times in seconds)
+    """
+    try:
+        backend_id, times, *retry_after = value.split(":")
+        start, end = times.split("-")
+        return ThrottleWindow(
+            backend_id,
+            float(start),
+            float(end),
+            float(retry_after[0]) if retry_after else None,
+        )
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Expected BACKEND:START-END[:RETRY_AFTER], got '{value}'"
+        )
+
+
+def main():
+    """
+    Simulate requests through a load balancing configuration (the v1 policy fragments or
+    a v2 backend pool) and report how far the split between the backends is from the weights
+    """
+    parser = argparse.ArgumentParser(
+        description="Simulate requests through a load balancing configuration"
+    )
+    parser.add_argument(
+        "--pool",
+        default="weighted-round-robin-backend-pool",
+        choices=list(default_pools) + list(FRAGMENT_POOLS),
+        help="Backend pool from apiManagement.bicep (v2) or policy fragment (v1) to simulate",
+    )
+    parser.add_argument(
+        "--backends",
+        type=int,
+        help="Simulate a generated pool with this many backends instead of --pool's backends",
+    )
+    parser.add_argument(
+        "--max-weight",
+        type=int,
+        default=10,
+        help="Maximum weight for --backends (weights are 1 to max-weight)",
+    )
+    parser.add_argument(
+        "--priorities",
+        type=int,
+        default=1,
+        help="Number of priorities for --backends (priorities are 1 to priorities)",
+    )
+    parser.add_argument(
+        "--circuit-breaker",
+        action="store_true",
+        help="Give the --backends the ptu-backend-1-with-circuit-breaker rule",
+    )
+    parser.add_argument(
+        "--selection",
+        default="weighted-round-robin",
+        choices=POOL_SELECTIONS,
+        help="How a v2 pool picks a backend within a priority group",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=100000, help="Number of requests to simulate"
+    )
+    parser.add_argument(
+        "--rps", type=float, default=100, help="Simulated requests per second"
+    )
+    parser.add_argument(
+        "--throttle",
+        type=parse_throttle_window,
+        action="append",
+        default=[],
+        metavar="BACKEND:START-END[:RETRY_AFTER]",
+        help="Return 429s from a backend between START and END seconds (repeatable)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the generated pool and random selection",
+    )
+    args = parser.parse_args()
+
+    if args.backends:
+        backends = generate_backends(
+            args.backends,
+            args.max_weight,
+            args.priorities,
+            CircuitBreakerRule() if args.circuit_breaker else None,
+            args.seed,
+        )
+    else:
+        backends = default_pools[FRAGMENT_POOLS.get(args.pool, args.pool)]
+
+    if args.pool == "simple-round-robin":
+        selector = SimpleRoundRobinFragment(
+            [backend.backend_id for backend in backends]
+        )
+        description = f"simple-round-robin.xml fragment ({len(backends)} backends)"
+    elif args.pool == "weighted-round-robin":
+        selector = WeightedRandomFragment(backends, args.seed)
+        description = f"weighted-round-robin.xml fragment ({len(backends)} backends)"
+    else:
+        selector = BackendPool(backends, args.selection, args.seed)
+        description = f"{args.selection} pool ({len(backends)} backends)"
+
+    start = time.perf_counter()
+    summary = simulate(selector, args.requests, args.rps, args.throttle)
+    elapsed = time.perf_counter() - start
+
+    backends_by_id: dict[str, PoolBackend] = {
+        backend.backend_id: backend for backend in backends
+    }
+    print(f"Simulated: {description}")
+    print(
+        tabulate(
+            [
+                [
+                    row[0],
+                    backends_by_id[row[0]].priority if row[0] in backends_by_id else "",
+                    backends_by_id[row[0]].weight if row[0] in backends_by_id else "",
+                    *row[1:],
+                ]
+                for row in summary.get_rows()
+            ],
+            headers=[
+                "Backend",
+                "Priority",
+                "Weight",
+                "Requests",
+                "429s",
+                "Expected %",
+                "Actual %",
+                "Error (pp)",
+            ],
+            floatfmt=".3f",
+        )
+    )
+    print()
+    if isinstance(selector, BackendPool) and selector.circuit_breakers:
+        trips = sum(
+            circuit_breaker.trip_count
+            for circuit_breaker in selector.circuit_breakers.values()
+        )
+        print(f"Circuit breaker trips: {trips}")
+    if summary.no_backend:
+        print(f"No backend available (503): {summary.no_backend}")
+    print(f"Max error: {summary.get_max_error() * 100:.3f} percentage points")
+    print(
+        f"Total variation: {summary.get_total_variation() * 100:.3f}% of the requests"
+    )
+    print(
+        f"Simulated {summary.total} requests in {elapsed * 1000:.0f}ms ({summary.total / max(elapsed, 1e-9):,.0f} requests/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
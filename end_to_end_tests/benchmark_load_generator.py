@@ -0,0 +1,161 @@
+# locust must be imported first so that gevent monkey patches the standard library
+from locust import constant, events, task
+from locust.env import Environment
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import gevent
+import requests
+from tabulate import tabulate
+
+from common.payload_corpus import JSON_CONTENT_TYPE, PayloadCorpus
+from common.simulator_config import SimulatorConfigDelta
+from common.users import LOAD_GENERATOR_CLIENTS, get_user_base_class
+
+deployment_name = "gpt-35-turbo-100m-token"
+chat_corpus = PayloadCorpus(
+    [
+        (
+            {
+                "messages": [
+                    {"role": "user", "content": "Lorem ipsum dolor sit amet?"}
+                ],
+                "model": "gpt-35-turbo",
+                "max_tokens": 10,
+            },
+            1,
+        )
+    ]
+)
+request_headers = {"Content-Type": JSON_CONTENT_TYPE}
+
+
+def create_user_class(client: str) -> type:
+    class BenchmarkUser(get_user_base_class(client)):
+        wait_time = constant(0)
+
+        @task
+        def get_completion(self):
+            self.client.post(
+                f"openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15",
+                data=chat_corpus.next_payload().body,
+                headers=request_headers,
+            )
+
+    return BenchmarkUser
+
+
+def run_benchmark(client: str, host: str, users: int, duration: float) -> list:
+    """
+    Run a single benchmark and return the results row
+    (client, requests, failures, RPS, CPU seconds, RPS per core)
+    """
+    environment = Environment(
+        user_classes=[create_user_class(client)], host=host, events=events
+    )
+    runner = environment.create_local_runner()
+    runner.start(users, spawn_rate=users)
+    # let the users spawn and connections open before measuring
+    gevent.sleep(2)
+    environment.stats.reset_all()
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    gevent.sleep(duration)
+    cpu_seconds = time.process_time() - cpu_start
+    wall_seconds = time.perf_counter() - wall_start
+    total = environment.stats.total
+    request_count = total.num_requests
+    failure_count = total.num_failures
+    runner.quit()
+
+    return [
+        client,
+        request_count,
+        failure_count,
+        round(request_count / wall_seconds),
+        round(cpu_seconds, 1),
+        round(request_count / cpu_seconds) if cpu_seconds > 0 else 0,
+    ]
+
+
+def main():
+    """
+    Measure the requests per second (and per CPU core) that each load generator
+    client can drive against the local simulator
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the HttpUser and FastHttpUser load generator clients"
+    )
+    parser.add_argument(
+        "--clients",
+        default=",".join(LOAD_GENERATOR_CLIENTS),
+        help="Comma-separated load generator clients to benchmark",
+    )
+    parser.add_argument("--users", type=int, default=50, help="Number of users")
+    parser.add_argument(
+        "--duration", type=float, default=20, help="Seconds to run each benchmark for"
+    )
+    parser.add_argument(
+        "--simulator-port", type=int, default=8090, help="Port for the local simulator"
+    )
+    args = parser.parse_args()
+
+    simulator_endpoint = f"http://127.0.0.1:{args.simulator_port}"
+    # the local simulator runs in its own process so that it doesn't compete
+    # with the load generator for CPU time
+    simulator = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "local_simulator.py"),
+            "--ports",
+            str(args.simulator_port),
+        ],
+        env={**os.environ, "SIMULATOR_API_KEY": ""},
+    )
+    try:
+        for _ in range(50):
+            try:
+                requests.get(f"{simulator_endpoint}/++/config", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        # remove the simulated latency so that the load generator is the bottleneck
+        requests.patch(
+            f"{simulator_endpoint}/++/config",
+            json=SimulatorConfigDelta(
+                completions_latency=0, chat_completions_latency=0
+            ).to_patch(),
+            timeout=10,
+        ).raise_for_status()
+
+        rows = [
+            run_benchmark(client, f"{simulator_endpoint}/", args.users, args.duration)
+            for client in args.clients.split(",")
+        ]
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    print()
+    print(
+        tabulate(
+            rows,
+            headers=[
+                "Client",
+                "Requests",
+                "Failures",
+                "RPS",
+                "CPU seconds",
+                "RPS per core",
+            ],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
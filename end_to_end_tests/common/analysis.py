@@ -0,0 +1,1130 @@
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import UTC, datetime, timedelta
+from gzip import GzipFile
+from typing import Any, NamedTuple
+
+import asciichartpy as asciichart
+from azure.core.credentials import TokenCredential
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.monitor.query import LogsBatchQuery, LogsQueryClient, LogsQueryStatus
+
+from .charts import format_table, render_chart
+from .config import (
+    log_analytics_query_mode,
+    query_cache_dir,
+    query_cache_ingestion_margin_minutes,
+    query_cache_max_age_hours,
+    query_cache_max_size_mb,
+)
+from .http_client import get_query_session
+from .query_cache import (
+    RESULT_FILE_EXTENSION,
+    DiskResultCache,
+    read_table,
+    write_table,
+)
+from .table import GroupDefinition, Table
+from .terminal import get_link
+
+#
+# Query/analysis engine shared by the Log Analytics and Application Insights query processors.
+# QueryProcessor queues, runs and outputs queries, and a QueryBackend runs them against a data source.
+#
+
+# https://learn.microsoft.com/en-us/python/api/overview/azure/monitor-query-readme?view=azure-python
+
+APPINSIGHTS_ENDPOINT = "https://api.applicationinsights.io/v1/apps"
+
+# Number of queries (or query batches) to run at once in run_queries
+DEFAULT_MAX_CONCURRENT_QUERIES = 4
+
+# "concurrent" runs each query as a separate request, "batch" sends the queries in batch requests
+QUERY_MODES = ["concurrent", "batch"]
+# Maximum number of queries in a Log Analytics batch request
+MAX_BATCH_QUERIES = 10
+
+# Polling for ingested data starts with a short wait and backs off exponentially
+INGESTION_INITIAL_WAIT_SECONDS = 0.5
+INGESTION_MAX_WAIT_SECONDS = 30
+INGESTION_BACKOFF_FACTOR = 2
+# Ingestion checks query from this long before the earliest check time (to allow for clock skew)
+INGESTION_TIMESPAN_MARGIN = timedelta(minutes=5)
+
+# Number of query results kept in the shared in-memory cache
+DEFAULT_RESULT_CACHE_SIZE = 256
+# Directory (in the query cache directory) that report manifests are saved in
+REPORTS_DIRECTORY = "reports"
+
+Timespan = (
+    str | timedelta | tuple[datetime, datetime] | tuple[datetime, timedelta] | None
+)
+
+
+def encode_portal_query(query: str) -> str:
+    """
+    Encode a query for an Azure Portal deep link (gzipped, base64 and URL encoded)
+    """
+    # GZip the UTF8 bytes for the query
+    bio_out = io.BytesIO()
+    with GzipFile(mode="wb", fileobj=bio_out) as gzip:
+        gzip.write(query.encode("utf-8"))
+
+    # Base64 encode the result and URL encode that
+    base64_query = base64.b64encode(bio_out.getvalue())
+    return urllib.parse.quote(base64_query, safe="")
+
+
+def get_log_analytics_portal_url(
+    tenant_id: str,
+    subscription_id: str,
+    resource_group_name: str,
+    workspace_name: str,
+    query: str,
+):
+    """
+    Build a URL to deep link into the Azure Portal to run a query in Log Analytics.
+    """
+    encoded_query = encode_portal_query(query)
+    return f"https://portal.azure.com#@{tenant_id}/blade/Microsoft_OperationsManagementSuite_Workspace/Logs.ReactView/resourceId/%2Fsubscriptions%2F{subscription_id}%2Fresourcegroups%2F{resource_group_name}%2Fproviders%2Fmicrosoft.operationalinsights%2Fworkspaces%2F{workspace_name}/source/LogsBlade.AnalyticsShareLinkToQuery/q/{encoded_query}"
+
+
+def get_app_insights_portal_url(
+    tenant_id: str,
+    subscription_id: str,
+    resource_group_name: str,
+    app_insights_name: str,
+    query: str,
+    timespan: str = "P1D",
+):
+    """
+    Build a URL to deep link into the Azure Portal to run a query in Application Insights.
+    """
+    encoded_query = encode_portal_query(query)
+    return (
+        f"https://portal.azure.com#@{tenant_id}/blade/Microsoft_Azure_Monitoring_Logs/"
+        + f"LogsBlade/resourceId/%2Fsubscriptions%2F{subscription_id}%2FresourceGroups%2F"
+        + f"{resource_group_name}%2Fproviders%2Fmicrosoft.insights%2Fcomponents%2F"
+        + f"{app_insights_name}/source/LogsBlade.AnalyticsShareLinkToQuery/q/{encoded_query}"
+        + f"/timespan/{timespan}"
+    )
+
+
+def parse_app_id_from_connection_string(connection_string):
+    for part in connection_string.split(";"):
+        if part.startswith("ApplicationId="):
+            return part.split("=")[1]
+    return None
+
+
+def format_timespan(timespan: Timespan) -> str | None:
+    """
+    Format a timespan as an ISO 8601 duration or interval, e.g. PT12H or <start>/<end>
+    (strings are assumed to already be in this format)
+    """
+    if timespan is None or isinstance(timespan, str):
+        return timespan
+    if isinstance(timespan, timedelta):
+        return f"PT{timespan.total_seconds()}S"
+    start, end = timespan
+    if isinstance(end, timedelta):
+        return f"{start.isoformat()}/PT{end.total_seconds()}S"
+    return f"{start.isoformat()}/{end.isoformat()}"
+
+
+# time after the end of a timespan before query results for it are cached
+CACHE_INGESTION_MARGIN = timedelta(minutes=query_cache_ingestion_margin_minutes)
+
+
+def is_absolute_timespan(
+    timespan: Timespan, ingestion_margin: timedelta = CACHE_INGESTION_MARGIN
+) -> bool:
+    """
+    Check whether a timespan is a fixed time range that ended at least ingestion_margin
+    ago, i.e. the data for it has been ingested and the results of a query over it are final
+    """
+    if not isinstance(timespan, tuple):
+        return False
+    start, end = timespan
+    if isinstance(end, timedelta):
+        end = start + end
+    return end + ingestion_margin <= datetime.now(UTC)
+
+
+def get_query_key(query: str, timespan: Timespan, source: str = "") -> str:
+    """
+    Get a key for the results of a query over a timespan (against a data source)
+    """
+    key = json.dumps([source, query, format_timespan(timespan)])
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """
+    In-memory LRU cache of query results, keyed by get_query_key.
+    Misses are looked up in the backing cache (e.g. a query_cache.DiskResultCache) if set,
+    and new results are stored in both.
+    """
+
+    def __init__(
+        self, max_entries: int = DEFAULT_RESULT_CACHE_SIZE, backing_cache=None
+    ):
+        self.max_entries = max_entries
+        self.backing_cache = backing_cache
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict[str, Table] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: str) -> Table | None:
+        with self.__lock:
+            table = self.__entries.get(key)
+            if table is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return table
+        table = self.backing_cache.get(key) if self.backing_cache else None
+        if table is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__put_entry(key, table)
+        return table
+
+    def put(self, key: str, table: Table):
+        self.__put_entry(key, table)
+        if self.backing_cache:
+            self.backing_cache.put(key, table)
+
+    def __put_entry(self, key: str, table: Table):
+        with self.__lock:
+            self.__entries[key] = table
+            self.__entries.move_to_end(key)
+            if len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+
+def create_result_cache() -> ResultCache:
+    """
+    Create a result cache from the QUERY_CACHE_* settings (backed by a
+    DiskResultCache in QUERY_CACHE_DIR unless QUERY_CACHE_DIR is empty)
+    """
+    backing_cache = None
+    if query_cache_dir:
+        backing_cache = DiskResultCache(
+            query_cache_dir,
+            max_age_seconds=query_cache_max_age_hours * 60 * 60,
+            max_size_bytes=int(query_cache_max_size_mb * 1024 * 1024),
+        )
+    return ResultCache(backing_cache=backing_cache)
+
+
+# shared by all QueryProcessors in the process
+result_cache = create_result_cache()
+
+
+class QueryResult(NamedTuple):
+    """
+    The result of running a query: a table, or an error message if the query failed
+    """
+
+    table: Table | None
+    error_message: str | None
+
+
+class QueryBackend(ABC):
+    """
+    Base class for the data sources that QueryProcessor runs queries against
+    """
+
+    # identifies the data source in result cache keys (e.g. the workspace ID)
+    source: str = ""
+    # text for links to run queries in the Azure Portal
+    link_text: str = "Run query"
+    # maximum number of queries in a run_query_batch call
+    max_batch_queries: int = 1
+
+    @abstractmethod
+    def run_query(self, query: str, timespan: Timespan) -> QueryResult:
+        pass
+
+    def run_query_batch(self, queries: list[tuple[str, Timespan]]) -> list[QueryResult]:
+        """
+        Run a batch of queries (backends without a batch API run them one at a time)
+        """
+        return [self.run_query(query, timespan) for query, timespan in queries]
+
+    def get_portal_url(self, query: str, timespan: Timespan) -> str | None:
+        """
+        Get a URL to run the query in the Azure Portal (None if not supported)
+        """
+        return None
+
+
+_logs_query_clients_lock = threading.Lock()
+_logs_query_clients: dict[int, tuple[TokenCredential, LogsQueryClient]] = {}
+
+
+def get_logs_query_client(token_credential: TokenCredential) -> LogsQueryClient:
+    """
+    Get the shared LogsQueryClient for a credential.
+    The clients send their requests through the shared query session (see http_client.get_query_session).
+    """
+    with _logs_query_clients_lock:
+        entry = _logs_query_clients.get(id(token_credential))
+        if entry is None:
+            client = LogsQueryClient(
+                token_credential,
+                transport=RequestsTransport(
+                    session=get_query_session(), session_owner=False
+                ),
+            )
+            # the credential is kept with the client so that its id isn't reused
+            entry = (token_credential, client)
+            _logs_query_clients[id(token_credential)] = entry
+        return entry[1]
+
+
+class LogAnalyticsBackend(QueryBackend):
+    """
+    Runs queries against a Log Analytics workspace using the azure-monitor-query SDK
+    """
+
+    link_text = "Run in Log Analytics"
+    max_batch_queries = MAX_BATCH_QUERIES
+
+    def __init__(
+        self,
+        workspace_id: str,
+        token_credential: TokenCredential,
+        tenant_id: str | None = None,
+        subscription_id: str | None = None,
+        resource_group_name: str | None = None,
+        workspace_name: str | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            workspace_id (str): Workspace ID
+            token_credential (TokenCredential): TokenCredential object
+            tenant_id (str): Tenant ID (required for links to the Azure Portal)
+            subscription_id (str): Subscription ID (required for links to the Azure Portal)
+            resource_group_name (str): Resource Group Name (required for links to the Azure Portal)
+            workspace_name (str): Workspace Name (required for links to the Azure Portal)
+        """
+        if workspace_id is None:
+            raise ValueError("workspace_id is required")
+        self.source = workspace_id
+        self.__workspace_id = workspace_id
+        self.__logs_query_client = get_logs_query_client(token_credential)
+        self.__tenant_id = tenant_id
+        self.__subscription_id = subscription_id
+        self.__resource_group_name = resource_group_name
+        self.__workspace_name = workspace_name
+
+    def run_query(self, query: str, timespan: Timespan) -> QueryResult:
+        try:
+            response = self.__logs_query_client.query_workspace(
+                workspace_id=self.__workspace_id,
+                query=query,
+                timespan=timespan,
+            )
+        except HttpResponseError as e:
+            return QueryResult(None, e.message)
+
+        return QueryResult(Table.from_logs_table(response.tables[0]), None)
+
+    def run_query_batch(self, queries: list[tuple[str, Timespan]]) -> list[QueryResult]:
+        """
+        Run a batch of queries in a single request.
+
+        Queries that return a partial result (or the whole batch if the batch request
+        fails) are re-run as single queries.
+        """
+        if len(queries) > MAX_BATCH_QUERIES:
+            raise ValueError(f"A batch can contain at most {MAX_BATCH_QUERIES} queries")
+
+        try:
+            responses = self.__logs_query_client.query_batch(
+                [
+                    LogsBatchQuery(
+                        workspace_id=self.__workspace_id,
+                        query=query,
+                        timespan=timespan,
+                    )
+                    for query, timespan in queries
+                ]
+            )
+        except (HttpResponseError, ValueError) as e:
+            logging.warning("Query batch failed, running queries individually: %s", e)
+            return [self.run_query(query, timespan) for query, timespan in queries]
+
+        results = []
+        for (query, timespan), response in zip(queries, responses):
+            if response.status == LogsQueryStatus.SUCCESS:
+                results.append(
+                    QueryResult(Table.from_logs_table(response.tables[0]), None)
+                )
+            elif response.status == LogsQueryStatus.PARTIAL:
+                logging.warning(
+                    "Query returned a partial result in a batch, running individually: %s",
+                    response.partial_error.message,
+                )
+                results.append(self.run_query(query, timespan))
+            else:
+                results.append(QueryResult(None, response.message))
+        return results
+
+    def get_portal_url(self, query: str, timespan: Timespan) -> str:
+        # When clicking on the link, Log Analytics runs the query automatically if there's no preceding whitespace
+        return get_log_analytics_portal_url(
+            self.__tenant_id,
+            self.__subscription_id,
+            self.__resource_group_name,
+            self.__workspace_name,
+            query.strip(),
+        )
+
+
+class AppInsightsBackend(QueryBackend):
+    """
+    Runs queries against Application Insights using the REST API
+    """
+
+    link_text = "Run in App Insights"
+
+    def __init__(
+        self,
+        app_id: str,
+        token_credential: TokenCredential,
+        tenant_id: str | None = None,
+        subscription_id: str | None = None,
+        resource_group_name: str | None = None,
+        app_insights_name: str | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            app_id (str): Application ID (can be found in platform.json)
+            token_credential (TokenCredential): TokenCredential object
+            tenant_id (str): Tenant ID (required for links to the Azure Portal)
+            subscription_id (str): Subscription ID (required for links to the Azure Portal)
+            resource_group_name (str): Resource Group Name (required for links to the Azure Portal)
+            app_insights_name (str): App Insights Name (required for links to the Azure Portal)
+        """
+        if app_id is None:
+            raise ValueError("app_id is required")
+        self.source = app_id
+        self.__app_id = app_id
+        self.__token_credential = token_credential
+        self.__tenant_id = tenant_id
+        self.__subscription_id = subscription_id
+        self.__resource_group_name = resource_group_name
+        self.__app_insights_name = app_insights_name
+
+    def run_query(self, query: str, timespan: Timespan) -> QueryResult:
+        token = self.__token_credential.get_token(
+            "https://api.applicationinsights.io/.default"
+        ).token
+        response = get_query_session().post(
+            f"{APPINSIGHTS_ENDPOINT}/{self.__app_id}/query",
+            params={"timespan": format_timespan(timespan)},
+            headers={"Authorization": f"Bearer {token}"},
+            json={"query": query},
+        )
+        if response.status_code != 200:
+            return QueryResult(None, response.text)
+
+        primary_table = response.json()["tables"][0]
+        return QueryResult(
+            Table(
+                columns=[column["name"] for column in primary_table["columns"]],
+                rows=primary_table["rows"],
+            ),
+            None,
+        )
+
+    def get_portal_url(self, query: str, timespan: Timespan) -> str:
+        return get_app_insights_portal_url(
+            self.__tenant_id,
+            self.__subscription_id,
+            self.__resource_group_name,
+            self.__app_insights_name,
+            query,
+            format_timespan(timespan) or "P1D",
+        )
+
+
+class FileBackend(QueryBackend):
+    """
+    Runs queries against results saved to a directory (one file per query and timespan,
+    see query_cache.write_table), e.g. to re-render the results of a test run offline
+    """
+
+    link_text = "Run query"
+
+    def __init__(self, directory: str):
+        """
+        Constructor
+
+        Parameters:
+            directory (str): The directory the results are saved in
+        """
+        self.directory = directory
+        self.source = os.path.abspath(directory)
+
+    def get_result_path(self, query: str, timespan: Timespan) -> str:
+        return os.path.join(
+            self.directory, f"{get_query_key(query, timespan)}{RESULT_FILE_EXTENSION}"
+        )
+
+    def run_query(self, query: str, timespan: Timespan) -> QueryResult:
+        path = self.get_result_path(query, timespan)
+        try:
+            return QueryResult(read_table(path), None)
+        except FileNotFoundError:
+            return QueryResult(None, f"No saved result for the query ({path})")
+
+    def save_result(self, query: str, timespan: Timespan, table: Table):
+        """
+        Save a query result so that it can be loaded by run_query
+        """
+        write_table(
+            self.get_result_path(query, timespan),
+            table,
+            metadata={"query": query, "timespan": format_timespan(timespan)},
+        )
+
+
+class CachedResultBackend(QueryBackend):
+    """
+    Backend for re-rendering reports offline: queries are answered from the result cache
+    only (see QueryProcessor), so any query that isn't cached fails rather than querying
+    the original data source.
+    """
+
+    def __init__(self, source: str, cache_directory: str | None = None):
+        """
+        Constructor
+
+        Parameters:
+            source (str): The source of the original backend (e.g. the workspace ID)
+            cache_directory (str): The directory of the query cache (for the error message)
+        """
+        self.source = source
+        self.cache_directory = cache_directory
+
+    def run_query(self, query: str, timespan: Timespan) -> QueryResult:
+        if self.cache_directory is None:
+            return QueryResult(None, "The query result is not in the query cache")
+        return QueryResult(
+            None,
+            f"The query result is not in the query cache ({self.cache_directory})",
+        )
+
+
+@dataclass
+class IngestionCheck:
+    """
+    Data to wait for with QueryProcessor.wait_for_ingestion: rows in a table
+    (optionally for a metric name in AppMetrics) generated since a point in time.
+    """
+
+    table: str
+    since: datetime
+    metric_name: str | None = None
+
+    def to_query(self) -> str:
+        query = f"{self.table} | where TimeGenerated >= datetime({self.since.strftime('%Y-%m-%dT%H:%M:%SZ')})"
+        if self.metric_name:
+            query += f" and Name == {json.dumps(self.metric_name)}"
+        return query
+
+    def __str__(self) -> str:
+        return f"{self.table} ({self.metric_name})" if self.metric_name else self.table
+
+
+class QueuedQuery(NamedTuple):
+    """
+    A query added with QueryProcessor.add_query
+    """
+
+    title: str
+    query: str
+    validation_func: Callable[[Table], str | None] | None
+    timespan: Timespan
+    is_chart: bool
+    columns: list[str]
+    chart_config: dict
+    group_definition: GroupDefinition | None
+    show_query: bool
+    include_link: bool
+    missing_value: Any
+
+
+def _encode_timespan(timespan: Timespan) -> Any:
+    """
+    Encode a timespan as JSON: durations as {"seconds": n}, (start, end) as a list
+    """
+    if isinstance(timespan, timedelta):
+        return {"seconds": timespan.total_seconds()}
+    if isinstance(timespan, tuple):
+        start, end = timespan
+        return [
+            start.isoformat(),
+            _encode_timespan(end) if isinstance(end, timedelta) else end.isoformat(),
+        ]
+    return timespan
+
+
+def _decode_timespan(value: Any) -> Timespan:
+    if isinstance(value, dict):
+        return timedelta(seconds=value["seconds"])
+    if isinstance(value, list):
+        start, end = value
+        return (
+            datetime.fromisoformat(start),
+            (
+                _decode_timespan(end)
+                if isinstance(end, dict)
+                else datetime.fromisoformat(end)
+            ),
+        )
+    return value
+
+
+def save_report_manifest(path: str, source: str, queries: list[QueuedQuery]):
+    """
+    Save the queries for a report so that it can be re-rendered from the query cache
+    with load_report_manifest (validation functions aren't saved)
+    """
+    manifest = {
+        "created": datetime.now(UTC).isoformat(),
+        "source": source,
+        "queries": [
+            {
+                "title": queued.title,
+                "query": queued.query,
+                "timespan": _encode_timespan(queued.timespan),
+                "is_chart": queued.is_chart,
+                "columns": queued.columns,
+                "chart_config": queued.chart_config,
+                "group_definition": (
+                    asdict(queued.group_definition) if queued.group_definition else None
+                ),
+                "show_query": queued.show_query,
+                "missing_value": queued.missing_value,
+            }
+            for queued in queries
+        ],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_report_manifest(
+    path: str,
+    result_cache: ResultCache = result_cache,
+    backend: QueryBackend | None = None,
+) -> "QueryProcessor":
+    """
+    Load a report saved with save_report_manifest as a QueryProcessor that runs the
+    queries against the query cache only (see CachedResultBackend), or against backend
+    for results that aren't cached
+
+    :param path: The path to the report manifest
+    :param result_cache: The cache with the query results (defaults to the shared result cache)
+    :param backend: The backend to run queries that aren't cached with (must have the same source as the report)
+    """
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if backend is None:
+        backend = CachedResultBackend(
+            manifest["source"], getattr(result_cache.backing_cache, "directory", None)
+        )
+    elif backend.source != manifest["source"]:
+        raise ValueError(
+            f"The report was run against {manifest['source']}, not {backend.source}"
+        )
+    query_processor = QueryProcessor(backend, result_cache)
+    for saved in manifest["queries"]:
+        group_definition = saved.get("group_definition")
+        query_processor.add_query(
+            title=saved["title"],
+            query=saved["query"],
+            timespan=_decode_timespan(saved["timespan"]),
+            is_chart=saved["is_chart"],
+            columns=saved["columns"],
+            chart_config=saved["chart_config"],
+            group_definition=(
+                GroupDefinition(**group_definition) if group_definition else None
+            ),
+            show_query=saved["show_query"],
+            missing_value=saved["missing_value"],
+        )
+    return query_processor
+
+
+class QueryProcessor:
+    """
+    Queues queries, runs them against a QueryBackend and outputs the results.
+    """
+
+    def __init__(
+        self, backend: QueryBackend, result_cache: ResultCache | None = result_cache
+    ) -> None:
+        """
+        Constructor
+
+        Parameters:
+            backend (QueryBackend): The backend to run the queries with
+            result_cache (ResultCache): Cache for the results of queries over fixed timespans that have been ingested (None to disable)
+        """
+        self.backend = backend
+        self.__result_cache = result_cache
+        self.__queries: list[QueuedQuery] = []
+
+    def add_query(
+        self,
+        title,
+        query,
+        validation_func=None,
+        timespan="PT12H",
+        is_chart=False,
+        columns=[],
+        group_definition: GroupDefinition | None = None,
+        chart_config=dict(),
+        show_query=False,
+        include_link=False,
+        missing_value=float("nan"),
+    ):
+        """
+        Adds a query to be executed.
+
+        Parameters:
+            title (str): Title of the query to be run (describes behaviour)
+            query (str): Query to be run in Kusto query language (KQL).
+            validation_func: The function that validates the results of a query.
+            timespan (str): The time period into the past from now to fetch data to query on for.
+                            in format PT<TIME DURATION> e.g. PT12H, or a (start, end) tuple.
+            is_chart (bool): If true then a chart is rendered else a table.
+            columns (list(str)): Columns to render in the chart as series.
+            group_definition (GroupDefinition): Grouping definition for the query result.
+            chart_config (dict): Asciichart graph config, info can be found here: https://github.com/kroitor/asciichart.
+            show_query (bool): If true then the query is printed before the result.
+            include_link (bool): If true then a link to the query in the Azure Portal is printed. Requires the backend's portal details to be set
+            missing_value: Value to chart for empty values.
+        """
+        self.__queries.append(
+            QueuedQuery(
+                title,
+                query,
+                validation_func,
+                timespan,
+                is_chart,
+                columns,
+                chart_config,
+                group_definition,
+                show_query,
+                include_link,
+                missing_value,
+            )
+        )
+
+    def get_all_queries_text(self) -> str:
+        return "".join(
+            f"\n\n// {queued.title}\n{queued.query.strip()}\n\n\n"
+            for queued in self.__queries
+        )
+
+    def get_run_all_queries_link(self, link_text):
+        url = self.backend.get_portal_url(self.get_all_queries_text(), None)
+        return get_link(link_text, url)
+
+    def run_queries(
+        self,
+        all_queries_link_text=None,
+        max_concurrent_queries=DEFAULT_MAX_CONCURRENT_QUERIES,
+        query_mode=None,
+    ):
+        """
+        Runs queries stored in __queries and prints result to stdout.
+
+        The queries are run concurrently (up to max_concurrent_queries at a time)
+        and the results are output in the order that the queries were added.
+
+        Parameters:
+            all_queries_link_text (str): If set, a link to run all the queries in the Azure Portal is printed with this text.
+            max_concurrent_queries (int): Maximum number of queries (or batches in batch mode) to run at once.
+            query_mode (str): "concurrent" or "batch" (defaults to the LOG_ANALYTICS_QUERY_MODE environment variable).
+
+        Returns:
+            The number of queries that failed or failed validation.
+        """
+        query_mode = query_mode or log_analytics_query_mode
+        if query_mode == "batch":
+            query_futures = self.__submit_query_batches(max_concurrent_queries)
+        elif query_mode == "concurrent":
+            query_futures = self.__submit_queries(max_concurrent_queries)
+        else:
+            raise ValueError(f"Unhandled query mode: {query_mode}")
+
+        query_error_count = 0
+        for query_index, queued in enumerate(self.__queries):
+            print()
+            print(f"Running query {query_index + 1} of {len(self.__queries)}")
+            print(f"{asciichart.yellow}{queued.title}{asciichart.reset}")
+            if queued.show_query:
+                print(queued.query)
+                print("")
+            if queued.include_link:
+                url = self.backend.get_portal_url(queued.query, queued.timespan)
+                if url:
+                    print(get_link(self.backend.link_text, url))
+                    print("")
+            if not self.output_result(queued, query_futures[query_index].result()):
+                query_error_count += 1
+                continue
+            print()
+
+        if all_queries_link_text:
+            all_queries_url = self.backend.get_portal_url(
+                self.get_all_queries_text(), None
+            )
+            if all_queries_url:
+                print()
+                print(get_link(all_queries_link_text, all_queries_url))
+                print()
+
+        self.__save_report_manifest()
+        return query_error_count
+
+    def __save_report_manifest(self):
+        """
+        Save a manifest for the report to the query cache directory so that the report
+        can be re-rendered offline (with render_report.py)
+        """
+        backing_cache = self.__result_cache and self.__result_cache.backing_cache
+        if (
+            not isinstance(backing_cache, DiskResultCache)
+            or isinstance(self.backend, CachedResultBackend)
+            # saved for fixed timespans that have ended even if the results aren't cached
+            # yet, as the missing results can be queried later (render_report.py --query-missing)
+            or not any(
+                is_absolute_timespan(queued.timespan, timedelta(0))
+                for queued in self.__queries
+            )
+        ):
+            return
+        report_id = get_query_key(
+            self.get_all_queries_text(), None, self.backend.source
+        )
+        path = os.path.join(
+            backing_cache.directory,
+            REPORTS_DIRECTORY,
+            f"{datetime.now(UTC).strftime('%Y%m%dT%H%M%SZ')}-{report_id[:8]}.json",
+        )
+        try:
+            save_report_manifest(path, self.backend.source, self.__queries)
+        except (OSError, TypeError) as e:
+            logging.warning("Failed to save report manifest: %s", e)
+            return
+        if all(is_absolute_timespan(queued.timespan) for queued in self.__queries):
+            print(
+                f"📄 Report saved - re-render it offline with: python render_report.py {path}"
+            )
+        else:
+            print(
+                f"📄 Report saved - after {query_cache_ingestion_margin_minutes:g} minutes (once the data has been ingested), cache the results with: python render_report.py --query-missing {path}"
+            )
+
+    def output_result(self, queued: QueuedQuery, query_result: QueryResult) -> bool:
+        """
+        Output (and validate) the result of a queued query
+
+        Returns:
+            True if the query succeeded and passed validation.
+        """
+        result, error_message = query_result
+        if error_message:
+            print()
+            print(f"Query '{queued.title}' failed with error: {error_message}")
+            return False
+
+        columns = queued.columns
+        group_definition = queued.group_definition
+        if group_definition:
+            if columns and len(columns) > 0:
+                raise ValueError("Cannot specify columns when using group_definition")
+            result = result.group_by(
+                group_definition.id_column,
+                group_definition.group_column,
+                group_definition.value_column,
+                group_definition.missing_value,
+            )
+            columns = sorted(
+                col
+                for col in result.columns
+                if col.startswith(group_definition.value_column + "_")
+            )
+
+        if queued.is_chart:
+            print(
+                render_chart(result, columns, queued.missing_value, queued.chart_config)
+            )
+        else:
+            print(format_table(result))
+
+        # Validate result
+        if queued.validation_func:
+            validation_error = queued.validation_func(result)
+            if validation_error:
+                print(
+                    f"{asciichart.red}Query '{queued.title}' failed with validation error: {validation_error}{asciichart.reset}"
+                )
+                return False
+        return True
+
+    def __submit_queries(self, max_concurrent_queries) -> list[Future]:
+        """
+        Start running the queries stored in __queries in a bounded thread pool.
+
+        Returns:
+            Futures for the run_query results, in the same order as __queries.
+        """
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(max_concurrent_queries, len(self.__queries))),
+            thread_name_prefix="analysis-query",
+        )
+        futures = [
+            executor.submit(self.run_query, queued.query, queued.timespan)
+            for queued in self.__queries
+        ]
+        # queued queries still run after shutdown - this just releases the threads when they finish
+        executor.shutdown(wait=False)
+        return futures
+
+    def __submit_query_batches(self, max_concurrent_queries) -> list[Future]:
+        """
+        Start running the queries stored in __queries in batches of up to the backend's max_batch_queries.
+
+        Returns:
+            Futures for the query results, in the same order as __queries.
+        """
+        queries = [(queued.query, queued.timespan) for queued in self.__queries]
+        futures = [Future() for _ in queries]
+        batch_size = self.backend.max_batch_queries
+        batch_starts = range(0, len(queries), batch_size)
+
+        def run_batch(start):
+            batch_futures = futures[start : start + batch_size]
+            try:
+                results = self.run_query_batch(queries[start : start + batch_size])
+            except Exception as e:
+                for future in batch_futures:
+                    future.set_exception(e)
+                return
+            for future, result in zip(batch_futures, results):
+                future.set_result(result)
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(max_concurrent_queries, len(batch_starts))),
+            thread_name_prefix="analysis-query",
+        )
+        for start in batch_starts:
+            executor.submit(run_batch, start)
+        executor.shutdown(wait=False)
+        return futures
+
+    def run_query(self, query, timespan, use_cache=True) -> QueryResult:
+        """
+        Runs a query on a given timespan.
+
+        Results for fixed timespans that ended more than CACHE_INGESTION_MARGIN ago are cached (unless use_cache is False).
+
+        Parameters:
+            query (str): Query in Kusto query language (KQL) to run.
+            timespan (str): The time period into the past from now to fetch data to query on for.
+                            in format PT<TIME DURATION> e.g. PT12H, or a (start, end) tuple.
+            use_cache (bool): Whether to use the result cache.
+
+        Returns:
+            Table with results
+            Error message if any.
+        """
+        cache_key = self.__get_cache_key(query, timespan, use_cache)
+        if cache_key is not None:
+            table = self.__result_cache.get(cache_key)
+            if table is not None:
+                return QueryResult(table, None)
+
+        result = self.backend.run_query(query, timespan)
+        if cache_key is not None and result.table is not None:
+            self.__result_cache.put(cache_key, result.table)
+        return result
+
+    def run_query_batch(self, queries, use_cache=True) -> list[QueryResult]:
+        """
+        Runs a batch of queries (see run_query), with up to the backend's max_batch_queries queries.
+        """
+        results: list[QueryResult | None] = [None] * len(queries)
+        cache_keys = [
+            self.__get_cache_key(query, timespan, use_cache)
+            for query, timespan in queries
+        ]
+        for index, cache_key in enumerate(cache_keys):
+            if cache_key is not None:
+                table = self.__result_cache.get(cache_key)
+                if table is not None:
+                    results[index] = QueryResult(table, None)
+
+        uncached = [index for index, result in enumerate(results) if result is None]
+        if uncached:
+            batch_results = self.backend.run_query_batch(
+                [queries[index] for index in uncached]
+            )
+            for index, result in zip(uncached, batch_results):
+                results[index] = result
+                if cache_keys[index] is not None and result.table is not None:
+                    self.__result_cache.put(cache_keys[index], result.table)
+        return results
+
+    def __get_cache_key(self, query, timespan, use_cache) -> str | None:
+        if (
+            not use_cache
+            or self.__result_cache is None
+            or not is_absolute_timespan(timespan)
+        ):
+            return None
+        return get_query_key(query, timespan, self.backend.source)
+
+    def wait_for_non_zero_count(
+        self, query, max_retries=20, wait_time_seconds=30, timespan=None
+    ):
+        """
+        Run a query until it returns a non-zero count.
+
+        The query is polled with an exponential backoff (starting at INGESTION_INITIAL_WAIT_SECONDS
+        and capped at wait_time_seconds) for up to max_retries * wait_time_seconds in total.
+        The timespan defaults to the last day.
+        """
+        logging.info("Check for metrics data, query: %s", query)
+
+        def check():
+            r, error_message = self.run_query(
+                query=query,
+                timespan=timespan
+                or (datetime.now(UTC) - timedelta(days=1), datetime.now(UTC)),
+                use_cache=False,
+            )
+            if error_message:
+                logging.warning("Check for metrics data failed: %s", error_message)
+                return False
+            return r.rows[0][0] > 0
+
+        if not wait_until(
+            check,
+            timeout_seconds=max_retries * wait_time_seconds,
+            max_wait_seconds=wait_time_seconds,
+        ):
+            raise Exception("❌ No metrics data found")
+        logging.info("✔️ Found metrics data")
+
+    def wait_for_ingestion(
+        self,
+        checks: list[IngestionCheck],
+        timeout_seconds=600,
+        max_wait_seconds=INGESTION_MAX_WAIT_SECONDS,
+    ):
+        """
+        Wait until data has been ingested for all of the checks, e.g. both the
+        locust.request_latency metric in AppMetrics and the ApiManagementGatewayLogs.
+
+        The pending checks are polled together in a single query over a timespan that
+        only covers the check times, with an exponential backoff between polls.
+
+        Parameters:
+            checks (list[IngestionCheck]): The data to wait for.
+            timeout_seconds (float): How long to wait before raising an exception.
+            max_wait_seconds (float): The maximum time to wait between polls.
+        """
+        pending = list(checks)
+        logging.info(
+            "Check for ingested data: %s", ", ".join(str(check) for check in pending)
+        )
+
+        def check():
+            counts_query = "union " + ",\n".join(
+                f"({check.to_query()} | count | extend check_index = {index})"
+                for index, check in enumerate(pending)
+            )
+            r, error_message = self.run_query(
+                query=counts_query,
+                timespan=(
+                    min(check.since for check in pending) - INGESTION_TIMESPAN_MARGIN,
+                    datetime.now(UTC) + INGESTION_TIMESPAN_MARGIN,
+                ),
+                use_cache=False,
+            )
+            if error_message:
+                logging.warning("Check for ingested data failed: %s", error_message)
+                return False
+            ingested = {
+                check_index
+                for count, check_index in zip(
+                    r.get_column("Count"), r.get_column("check_index")
+                )
+                if count > 0
+            }
+            for index, check in enumerate(pending):
+                if index in ingested:
+                    logging.info("✔️ Found data: %s", check)
+            pending[:] = [
+                check for index, check in enumerate(pending) if index not in ingested
+            ]
+            return len(pending) == 0
+
+        if not wait_until(
+            check, timeout_seconds=timeout_seconds, max_wait_seconds=max_wait_seconds
+        ):
+            raise Exception(
+                "❌ No data found: " + ", ".join(str(check) for check in pending)
+            )
+
+
+def wait_until(
+    check: Callable[[], bool], timeout_seconds: float, max_wait_seconds: float
+) -> bool:
+    """
+    Call check until it returns True, backing off exponentially between calls
+    (starting at INGESTION_INITIAL_WAIT_SECONDS).
+
+    Returns:
+        True if check returned True before the timeout, otherwise False.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    wait_seconds = min(INGESTION_INITIAL_WAIT_SECONDS, max_wait_seconds)
+    while True:
+        if check():
+            return True
+        if time.monotonic() + wait_seconds > deadline:
+            return False
+        logging.info("⏳ Waiting %.1fs for data...", wait_seconds)
+        time.sleep(wait_seconds)
+        wait_seconds = min(wait_seconds * INGESTION_BACKOFF_FACTOR, max_wait_seconds)
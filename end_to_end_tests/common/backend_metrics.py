@@ -0,0 +1,421 @@
+import logging
+import threading
+import time
+
+import asciichartpy as asciichart
+import gevent
+from tabulate import tabulate
+
+from .config import backend_matrix_interval
+from .distributed import (
+    add_final_report_listener,
+    add_worker_data_transfer,
+    coordinator_only,
+)
+from .request_metrics import LatencyHistogram
+
+#
+# Live per-backend request matrix, built from the response headers that the gateway
+# policies set (so that routing and throttling can be checked while the test runs,
+# rather than from ApiManagementGatewayLogs after ingestion):
+#
+#   x-apim-backend: the backend the request was sent to
+#   x-apim-remaining-tokens/x-apim-remaining-requests: the remaining rate limit
+#     (x-gw-remaining-* from the prioritization policies, x-ratelimit-remaining-*
+#     when calling the backends directly)
+#   x-apim-tokens-retry-after/x-apim-requests-retry-after/Retry-After: the retry-after
+#     for throttled requests
+#
+
+BACKEND_HEADER = "x-apim-backend"
+REMAINING_TOKENS_HEADERS = [
+    "x-apim-remaining-tokens",
+    "x-gw-remaining-tokens",
+    "x-ratelimit-remaining-tokens",
+]
+REMAINING_REQUESTS_HEADERS = [
+    "x-apim-remaining-requests",
+    "x-gw-remaining-requests",
+    "x-ratelimit-remaining-requests",
+]
+# retry-after headers (in seconds, except retry-after-ms)
+RETRY_AFTER_HEADERS = [
+    "x-apim-tokens-retry-after",
+    "x-apim-requests-retry-after",
+    "retry-after",
+]
+RETRY_AFTER_MS_HEADER = "retry-after-ms"
+
+# backend shown for responses without the x-apim-backend header
+UNKNOWN_BACKEND = "-"
+
+# key for the matrix data sent from the workers to the master
+MATRIX_DATA_KEY = "backend_matrix"
+
+
+def _parse_number(value: str | None) -> float | None:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        # e.g. a Retry-After HTTP date
+        return None
+
+
+def _get_first_number(headers, names: list[str]) -> float | None:
+    for name in names:
+        value = _parse_number(headers.get(name))
+        if value is not None:
+            return value
+    return None
+
+
+def get_response_backend(headers) -> str:
+    """
+    Get the backend from the response headers (UNKNOWN_BACKEND if not set)
+    """
+    return headers.get(BACKEND_HEADER) or UNKNOWN_BACKEND
+
+
+def get_remaining_tokens(headers) -> float | None:
+    """
+    Get the remaining tokens from the response headers (None if not set)
+    """
+    return _get_first_number(headers, REMAINING_TOKENS_HEADERS)
+
+
+def get_remaining_requests(headers) -> float | None:
+    """
+    Get the remaining requests from the response headers (None if not set)
+    """
+    return _get_first_number(headers, REMAINING_REQUESTS_HEADERS)
+
+
+def get_retry_after(headers) -> float | None:
+    """
+    Get the longest retry-after (in seconds) from the response headers (None if not set)
+    """
+    values = [_parse_number(headers.get(name)) for name in RETRY_AFTER_HEADERS]
+    retry_after_ms = _parse_number(headers.get(RETRY_AFTER_MS_HEADER))
+    if retry_after_ms is not None:
+        values.append(retry_after_ms / 1000)
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def _min(a: float | None, b: float | None) -> float | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _max(a: float | None, b: float | None) -> float | None:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+class BackendStats:
+    """
+    Request statistics for a backend: request/error/throttled counts, latencies,
+    the lowest remaining tokens/requests and the longest retry-after
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.latency = LatencyHistogram()
+        self.min_remaining_tokens: float | None = None
+        self.min_remaining_requests: float | None = None
+        self.max_retry_after: float | None = None
+
+    def record(
+        self,
+        seconds: float,
+        failed: bool,
+        status_code: int,
+        remaining_tokens: float | None,
+        remaining_requests: float | None,
+        retry_after: float | None,
+    ):
+        self.requests += 1
+        if failed:
+            self.errors += 1
+        if status_code == 429:
+            self.throttled += 1
+        self.latency.record(seconds)
+        self.min_remaining_tokens = _min(self.min_remaining_tokens, remaining_tokens)
+        self.min_remaining_requests = _min(
+            self.min_remaining_requests, remaining_requests
+        )
+        self.max_retry_after = _max(self.max_retry_after, retry_after)
+
+    def merge(self, other: "BackendStats"):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.throttled += other.throttled
+        self.latency.merge(other.latency)
+        self.min_remaining_tokens = _min(
+            self.min_remaining_tokens, other.min_remaining_tokens
+        )
+        self.min_remaining_requests = _min(
+            self.min_remaining_requests, other.min_remaining_requests
+        )
+        self.max_retry_after = _max(self.max_retry_after, other.max_retry_after)
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "latency": self.latency.to_dict(),
+            "min_remaining_tokens": self.min_remaining_tokens,
+            "min_remaining_requests": self.min_remaining_requests,
+            "max_retry_after": self.max_retry_after,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BackendStats":
+        stats = cls()
+        stats.requests = data["requests"]
+        stats.errors = data["errors"]
+        stats.throttled = data["throttled"]
+        stats.latency = LatencyHistogram.from_dict(data["latency"])
+        stats.min_remaining_tokens = data["min_remaining_tokens"]
+        stats.min_remaining_requests = data["min_remaining_requests"]
+        stats.max_retry_after = data["max_retry_after"]
+        return stats
+
+
+class BackendMatrix:
+    """
+    Per-backend request statistics, for the current interval and for the whole run.
+
+    On a worker, the interval data is sent to the master (see pop_data/merge_data),
+    otherwise it is moved into the run statistics by pop_interval
+    """
+
+    def __init__(self):
+        self.__interval_stats: dict[str, BackendStats] = {}
+        self.__stats: dict[str, BackendStats] = {}
+        self.__interval_start = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def record(
+        self,
+        backend: str,
+        seconds: float,
+        failed: bool,
+        status_code: int,
+        remaining_tokens: float | None = None,
+        remaining_requests: float | None = None,
+        retry_after: float | None = None,
+    ):
+        """
+        Record a request to a backend (latency in seconds)
+        """
+        with self.__lock:
+            stats = self.__interval_stats.get(backend)
+            if stats is None:
+                stats = BackendStats()
+                self.__interval_stats[backend] = stats
+            stats.record(
+                seconds,
+                failed,
+                status_code,
+                remaining_tokens,
+                remaining_requests,
+                retry_after,
+            )
+
+    def on_request(
+        self,
+        request_type,
+        name,
+        response_time,
+        response_length,
+        exception,
+        response=None,
+        **kwargs,
+    ):
+        """
+        Request event listener (response_time is in milliseconds)
+        """
+        headers = getattr(response, "headers", None) or {}
+        self.record(
+            get_response_backend(headers),
+            response_time / 1000,
+            bool(exception),
+            getattr(response, "status_code", None) or 0,
+            get_remaining_tokens(headers),
+            get_remaining_requests(headers),
+            get_retry_after(headers),
+        )
+
+    def pop_interval(self) -> tuple[dict[str, BackendStats], float]:
+        """
+        Get the statistics since the last call and start a new interval
+
+        Returns:
+            The statistics for each backend and the length of the interval in seconds
+        """
+        now = time.monotonic()
+        with self.__lock:
+            interval_stats, self.__interval_stats = self.__interval_stats, {}
+            elapsed = now - self.__interval_start
+            self.__interval_start = now
+            for backend, stats in interval_stats.items():
+                run_stats = self.__stats.get(backend)
+                if run_stats is None:
+                    run_stats = BackendStats()
+                    self.__stats[backend] = run_stats
+                run_stats.merge(stats)
+        return dict(sorted(interval_stats.items())), elapsed
+
+    def get_stats(self) -> dict[str, BackendStats]:
+        """
+        Get the statistics for the whole run so far
+        """
+        stats_by_backend: dict[str, BackendStats] = {}
+        with self.__lock:
+            for source in [self.__stats, self.__interval_stats]:
+                for backend, stats in source.items():
+                    if backend not in stats_by_backend:
+                        stats_by_backend[backend] = BackendStats()
+                    stats_by_backend[backend].merge(stats)
+        return dict(sorted(stats_by_backend.items()))
+
+    def pop_data(self) -> dict:
+        """
+        Get the data recorded since the last call (for sending to the master) and start a new interval
+        """
+        with self.__lock:
+            interval_stats, self.__interval_stats = self.__interval_stats, {}
+        return {backend: stats.to_dict() for backend, stats in interval_stats.items()}
+
+    def merge_data(self, data: dict):
+        """
+        Merge data from pop_data (e.g. from a worker) into the current interval
+        """
+        with self.__lock:
+            for backend, stats_data in data.items():
+                stats = BackendStats.from_dict(stats_data)
+                if backend in self.__interval_stats:
+                    self.__interval_stats[backend].merge(stats)
+                else:
+                    self.__interval_stats[backend] = stats
+
+
+def format_backend_matrix(
+    stats_by_backend: dict[str, BackendStats], elapsed: float | None = None
+) -> str:
+    """
+    Format backend statistics as a table (with the request rate if elapsed is set)
+    """
+    total_requests = sum(stats.requests for stats in stats_by_backend.values())
+
+    def format_optional(value: float | None, format: str = "{:.0f}") -> str:
+        return "" if value is None else format.format(value)
+
+    rows = []
+    for backend, stats in stats_by_backend.items():
+        rows.append(
+            [
+                backend,
+                stats.requests,
+                stats.requests / elapsed if elapsed else "",
+                stats.requests / total_requests * 100 if total_requests else 0,
+                stats.errors / stats.requests * 100 if stats.requests else 0,
+                stats.throttled,
+                *[stats.latency.quantile(q) * 1000 for q in [0.5, 0.9, 0.99]],
+                format_optional(stats.min_remaining_tokens),
+                format_optional(stats.min_remaining_requests),
+                format_optional(stats.max_retry_after, "{:g}"),
+            ]
+        )
+    return tabulate(
+        rows,
+        [
+            "Backend",
+            "Requests",
+            "RPS",
+            "Share %",
+            "Errors %",
+            "429s",
+            "p50 (ms)",
+            "p90 (ms)",
+            "p99 (ms)",
+            "Min remaining tokens",
+            "Min remaining requests",
+            "Max retry-after (s)",
+        ],
+        floatfmt=".1f",
+    )
+
+
+# per-process matrix (the master's matrix includes the data from the workers)
+backend_matrix = BackendMatrix()
+
+
+def add_backend_matrix(environment):
+    """
+    Collect the per-backend request statistics, log them every BACKEND_MATRIX_INTERVAL
+    seconds while the test runs and output the totals when the test stops.
+    Call from an init event listener.
+    """
+    environment.events.request.add_listener(backend_matrix.on_request)
+
+    add_worker_data_transfer(
+        environment, MATRIX_DATA_KEY, backend_matrix.pop_data, backend_matrix.merge_data
+    )
+
+    log_greenlet: gevent.Greenlet | None = None
+    test_start_time = test_stop_time = time.monotonic()
+
+    def log_matrix():
+        while True:
+            gevent.sleep(backend_matrix_interval)
+            stats_by_backend, elapsed = backend_matrix.pop_interval()
+            if stats_by_backend:
+                logging.info(
+                    "📊 Backends (last %.0fs):\n%s",
+                    elapsed,
+                    format_backend_matrix(stats_by_backend, elapsed),
+                )
+
+    @coordinator_only
+    def on_test_start(environment, **kwargs):
+        nonlocal log_greenlet, test_start_time
+        test_start_time = time.monotonic()
+        backend_matrix.pop_interval()
+        if backend_matrix_interval > 0:
+            log_greenlet = gevent.spawn(log_matrix)
+
+    @coordinator_only
+    def on_test_stop(environment, **kwargs):
+        nonlocal test_stop_time
+        test_stop_time = time.monotonic()
+        if log_greenlet is not None:
+            log_greenlet.kill(block=False)
+
+    def output_matrix(environment):
+        stats_by_backend = backend_matrix.get_stats()
+        if stats_by_backend:
+            print()
+            print(f"{asciichart.yellow}Backends{asciichart.reset}")
+            print(
+                format_backend_matrix(
+                    stats_by_backend, test_stop_time - test_start_time
+                )
+            )
+            print()
+
+    environment.events.test_start.add_listener(on_test_start)
+    environment.events.test_stop.add_listener(on_test_stop)
+    add_final_report_listener(environment, output_matrix)
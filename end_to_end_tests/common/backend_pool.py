@@ -0,0 +1,521 @@
+import bisect
+import math
+import random
+from abc import ABC, abstractmethod
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+#
+# Python reference implementation of the load balancing capabilities, for checking how
+# a configuration distributes requests offline:
+#
+# - v1: the policy fragments in capabilities/load-balancing (simple-round-robin.xml and
+#   weighted-round-robin.xml)
+# - v2: the APIM backend pools used by capabilities/load-balancing-v2 (configured in
+#   infra/apim-genai/modules/apiManagement.bicep): weights, priorities and the
+#   backends' circuit breaker rules
+#
+# Time is passed in explicitly (seconds) so that traffic can be simulated faster than real time.
+#
+
+# how a pool picks a backend within a priority group
+POOL_SELECTIONS = ["weighted-round-robin", "weighted-random"]
+
+
+@dataclass(frozen=True)
+class CircuitBreakerRule:
+    """
+    A backend circuit breaker rule: the circuit trips for trip_duration seconds when
+    failure_count responses with a status in status_code_ranges are received within
+    interval seconds (or for the Retry-After if accept_retry_after is set)
+    """
+
+    failure_count: int = 3
+    interval: float = 10
+    trip_duration: float = 60
+    status_code_ranges: tuple[tuple[int, int], ...] = ((429, 429),)
+    accept_retry_after: bool = True
+
+    def is_failure(self, status_code: int) -> bool:
+        return any(low <= status_code <= high for low, high in self.status_code_ranges)
+
+
+@dataclass(frozen=True)
+class PoolBackend:
+    """
+    A backend in a pool (priority 1 is used first)
+    """
+
+    backend_id: str
+    weight: int = 1
+    priority: int = 1
+    circuit_breaker: CircuitBreakerRule | None = None
+
+
+# The circuit breaker rule of ptu-backend-1-with-circuit-breaker in apiManagement.bicep
+retry_with_payg_breaker_rule = CircuitBreakerRule(
+    failure_count=3, interval=10, trip_duration=60
+)
+
+# The backend pools from apiManagement.bicep
+default_pools = {
+    "simple-round-robin-backend-pool": [
+        PoolBackend("payg-backend-1", 1, 1),
+        PoolBackend("payg-backend-2", 1, 1),
+    ],
+    "weighted-round-robin-backend-pool": [
+        PoolBackend("payg-backend-1", 2, 1),
+        PoolBackend("payg-backend-2", 1, 1),
+    ],
+    "retry-with-payg-backend-pool": [
+        PoolBackend(
+            "ptu-backend-1-with-circuit-breaker", 1, 1, retry_with_payg_breaker_rule
+        ),
+        PoolBackend("payg-backend-1", 1, 2),
+    ],
+}
+
+# The backends in the v1 fragments
+default_simple_round_robin_backends = ["payg-backend-1", "payg-backend-2"]
+default_weighted_round_robin_backends = [
+    PoolBackend("payg-backend-1", 2),
+    PoolBackend("payg-backend-2", 1),
+]
+
+
+class BackendSelector(ABC):
+    """
+    Base class for the load balancing implementations: selects the backend for each
+    request and is told the response status (for circuit breaking)
+    """
+
+    @abstractmethod
+    def select(self, now: float) -> str | None:
+        """
+        Get the backend for a request (None if no backend is available)
+        """
+
+    def report(
+        self,
+        now: float,
+        backend_id: str,
+        status_code: int,
+        retry_after: float | None = None,
+    ):
+        """
+        Record the response from a backend
+        """
+
+    @abstractmethod
+    def get_expected_shares(self) -> dict[str, float]:
+        """
+        Get the share of the requests each backend should get when all backends are available
+        """
+
+
+class SimpleRoundRobinFragment(BackendSelector):
+    """
+    capabilities/load-balancing/simple-round-robin.xml: a backend-counter in the cache
+    is incremented for each request and the backend is backend-pool[counter % count]
+    (so the first request goes to the second backend).
+
+    The counter is stored with a duration of cache_duration seconds, so it restarts from
+    0 when there are no requests for that long. Concurrent requests reading the same
+    counter value (the cache lookup and store aren't atomic) aren't modelled.
+    """
+
+    def __init__(
+        self,
+        backend_ids: list[str] | None = None,
+        cache_duration: float = 1200,
+    ):
+        self.backend_ids = (
+            backend_ids
+            if backend_ids is not None
+            else default_simple_round_robin_backends
+        )
+        self.cache_duration = cache_duration
+        self.__counter = 0
+        self.__stored_at: float | None = None
+
+    def select(self, now: float) -> str | None:
+        if not self.backend_ids:
+            return None
+        if self.__stored_at is None or now - self.__stored_at > self.cache_duration:
+            # cache-lookup-value default-value
+            self.__counter = 0
+        self.__counter += 1
+        self.__stored_at = now
+        return self.backend_ids[self.__counter % len(self.backend_ids)]
+
+    def get_expected_shares(self) -> dict[str, float]:
+        return _get_shares({backend_id: 1 for backend_id in self.backend_ids})
+
+
+class WeightedRandomFragment(BackendSelector):
+    """
+    capabilities/load-balancing/weighted-round-robin.xml: a random number in
+    [0, total weight) picks the backend whose cumulative weight range contains it
+    (the fragment's "round robin" is a weighted random choice)
+    """
+
+    def __init__(self, backends: list[PoolBackend] | None = None, seed: int = 0):
+        """
+        Constructor
+
+        Parameters:
+            backends (list[PoolBackend]): The all-backends list (only the ids and weights are used)
+            seed (int): Seed for the random numbers (new Random() in the fragment), for repeatable simulations
+        """
+        self.backends = (
+            backends if backends is not None else default_weighted_round_robin_backends
+        )
+        self.__random = random.Random(seed)
+        self.__cumulative_weights = []
+        total_weight = 0
+        for backend in self.backends:
+            total_weight += backend.weight
+            self.__cumulative_weights.append(total_weight)
+        self.__total_weight = total_weight
+
+    def select(self, now: float) -> str | None:
+        if self.__total_weight <= 0:
+            return None
+        random_number = self.__random.randrange(self.__total_weight)
+        index = bisect.bisect_right(self.__cumulative_weights, random_number)
+        return self.backends[index].backend_id
+
+    def get_expected_shares(self) -> dict[str, float]:
+        return _get_shares(
+            {backend.backend_id: backend.weight for backend in self.backends}
+        )
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker state for a backend
+    """
+
+    def __init__(self, rule: CircuitBreakerRule):
+        self.rule = rule
+        self.tripped_until = -math.inf
+        self.trip_count = 0
+        self.__failures: deque[float] = deque()
+
+    def is_tripped(self, now: float) -> bool:
+        return now < self.tripped_until
+
+    def report(
+        self, now: float, status_code: int, retry_after: float | None = None
+    ) -> bool:
+        """
+        Record a response, tripping the circuit if the failure condition is met
+
+        Returns:
+            True if the circuit tripped
+        """
+        rule = self.rule
+        if not rule.is_failure(status_code):
+            return False
+        failures = self.__failures
+        failures.append(now)
+        while failures[0] <= now - rule.interval:
+            failures.popleft()
+        if len(failures) < rule.failure_count:
+            return False
+        duration = rule.trip_duration
+        if rule.accept_retry_after and retry_after:
+            duration = retry_after
+        self.tripped_until = now + duration
+        self.trip_count += 1
+        failures.clear()
+        return True
+
+
+def _get_shares(weights: dict[str, float]) -> dict[str, float]:
+    total = sum(weights.values())
+    return {
+        backend_id: weight / total if total else 0
+        for backend_id, weight in weights.items()
+    }
+
+
+def get_weighted_round_robin_cycle(backends: list[PoolBackend]) -> list[str]:
+    """
+    Get one cycle (total weight requests) of smooth weighted round robin over backends:
+    each backend gets its weight's worth of requests per cycle, spread out through the cycle
+    """
+    current = [0] * len(backends)
+    total_weight = sum(backend.weight for backend in backends)
+    cycle = []
+    for _ in range(total_weight):
+        for index, backend in enumerate(backends):
+            current[index] += backend.weight
+        selected = max(range(len(backends)), key=current.__getitem__)
+        current[selected] -= total_weight
+        cycle.append(backends[selected].backend_id)
+    return cycle
+
+
+class BackendPool(BackendSelector):
+    """
+    An APIM backend pool (v2): requests go to the available backends with the highest
+    priority (lowest number), split by weight. A backend is unavailable while its
+    circuit breaker is tripped, and lower priority backends are only used when all the
+    higher priority backends are unavailable. select returns None (APIM returns a 503)
+    when no backends are available.
+
+    APIM doesn't document how the weights are applied, so the selection within a
+    priority group is either "weighted-round-robin" (smooth weighted round robin: the
+    exact split over each cycle of total weight requests) or "weighted-random".
+    """
+
+    def __init__(
+        self,
+        backends: list[PoolBackend],
+        selection: str = "weighted-round-robin",
+        seed: int = 0,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            backends (list[PoolBackend]): The pool's services
+            selection (str): How to pick a backend within a priority group (one of POOL_SELECTIONS)
+            seed (int): Seed for "weighted-random", for repeatable simulations
+        """
+        if selection not in POOL_SELECTIONS:
+            raise ValueError(f"Unhandled pool selection: {selection}")
+        self.backends = backends
+        self.selection = selection
+        self.circuit_breakers = {
+            backend.backend_id: CircuitBreaker(backend.circuit_breaker)
+            for backend in backends
+            if backend.circuit_breaker is not None
+        }
+        self.__random = random.Random(seed)
+        # backends by priority, highest priority first
+        self.__priority_groups = [
+            [backend for backend in backends if backend.priority == priority]
+            for priority in sorted({backend.priority for backend in backends})
+        ]
+        # the backends in use and how to pick between them, until a circuit breaker changes state
+        self.__available_until = -math.inf
+        self.__group: list[PoolBackend] = []
+        self.__cycle: list[str] = []
+        self.__cycle_position = 0
+        self.__cumulative_weights: list[int] = []
+
+    def select(self, now: float) -> str | None:
+        if now >= self.__available_until:
+            self.__update_group(now)
+        if not self.__group:
+            return None
+        if self.selection == "weighted-round-robin":
+            backend_id = self.__cycle[self.__cycle_position]
+            self.__cycle_position = (self.__cycle_position + 1) % len(self.__cycle)
+            return backend_id
+        random_number = self.__random.randrange(self.__cumulative_weights[-1])
+        index = bisect.bisect_right(self.__cumulative_weights, random_number)
+        return self.__group[index].backend_id
+
+    def report(
+        self,
+        now: float,
+        backend_id: str,
+        status_code: int,
+        retry_after: float | None = None,
+    ):
+        circuit_breaker = self.circuit_breakers.get(backend_id)
+        if circuit_breaker is not None and circuit_breaker.report(
+            now, status_code, retry_after
+        ):
+            # re-evaluate the available backends on the next request
+            self.__available_until = -math.inf
+
+    def is_available(self, backend_id: str, now: float) -> bool:
+        circuit_breaker = self.circuit_breakers.get(backend_id)
+        return circuit_breaker is None or not circuit_breaker.is_tripped(now)
+
+    def get_expected_shares(self) -> dict[str, float]:
+        weights = {backend.backend_id: 0 for backend in self.backends}
+        for backend in self.__priority_groups[0] if self.__priority_groups else []:
+            weights[backend.backend_id] = backend.weight
+        return _get_shares(weights)
+
+    def __update_group(self, now: float):
+        """
+        Find the highest priority group with available backends (and when that could change)
+        """
+        available_until = math.inf
+        group = []
+        for priority_group in self.__priority_groups:
+            for backend in priority_group:
+                circuit_breaker = self.circuit_breakers.get(backend.backend_id)
+                if circuit_breaker is not None and circuit_breaker.is_tripped(now):
+                    available_until = min(
+                        available_until, circuit_breaker.tripped_until
+                    )
+                elif backend.weight > 0:
+                    group.append(backend)
+            if group:
+                break
+        self.__available_until = available_until
+        if [backend.backend_id for backend in group] != [
+            backend.backend_id for backend in self.__group
+        ]:
+            self.__group = group
+            self.__cycle = get_weighted_round_robin_cycle(group) if group else []
+            self.__cycle_position = 0
+            self.__cumulative_weights = []
+            total_weight = 0
+            for backend in group:
+                total_weight += backend.weight
+                self.__cumulative_weights.append(total_weight)
+
+
+class ThrottleWindow(NamedTuple):
+    """
+    A backend returning 429s (with a retry-after) between start and end seconds
+    """
+
+    backend_id: str
+    start: float
+    end: float
+    retry_after: float | None = None
+
+
+@dataclass
+class SimulationSummary:
+    """
+    Request counts from a simulation, keyed by backend id
+    """
+
+    expected_shares: dict[str, float]
+    requests: dict[str, int] = field(default_factory=dict)
+    throttled: dict[str, int] = field(default_factory=dict)
+    no_backend: int = 0
+    total: int = 0
+
+    def get_share(self, backend_id: str) -> float:
+        return self.requests.get(backend_id, 0) / self.total if self.total else 0
+
+    def get_errors(self) -> dict[str, float]:
+        """
+        Get the difference between the actual and expected share of the requests for each backend
+        """
+        backend_ids = list(self.expected_shares) + [
+            backend_id
+            for backend_id in self.requests
+            if backend_id not in self.expected_shares
+        ]
+        return {
+            backend_id: self.get_share(backend_id)
+            - self.expected_shares.get(backend_id, 0)
+            for backend_id in backend_ids
+        }
+
+    def get_max_error(self) -> float:
+        """
+        Get the largest absolute difference between the actual and expected shares
+        """
+        return max((abs(error) for error in self.get_errors().values()), default=0)
+
+    def get_total_variation(self) -> float:
+        """
+        Get the share of the requests that would have to go to a different backend to
+        match the expected shares (the total variation distance)
+        """
+        return sum(abs(error) for error in self.get_errors().values()) / 2
+
+    def get_rows(self) -> list[list]:
+        """
+        Get a row per backend: backend, requests, 429s, expected %, actual %, error (percentage points)
+        """
+        return [
+            [
+                backend_id,
+                self.requests.get(backend_id, 0),
+                self.throttled.get(backend_id, 0),
+                self.expected_shares.get(backend_id, 0) * 100,
+                self.get_share(backend_id) * 100,
+                error * 100,
+            ]
+            for backend_id, error in self.get_errors().items()
+        ]
+
+
+def simulate(
+    selector: BackendSelector,
+    request_count: int,
+    requests_per_second: float = 100,
+    throttle_windows: list[ThrottleWindow] | None = None,
+    get_status: Callable[[str, float], tuple[int, float | None]] | None = None,
+) -> SimulationSummary:
+    """
+    Send evenly spaced requests through a backend selector
+
+    :param selector: The load balancing implementation
+    :param request_count: The number of requests to send
+    :param requests_per_second: The request rate (sets the simulated time for the circuit breakers)
+    :param throttle_windows: Times when backends return 429s
+    :param get_status: Function of (backend id, time) returning the status code and retry-after
+                       for a response (overrides throttle_windows)
+    """
+    summary = SimulationSummary(selector.get_expected_shares())
+    requests = summary.requests
+    throttled = summary.throttled
+    windows_by_backend: dict[str, list[ThrottleWindow]] = {}
+    for window in throttle_windows or []:
+        windows_by_backend.setdefault(window.backend_id, []).append(window)
+
+    def get_throttle_status(backend_id: str, now: float) -> tuple[int, float | None]:
+        for window in windows_by_backend.get(backend_id, []):
+            if window.start <= now < window.end:
+                return 429, window.retry_after
+        return 200, None
+
+    if get_status is None and windows_by_backend:
+        get_status = get_throttle_status
+
+    select = selector.select
+    report = selector.report
+    for i in range(request_count):
+        now = i / requests_per_second
+        backend_id = select(now)
+        if backend_id is None:
+            summary.no_backend += 1
+            continue
+        requests[backend_id] = requests.get(backend_id, 0) + 1
+        if get_status is not None:
+            status_code, retry_after = get_status(backend_id, now)
+            if status_code == 429:
+                throttled[backend_id] = throttled.get(backend_id, 0) + 1
+            report(now, backend_id, status_code, retry_after)
+    summary.total = request_count
+    return summary
+
+
+def generate_backends(
+    count: int,
+    max_weight: int = 10,
+    priorities: int = 1,
+    circuit_breaker: CircuitBreakerRule | None = None,
+    seed: int = 0,
+) -> list[PoolBackend]:
+    """
+    Generate a pool of backends with random weights (1 to max_weight) and priorities
+    (1 to priorities), for checking larger configurations
+    """
+    rng = random.Random(seed)
+    return [
+        PoolBackend(
+            f"backend-{index + 1}",
+            rng.randint(1, max_weight),
+            rng.randint(1, priorities),
+            circuit_breaker,
+        )
+        for index in range(count)
+    ]
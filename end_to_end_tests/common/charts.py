@@ -0,0 +1,58 @@
+from typing import Any
+
+import asciichartpy as asciichart
+from tabulate import tabulate
+
+from .table import Table
+
+# colors for the series in charts with several series
+CHART_COLORS = [
+    asciichart.green,
+    asciichart.yellow,
+    asciichart.blue,
+    asciichart.magenta,
+    asciichart.cyan,
+    asciichart.red,
+]
+
+
+def get_chart_colors(series_count: int) -> list[str]:
+    """
+    Get the colors for the series in a chart (see CHART_COLORS)
+    """
+    return [CHART_COLORS[i % len(CHART_COLORS)] for i in range(series_count)]
+
+
+def format_legend(names: list[str], colors: list[str]) -> str:
+    """
+    Format a legend for the series in a chart
+    """
+    return "  ".join(
+        f"{color}■{asciichart.reset} {name}" for color, name in zip(colors, names)
+    )
+
+
+def format_table(table: Table) -> str:
+    """
+    Format a table as text
+    """
+    return tabulate(table.rows, table.columns)
+
+
+def render_chart(
+    table: Table, columns: list[str], missing_value: Any = None, config=dict()
+) -> str:
+    """
+    Render columns of a table as an asciichart chart
+
+    Parameters:
+        table (Table): The table with the values to chart.
+        columns: Columns of the table to display as a series in the chart.
+        missing_value: Value to chart for empty values.
+        config: The style configuration for the chart, info can be found here: https://github.com/kroitor/asciichart.
+    """
+    series = [
+        [value or missing_value for value in table.get_column(column)]
+        for column in columns
+    ]
+    return asciichart.plot(series, config)
@@ -15,6 +15,34 @@ simulator_api_key = os.getenv("SIMULATOR_API_KEY")
 tenant_id = os.getenv("TENANT_ID")
 subscription_id = os.getenv("SUBSCRIPTION_ID")
 resource_group_name = os.getenv("RESOURCE_GROUP_NAME")
+latency_ranking_statistic = os.getenv("LATENCY_RANKING_STATISTIC", "ewma")
+latency_probe_mode = os.getenv("LATENCY_PROBE_MODE", "full")
+latency_probe_metric = os.getenv("LATENCY_PROBE_METRIC", "total")
+# seconds after which an unchanged ranking is sent to APIM again (the policy caches it
+# for 12000 seconds, and the cache entry can also be evicted or lost on a restart)
+latency_republish_interval = float(os.getenv("LATENCY_REPUBLISH_INTERVAL", "1800"))
+tokenizer_vocabulary_path = os.getenv("TOKENIZER_VOCABULARY_PATH")
+load_generator_client = os.getenv("LOAD_GENERATOR_CLIENT", "http")
+arrival_process = os.getenv("ARRIVAL_PROCESS", "poisson")
+# "concurrent" or "batch" (see log_analytics.QUERY_MODES)
+log_analytics_query_mode = os.getenv("LOG_ANALYTICS_QUERY_MODE", "concurrent")
+# seconds between exports of the (pre-aggregated) request metrics to App Insights
+metrics_export_interval = float(os.getenv("METRICS_EXPORT_INTERVAL", "60"))
+# seconds between logging the per-backend request matrix while the test runs (0 to disable)
+backend_matrix_interval = float(os.getenv("BACKEND_MATRIX_INTERVAL", "30"))
+# show a live dashboard in the terminal while the test runs ("true" to enable)
+live_dashboard = os.getenv("LIVE_DASHBOARD", "false").lower() in ["true", "1"]
+# directory to write the local latency reports to (empty to only print the report)
+latency_report_dir = os.getenv("LATENCY_REPORT_DIR", "latency_reports")
+# directory to cache query results in for re-running reports (empty to disable, see common/query_cache.py)
+query_cache_dir = os.getenv("QUERY_CACHE_DIR", ".query_cache")
+query_cache_max_age_hours = float(os.getenv("QUERY_CACHE_MAX_AGE_HOURS", "168"))
+query_cache_max_size_mb = float(os.getenv("QUERY_CACHE_MAX_SIZE_MB", "256"))
+# minutes after the end of a time range before query results for it are cached
+# (Log Analytics is still ingesting data for the time range until then)
+query_cache_ingestion_margin_minutes = float(
+    os.getenv("QUERY_CACHE_INGESTION_MARGIN_MINUTES", "15")
+)
 
 
 # Load connection string from environment variable or configuration
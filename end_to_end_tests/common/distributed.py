@@ -0,0 +1,104 @@
+import functools
+from typing import Any, Callable
+
+from locust.env import Environment
+from locust.runners import MasterRunner, WorkerRunner
+
+
+def is_worker(environment: Environment) -> bool:
+    """
+    Check whether this process is a worker in a distributed (master/worker) run
+    """
+    return isinstance(environment.runner, WorkerRunner)
+
+
+def coordinator_only(listener):
+    """
+    Decorator for test_start/test_stop listeners that should only run once per test.
+
+    Locust fires these events on the master and on every worker in a distributed run,
+    so the listener is skipped on workers (in a single process run it always runs)
+    """
+
+    @functools.wraps(listener)
+    def wrapper(environment: Environment, **kwargs):
+        if is_worker(environment):
+            return None
+        return listener(environment, **kwargs)
+
+    return wrapper
+
+
+def add_worker_data_transfer(
+    environment: Environment,
+    data_key: str,
+    pop_data: Callable[[], Any],
+    merge_data: Callable[[Any], None],
+):
+    """
+    Send data collected on the workers to the master: with the worker stats reports
+    (every few seconds) and when the worker stops (the workers don't send a stats report
+    when they stop, so the last few seconds would otherwise arrive after test_stop on the master).
+    Call from an init event listener.
+
+    :param environment: The Locust environment
+    :param data_key: Key for the data in the stats reports (and the stop message type)
+    :param pop_data: Called on the workers to get the data since the last call
+    :param merge_data: Called on the master with the data from a worker
+    """
+    if is_worker(environment):
+
+        def on_report_to_master(client_id, data, **kwargs):
+            data[data_key] = pop_data()
+
+        def on_test_stop(environment, **kwargs):
+            environment.runner.send_message(data_key, pop_data())
+
+        environment.events.report_to_master.add_listener(on_report_to_master)
+        environment.events.test_stop.add_listener(on_test_stop)
+    elif isinstance(environment.runner, MasterRunner):
+
+        def on_worker_report(client_id, data, **kwargs):
+            if data_key in data:
+                merge_data(data[data_key])
+
+        def on_worker_stopped(environment, msg, **kwargs):
+            merge_data(msg.data)
+
+        environment.events.worker_report.add_listener(on_worker_report)
+        environment.runner.register_message(data_key, on_worker_stopped)
+
+
+def add_final_report_listener(
+    environment: Environment, listener: Callable[[Environment], None]
+):
+    """
+    Call a listener once per test, after the test has stopped and the workers have sent
+    their final data (see add_worker_data_transfer).
+
+    The listener is called at test_stop, except when the workers are still running at
+    test_stop on the master (the --run-time limit in a headless run stops the master
+    before the workers): then it's called when Locust quits, after the workers have stopped.
+    Call from an init event listener.
+    """
+    pending = False
+
+    @coordinator_only
+    def on_test_stop(environment: Environment, **kwargs):
+        nonlocal pending
+        if (
+            isinstance(environment.runner, MasterRunner)
+            and environment.runner.user_count > 0
+        ):
+            pending = True
+        else:
+            listener(environment)
+
+    def on_quitting(environment: Environment, **kwargs):
+        nonlocal pending
+        if pending:
+            pending = False
+            listener(environment)
+
+    environment.events.test_stop.add_listener(on_test_stop)
+    environment.events.quitting.add_listener(on_quitting)
@@ -0,0 +1,91 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# Status codes that are worth retrying for helper/config calls
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+_session_lock = threading.Lock()
+_shared_session: requests.Session | None = None
+_shared_probe_session: requests.Session | None = None
+_shared_query_session: requests.Session | None = None
+
+
+def create_session(
+    retries: int = 3,
+    backoff_factor: float = 0.5,
+    pool_connections: int = 50,
+    pool_maxsize: int = 20,
+    retry_status_codes: list[int] = RETRY_STATUS_CODES,
+    respect_retry_after: bool = True,
+) -> requests.Session:
+    """
+    Create a session with keep-alive connection pools (one pool per host)
+    and retries with exponential backoff
+
+    Parameters:
+        retries (int): Number of retries for connection errors and retry_status_codes (0 to disable)
+        backoff_factor (float): Backoff factor between retries (see urllib3 Retry)
+        pool_connections (int): Number of hosts to keep connection pools for
+        pool_maxsize (int): Maximum number of connections to keep per host
+        retry_status_codes (list[int]): Status codes to retry (defaults to RETRY_STATUS_CODES)
+        respect_retry_after (bool): Wait for the Retry-After header before retrying (urllib3 also retries 429/503 responses with a Retry-After header when set)
+
+    Returns:
+        requests.Session
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=retry_status_codes,
+        allowed_methods=None,  # retry all methods (the helper calls are idempotent)
+        respect_retry_after_header=respect_retry_after,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Get the shared session for simulator/APIM helper calls (with retries)
+    """
+    global _shared_session
+    with _session_lock:
+        if _shared_session is None:
+            _shared_session = create_session()
+        return _shared_session
+
+
+def get_probe_session() -> requests.Session:
+    """
+    Get the shared session for latency probes.
+    Retries are disabled so that a measurement is always a single request
+    """
+    global _shared_probe_session
+    with _session_lock:
+        if _shared_probe_session is None:
+            _shared_probe_session = create_session(retries=0)
+        return _shared_probe_session
+
+
+def get_query_session() -> requests.Session:
+    """
+    Get the shared session for Log Analytics/Application Insights queries.
+    Retries are disabled as the Azure SDK pipeline has its own retry policy
+    """
+    global _shared_query_session
+    with _session_lock:
+        if _shared_query_session is None:
+            _shared_query_session = create_session(retries=0)
+        return _shared_query_session
+
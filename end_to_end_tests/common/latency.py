@@ -1,41 +1,27 @@
+import json
 import logging
-import os
+import statistics
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
 import requests
 
-from opentelemetry import metrics
-from azure.monitor.opentelemetry import configure_azure_monitor
-
 from .config import (
     apim_endpoint,
     apim_subscription_one_key,
-    app_insights_connection_string,
+    latency_probe_metric,
+    latency_probe_mode,
+    latency_ranking_statistic,
     simulator_api_key,
     simulator_endpoint_payg1,
     simulator_endpoint_payg2,
 )
+from .http_client import get_probe_session, get_session
+from .latency_estimator import LatencyEstimator
+from .simulator_config import SimulatorConfigDelta, apply_simulator_config
 
 deployment_name = "gpt-35-turbo-100k-token"
 
-histogram_request_latency: metrics.Histogram
-
-if app_insights_connection_string:
-    # Options: https://github.com/Azure/azure-sdk-for-python/tree/main/sdk/monitor/azure-monitor-opentelemetry#usage
-    logging.getLogger("azure").setLevel(logging.WARNING)
-    configure_azure_monitor(connection_string=app_insights_connection_string)
-    histogram_request_latency = metrics.get_meter(__name__).create_histogram(
-        "locust.request_latency", "Request latency", "s"
-    )
-
-
-def report_request_metric(
-    request_type, name, response_time, response_length, exception, **kwargs
-):
-    if not exception:
-        # response_time is in milliseconds
-        response_time_s = response_time / 1000
-        histogram_request_latency.record(response_time_s)
-
 
 def set_simulator_completions_latency(endpoint: str, latency: float):
     """
@@ -45,14 +31,7 @@ def set_simulator_completions_latency(endpoint: str, latency: float):
     :param latency: The latency to set - specified in milliseconds per completion token
     """
 
-    url = f"{endpoint}/++/config"
-    response = requests.patch(
-        url=url,
-        headers={"api-key": simulator_api_key, "Content-Type": "application/json"},
-        json={"latency": {"open_ai_completions": {"mean": latency}}},
-        timeout=10,
-    )
-    response.raise_for_status()
+    apply_simulator_config(endpoint, SimulatorConfigDelta(completions_latency=latency))
 
 
 def set_simulator_chat_completions_latency(endpoint: str, latency: float):
@@ -63,22 +42,294 @@ def set_simulator_chat_completions_latency(endpoint: str, latency: float):
     :param latency: The latency to set - specified in milliseconds per chat completion token
     """
 
-    url = f"{endpoint}/++/config"
-    response = requests.patch(
-        url=url,
-        headers={"api-key": simulator_api_key, "Content-Type": "application/json"},
-        json={"latency": {"open_ai_chat_completions": {"mean": latency}}},
-        timeout=10,
+    apply_simulator_config(
+        endpoint, SimulatorConfigDelta(chat_completions_latency=latency)
+    )
+
+
+# shared estimator so that samples accumulate across measurement rounds
+latency_estimator = LatencyEstimator(statistic=latency_ranking_statistic)
+
+latency_backends = [
+    {
+        "endpoint": f"{simulator_endpoint_payg1}/openai",
+        "backend-id": "payg-backend-1",
+    },
+    {
+        "endpoint": f"{simulator_endpoint_payg2}/openai",
+        "backend-id": "payg-backend-2",
+    },
+]
+
+
+PROBE_MODES = ["full", "streaming"]
+PROBE_METRICS = ["total", "time_to_first_token", "inter_token_latency"]
+
+
+@dataclass
+class LatencyMeasurement:
+    """
+    Timings (in seconds) for a single probe request.
+    The token timings are only available for streaming probes (NaN otherwise)
+    """
+
+    total: float
+    time_to_first_token: float = float("nan")
+    inter_token_latency: float = float("nan")
+
+    def get(self, metric: str) -> float:
+        if metric not in PROBE_METRICS:
+            raise ValueError(f"Unhandled probe metric: {metric}")
+        return getattr(self, metric)
+
+
+failed_measurement = LatencyMeasurement(
+    total=float("inf"),
+    time_to_first_token=float("inf"),
+    inter_token_latency=float("inf"),
+)
+
+
+def measure_latency(
+    endpoint: str, timeout: float = 30, session: requests.Session | None = None
+) -> LatencyMeasurement:
+    """
+    Measure the latency of a single endpoint by timing a full (non-streaming) completion
+
+    :param endpoint: The simulator endpoint to measure (including the /openai suffix)
+    :param timeout: The request timeout in seconds
+    :param session: Session to send the request with (defaults to the shared probe session)
+    :return: The measurement (with infinite timings if the request timed out)
+    """
+    client = session or get_probe_session()
+    time_start = time.perf_counter()
+    try:
+        response = client.post(
+            url=f"{endpoint}/deployments/{deployment_name}/completions?api-version=2023-05-15",
+            headers={
+                "api-key": simulator_api_key,
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": "gpt-5-turbo-1",
+                "prompt": "Once upon a time",
+                "max_tokens": 10,
+            },
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        time_end = time.perf_counter()
+        return LatencyMeasurement(total=time_end - time_start)
+    except requests.ReadTimeout:
+        logging.warning("Request to %s timed out", endpoint)
+        return failed_measurement
+
+
+def measure_streaming_latency(
+    endpoint: str, timeout: float = 30, session: requests.Session | None = None
+) -> LatencyMeasurement:
+    """
+    Measure the latency of a single endpoint by timing a streamed completion (the same
+    completions endpoint as measure_latency, so both modes see the same backend latency).
+    This records the time to the first token and the mean time between subsequent
+    tokens as well as the total time
+
+    :param endpoint: The simulator endpoint to measure (including the /openai suffix)
+    :param timeout: The time allowed for the full response in seconds
+    :param session: Session to send the request with (defaults to the shared probe session)
+    :return: The measurement (with infinite timings if the request timed out)
+    """
+    client = session or get_probe_session()
+    time_start = time.perf_counter()
+    try:
+        with client.post(
+            url=f"{endpoint}/deployments/{deployment_name}/completions?api-version=2023-05-15",
+            headers={
+                "api-key": simulator_api_key,
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": "gpt-5-turbo-1",
+                "prompt": "Once upon a time",
+                "max_tokens": 10,
+                "stream": True,
+            },
+            timeout=timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            token_times = []
+            for line in response.iter_lines():
+                now = time.perf_counter()
+                if now - time_start > timeout:
+                    raise requests.ReadTimeout(f"No complete response in {timeout}s")
+                # server-sent events: "data: {chunk}" ... "data: [DONE]"
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:") :].strip()
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                if choices[0].get("text"):
+                    token_times.append(now)
+            time_end = time.perf_counter()
+    except requests.ReadTimeout:
+        logging.warning("Request to %s timed out", endpoint)
+        return failed_measurement
+
+    if len(token_times) == 0:
+        # no content received - treat the whole response as the first token
+        return LatencyMeasurement(
+            total=time_end - time_start,
+            time_to_first_token=time_end - time_start,
+            inter_token_latency=0,
+        )
+    inter_token_latency = (
+        (token_times[-1] - token_times[0]) / (len(token_times) - 1)
+        if len(token_times) > 1
+        else 0
+    )
+    return LatencyMeasurement(
+        total=time_end - time_start,
+        time_to_first_token=token_times[0] - time_start,
+        inter_token_latency=inter_token_latency,
+    )
+
+
+def measure_backend_latencies(
+    backends: list[dict],
+    deadline: float = 30,
+    samples_per_backend: int = 1,
+    probe_mode: str = "full",
+    metric: str = "total",
+    session: requests.Session | None = None,
+) -> list[dict]:
+    """
+    Measure the latency of all backends concurrently
+
+    All backends are probed at the same time and a single deadline applies to the whole round,
+    so a slow backend doesn't delay the measurement of the others.
+    Samples for each backend are taken one after another until the deadline is reached.
+
+    :param backends: The backends to measure (dicts with "endpoint" and "backend-id")
+    :param deadline: The time in seconds allowed for the whole round of measurements
+    :param samples_per_backend: The number of samples to take for each backend
+    :param probe_mode: "full" to time a complete response, "streaming" to also time the tokens
+    :param metric: The probe metric to report as the latency (one of PROBE_METRICS)
+    :param session: Session to send the requests with (defaults to the shared probe session)
+    :return: The backends with the "measurements" and the chosen metric's "latencies" (in seconds)
+             and median "latency" added (infinity if no samples completed),
+             sorted with lowest latency first
+    """
+    if probe_mode not in PROBE_MODES:
+        raise ValueError(f"Unhandled probe mode: {probe_mode}")
+    if metric not in PROBE_METRICS:
+        raise ValueError(f"Unhandled probe metric: {metric}")
+    if probe_mode == "full" and metric != "total":
+        raise ValueError(f"The '{metric}' metric requires the streaming probe mode")
+    if len(backends) == 0:
+        return []
+
+    measure = (
+        measure_streaming_latency if probe_mode == "streaming" else measure_latency
+    )
+
+    round_end = time.perf_counter() + deadline
+
+    def probe(endpoint: str, measurements: list[LatencyMeasurement]):
+        for _ in range(samples_per_backend):
+            remaining = round_end - time.perf_counter()
+            if remaining <= 0:
+                break
+            measurements.append(measure(endpoint, remaining, session))
+
+    executor = ThreadPoolExecutor(
+        max_workers=len(backends), thread_name_prefix="latency-probe"
+    )
+    try:
+        backend_measurements = [[] for _ in backends]
+        futures = [
+            executor.submit(probe, backend["endpoint"], measurements)
+            for backend, measurements in zip(backends, backend_measurements)
+        ]
+        wait(futures, timeout=deadline)
+
+        backends_with_latency = []
+        for backend, future, measurements in zip(
+            backends, futures, backend_measurements
+        ):
+            if not future.done():
+                logging.warning(
+                    "Requests to %s didn't complete within %ss",
+                    backend["endpoint"],
+                    deadline,
+                )
+            elif future.exception():
+                logging.warning(
+                    "Request to %s failed: %s", backend["endpoint"], future.exception()
+                )
+            # take a copy as a straggling probe may still append to the list
+            measurements = list(measurements)
+            latencies = [measurement.get(metric) for measurement in measurements]
+            backends_with_latency.append(
+                {
+                    "endpoint": backend["endpoint"],
+                    "backend-id": backend["backend-id"],
+                    "measurements": measurements,
+                    "latencies": latencies,
+                    "latency": (
+                        statistics.median(latencies) if latencies else float("inf")
+                    ),
+                }
+            )
+    finally:
+        # don't block on any stragglers - their results are no longer needed
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # sort with lowest latency first
+    return sorted(backends_with_latency, key=lambda x: x["latency"])
+
+
+def set_preferred_backends(
+    backend_ids: list[str], session: requests.Session | None = None
+):
+    """
+    Call the helper API published in APIM to set the preferred backend order
+
+    :param backend_ids: The backend IDs in order of preference
+    :param session: Session to send the request with (defaults to the shared session)
+    """
+    client = session or get_session()
+    payload = {"preferredBackends": backend_ids}
+    response = client.post(
+        url=f"{apim_endpoint}/helpers/set-preferred-backends",
+        json=payload,
+        headers={"ocp-apim-subscription-key": apim_subscription_one_key},
+        timeout=30,
     )
     response.raise_for_status()
+    logging.info("    Updated APIM with preferred backends: %s", response.text)
 
 
-def measure_latency_and_update_apim():
+def measure_latency_and_update_apim(
+    deadline: float = 30,
+    samples_per_backend: int = 3,
+    estimator: LatencyEstimator | None = None,
+    probe_mode: str | None = None,
+    metric: str | None = None,
+):
     """
     Make calls to the simulator endpoints to measure the latency.
     Then call the helper API published in APIM to pass this information
     so that it can be used in the latency-routing policy
     In a real scenario, this would be scheduled to run periodically
+
+    :param deadline: The time in seconds allowed for measuring all backends
+    :param samples_per_backend: The number of samples to take for each backend
+    :param estimator: The estimator to record samples in and rank backends with
+                      (defaults to the shared module-level estimator)
+    :param probe_mode: "full" or "streaming" (defaults to LATENCY_PROBE_MODE)
+    :param metric: The probe metric to rank on (defaults to LATENCY_PROBE_METRIC)
     """
 
     # There are various considerations to take into account when measuring the latency
@@ -90,65 +341,61 @@ def measure_latency_and_update_apim():
     # The measurement used here takes a balanced view by measuring the time to receive the full
     # response but setting max_tokens to 10 to limit the degree of variation in the
     # number of tokens in the response (and hence the response time)
+    # For interactive traffic the time to first token is usually a better fit, so setting
+    # LATENCY_PROBE_MODE=streaming streams the response and LATENCY_PROBE_METRIC selects
+    # whether to rank on the total time, time to first token or inter-token latency
+    # Rather than ranking on a single sample, the samples are fed into an estimator that
+    # tracks a rolling window per backend so that one slow request doesn't flip the order
 
-    def measure_latency(endpoint: str):
-        """Helper to measure the latency of an endpoint"""
-        time_start = time.perf_counter()
-        try:
-            response = requests.post(
-                url=f"{endpoint}/deployments/{deployment_name}/completions?api-version=2023-05-15",
-                headers={
-                    "api-key": simulator_api_key,
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": "gpt-5-turbo-1",
-                    "prompt": "Once upon a time",
-                    "max_tokens": 10,
-                },
-                timeout=30,
-            )
-            response.raise_for_status()
-            time_end = time.perf_counter()
-            return time_end - time_start
-        except requests.ReadTimeout:
-            logging.warning("Request to %s timed out", endpoint)
-            return float("inf")
-
-    backends = [
-        {
-            "endpoint": f"{simulator_endpoint_payg1}/openai",
-            "backend-id": "payg-backend-1",
-        },
-        {
-            "endpoint": f"{simulator_endpoint_payg2}/openai",
-            "backend-id": "payg-backend-2",
-        },
-    ]
-    backends_with_latency = [
-        {
-            "endpoint": backend["endpoint"],
-            "backend-id": backend["backend-id"],
-            "latency": measure_latency(backend["endpoint"]),
-        }
-        for backend in backends
-    ]
+    if estimator is None:
+        estimator = latency_estimator
+    if probe_mode is None:
+        probe_mode = latency_probe_mode
+    if metric is None:
+        metric = latency_probe_metric
 
-    # sort with lowest latency first
-    backends_with_latency = sorted(backends_with_latency, key=lambda x: x["latency"])
+    backends_with_latency = measure_backend_latencies(
+        latency_backends, deadline, samples_per_backend, probe_mode, metric
+    )
+    sorted_backends = rank_backends(backends_with_latency, estimator, metric)
+    if sorted_backends is not None:
+        set_preferred_backends(sorted_backends)
+
+
+def rank_backends(
+    backends_with_latency: list[dict], estimator: LatencyEstimator, metric: str
+) -> list[str] | None:
+    """
+    Record a round of measurements in the estimator and rank the backends
+
+    :param backends_with_latency: The result of measure_backend_latencies
+    :param estimator: The estimator to record samples in and rank backends with
+    :param metric: The probe metric that was measured (for logging)
+    :return: The backend IDs with the preferred backend first
+             (or None if no backend responded in time)
+    """
     for backend in backends_with_latency:
-        logging.info(
-            "    %s: %s ms",
-            backend["endpoint"],
-            backend["latency"] * 1000,
-        )
-    sorted_backends = [backend["backend-id"] for backend in backends_with_latency]
+        samples = backend["latencies"] or [float("inf")]
+        for latency in samples:
+            estimator.add_sample(backend["backend-id"], latency)
 
-    payload = {"preferredBackends": sorted_backends}
-    response = requests.post(
-        url=f"{apim_endpoint}/helpers/set-preferred-backends",
-        json=payload,
-        headers={"ocp-apim-subscription-key": apim_subscription_one_key},
+    if all(backend["latency"] == float("inf") for backend in backends_with_latency):
+        # Keep the current ranking in APIM rather than publishing one with no information
+        logging.warning("    No backends responded in time - skipping APIM update")
+        return None
+
+    sorted_backends = estimator.rank(
+        [backend["backend-id"] for backend in backends_with_latency]
     )
-    response.raise_for_status()
-    logging.info("    Updated APIM with preferred backends: %s", response.text)
+    for backend_id in sorted_backends:
+        stats = estimator.get_stats(backend_id)
+        logging.info(
+            "    %s: %s ewma %.1f ms, p50 %.1f ms, p95 %.1f ms (%d samples)",
+            backend_id,
+            metric,
+            stats.ewma * 1000,
+            stats.p50 * 1000,
+            stats.p95 * 1000,
+            stats.sample_count,
+        )
+    return sorted_backends
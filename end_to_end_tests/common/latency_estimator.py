@@ -0,0 +1,170 @@
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass
+
+RANKING_STATISTICS = ["last", "ewma", "p50", "p95"]
+
+
+@dataclass
+class LatencyStats:
+    backend_id: str
+    sample_count: int
+    last: float
+    ewma: float
+    p50: float
+    p95: float
+
+    def get(self, statistic: str) -> float:
+        if statistic not in RANKING_STATISTICS:
+            raise ValueError(f"Unhandled ranking statistic: {statistic}")
+        return getattr(self, statistic)
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """
+    Get the nearest-rank percentile from a sorted list of values
+
+    :param sorted_values: The values to get the percentile for (sorted ascending)
+    :param percent: The percentile to get (0-100)
+    """
+    if len(sorted_values) == 0:
+        return float("nan")
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class _BackendWindow:
+    def __init__(self, window_size: int):
+        self.samples = deque(maxlen=window_size)
+        self.ewma = None
+
+    def add(self, latency: float, alpha: float):
+        self.samples.append(latency)
+        if self.ewma is None:
+            self.ewma = latency
+        else:
+            self.ewma = alpha * latency + (1 - alpha) * self.ewma
+
+
+class LatencyEstimator:
+    """
+    Tracks a rolling window of latency samples per backend and ranks backends on
+    a configurable statistic.
+
+    A single slow sample (e.g. a cold connection or GC pause) shouldn't flip the
+    backend order, so the ranking is sticky: a backend only moves ahead of another
+    when it is faster by more than the hysteresis margin.
+    """
+
+    def __init__(
+        self,
+        window_size: int = 20,
+        ewma_alpha: float = 0.3,
+        statistic: str = "ewma",
+        hysteresis: float = 0.1,
+        failure_latency: float = 30,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            window_size (int): Number of samples to keep per backend
+            ewma_alpha (float): Weight given to the newest sample in the EWMA (0-1)
+            statistic (str): Statistic to rank on (one of RANKING_STATISTICS)
+            hysteresis (float): Fraction by which a backend must be faster than the
+                                backend ahead of it to take its place in the ranking
+            failure_latency (float): Latency (in seconds) recorded for a failed or timed out probe
+        """
+        if statistic not in RANKING_STATISTICS:
+            raise ValueError(f"Unhandled ranking statistic: {statistic}")
+        if not 0 < ewma_alpha <= 1:
+            raise ValueError("ewma_alpha must be in the range (0, 1]")
+        if hysteresis < 0:
+            raise ValueError("hysteresis must not be negative")
+
+        self.window_size = window_size
+        self.ewma_alpha = ewma_alpha
+        self.statistic = statistic
+        self.hysteresis = hysteresis
+        self.failure_latency = failure_latency
+        self.__windows: dict[str, _BackendWindow] = {}
+        self.__ranking: list[str] = []
+        self.__lock = threading.Lock()
+
+    def add_sample(self, backend_id: str, latency: float):
+        """
+        Record a latency sample for a backend
+
+        :param backend_id: The backend the sample is for
+        :param latency: The latency in seconds (infinity/NaN for a failed probe)
+        """
+        if math.isinf(latency) or math.isnan(latency):
+            # an infinite sample would pin the EWMA and percentiles forever
+            latency = self.failure_latency
+        with self.__lock:
+            window = self.__windows.get(backend_id)
+            if window is None:
+                window = _BackendWindow(self.window_size)
+                self.__windows[backend_id] = window
+            window.add(latency, self.ewma_alpha)
+
+    def get_stats(self, backend_id: str) -> LatencyStats | None:
+        """
+        Get the current statistics for a backend (None if there are no samples)
+        """
+        with self.__lock:
+            window = self.__windows.get(backend_id)
+            if window is None or len(window.samples) == 0:
+                return None
+            samples = list(window.samples)
+            ewma = window.ewma
+        sorted_samples = sorted(samples)
+        return LatencyStats(
+            backend_id=backend_id,
+            sample_count=len(samples),
+            last=samples[-1],
+            ewma=ewma,
+            p50=percentile(sorted_samples, 50),
+            p95=percentile(sorted_samples, 95),
+        )
+
+    def rank(self, backend_ids: list[str]) -> list[str]:
+        """
+        Rank the backends with the lowest latency first, applying hysteresis
+        against the previous ranking
+
+        Backends with no samples are ranked last.
+        """
+
+        def get_value(backend_id: str) -> float:
+            stats = self.get_stats(backend_id)
+            return float("inf") if stats is None else stats.get(self.statistic)
+
+        values = {backend_id: get_value(backend_id) for backend_id in backend_ids}
+
+        # start from the previous ranking (new backends go to the end in latency order)
+        ranking = [
+            backend_id for backend_id in self.__ranking if backend_id in values
+        ] + sorted(
+            (
+                backend_id
+                for backend_id in backend_ids
+                if backend_id not in self.__ranking
+            ),
+            key=lambda backend_id: values[backend_id],
+        )
+
+        # bubble a backend ahead only when it is faster by more than the hysteresis margin
+        # (each swap moves a strictly lower value forward, so this terminates)
+        swapped = True
+        while swapped:
+            swapped = False
+            for i in range(len(ranking) - 1):
+                ahead, behind = ranking[i], ranking[i + 1]
+                if values[behind] < values[ahead] * (1 - self.hysteresis):
+                    ranking[i], ranking[i + 1] = behind, ahead
+                    swapped = True
+
+        self.__ranking = ranking
+        return list(ranking)
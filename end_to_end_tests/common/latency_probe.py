@@ -0,0 +1,226 @@
+import logging
+import math
+import random
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import requests
+
+from .http_client import RETRY_STATUS_CODES, create_session
+from .latency import (
+    latency_backends,
+    measure_backend_latencies,
+    rank_backends,
+    set_preferred_backends,
+)
+from .latency_estimator import LatencyEstimator
+
+if TYPE_CHECKING:
+    # latency_report imports locust, which the standalone service does not use
+    from .latency_report import LatencyReport
+
+
+class LatencyProbeService:
+    """
+    Periodically measures the backend latencies and pushes the preferred backend
+    order to APIM (via /helpers/set-preferred-backends).
+
+    This is the scheduled task from the latency-routing capability: it keeps a
+    persistent connection to each backend, only calls APIM when the ranking changes
+    (or every republish_interval, as APIM only caches the ranking for a while) and
+    backs off when APIM throttles the helper API.
+    """
+
+    def __init__(
+        self,
+        backends: list[dict] | None = None,
+        interval: float = 60,
+        jitter: float = 0.1,
+        deadline: float = 30,
+        samples_per_backend: int = 3,
+        probe_mode: str = "full",
+        metric: str = "total",
+        estimator: LatencyEstimator | None = None,
+        max_backoff: float = 600,
+        republish_interval: float = 1800,
+        latency_report: "LatencyReport | None" = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            backends (list[dict]): Backends to probe (dicts with "endpoint" and "backend-id")
+            interval (float): Time in seconds between measurement rounds
+            jitter (float): Random variation applied to the interval (as a fraction of the interval)
+            deadline (float): Time in seconds allowed for each measurement round
+            samples_per_backend (int): Number of samples to take for each backend per round
+            probe_mode (str): "full" or "streaming"
+            metric (str): The probe metric to rank on
+            estimator (LatencyEstimator): Estimator to rank backends with
+            max_backoff (float): Maximum time in seconds to wait when APIM is throttling
+            republish_interval (float): Time in seconds after which an unchanged ranking is sent to APIM again
+            latency_report (LatencyReport): Report to record the probe timings in (the time to first token is recorded in streaming mode)
+        """
+        if not 0 <= jitter < 1:
+            raise ValueError("jitter must be in the range [0, 1)")
+        self.backends = backends if backends is not None else latency_backends
+        self.interval = interval
+        self.jitter = jitter
+        self.deadline = deadline
+        self.samples_per_backend = samples_per_backend
+        self.probe_mode = probe_mode
+        self.metric = metric
+        self.estimator = estimator or LatencyEstimator(failure_latency=deadline)
+        self.max_backoff = max_backoff
+        self.republish_interval = republish_interval
+        self.latency_report = latency_report
+
+        self.rounds_completed = 0
+        self.published_ranking: list[str] | None = None
+        self.__published_time = 0.0
+        self.__backoff = 0
+        # keep-alive connections to each backend (retries disabled so that each
+        # measurement is a single request) and to APIM (429s aren't retried as
+        # run_once backs off when APIM throttles)
+        self.__probe_session = create_session(retries=0)
+        self.__apim_session = create_session(
+            retry_status_codes=[code for code in RETRY_STATUS_CODES if code != 429],
+            respect_retry_after=False,
+        )
+        self.__stop_event = threading.Event()
+        self.__round_completed = threading.Condition()
+        self.__thread: threading.Thread | None = None
+
+    def run_once(self) -> bool:
+        """
+        Run a single measurement round, updating APIM if the ranking has changed
+        (or was last sent more than republish_interval seconds ago)
+
+        Returns:
+            True if the round completed, False if APIM throttled the update
+        """
+        backends_with_latency = measure_backend_latencies(
+            self.backends,
+            self.deadline,
+            self.samples_per_backend,
+            self.probe_mode,
+            self.metric,
+            self.__probe_session,
+        )
+        if self.latency_report is not None:
+            self.__record_measurements(backends_with_latency)
+        ranking = rank_backends(backends_with_latency, self.estimator, self.metric)
+
+        throttled = False
+        republish_due = (
+            time.monotonic() - self.__published_time >= self.republish_interval
+        )
+        if ranking is not None and (ranking != self.published_ranking or republish_due):
+            if ranking == self.published_ranking:
+                logging.info("    Ranking unchanged - refreshing the APIM cache")
+            try:
+                set_preferred_backends(ranking, self.__apim_session)
+                self.published_ranking = ranking
+                self.__published_time = time.monotonic()
+                self.__backoff = 0
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 429:
+                    raise
+                throttled = True
+                self.__backoff = self.__get_backoff(e.response)
+                logging.warning(
+                    "⏳ APIM throttled the preferred backends update - retrying in %ss",
+                    self.__backoff,
+                )
+        elif ranking is not None:
+            logging.info("    Ranking unchanged - skipping APIM update")
+
+        with self.__round_completed:
+            self.rounds_completed += 1
+            self.__round_completed.notify_all()
+        return not throttled
+
+    def run_forever(self, run_immediately: bool = True):
+        """
+        Run measurement rounds until stop() is called
+        """
+        delay = 0 if run_immediately else self.__next_delay()
+        while not self.__stop_event.wait(delay):
+            try:
+                completed = self.run_once()
+            except Exception as e:
+                logging.error("Latency probe round failed: %s", e)
+                completed = False
+                self.__backoff = min(
+                    max(self.__backoff * 2, self.interval), self.max_backoff
+                )
+            delay = self.__next_delay() if completed else self.__backoff
+
+    def start(self, run_immediately: bool = True):
+        """
+        Start running measurement rounds in a background thread
+        """
+        if self.__thread is not None:
+            raise RuntimeError("LatencyProbeService is already running")
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(
+            target=self.run_forever,
+            args=(run_immediately,),
+            name="latency-probe-service",
+            daemon=True,
+        )
+        self.__thread.start()
+
+    def stop(self, timeout: float | None = None):
+        """
+        Stop the background thread (if running) and close the connections
+        """
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+        self.__probe_session.close()
+        self.__apim_session.close()
+
+    def wait_for_rounds(self, rounds: int, timeout: float | None = None) -> bool:
+        """
+        Wait until the given number of measurement rounds have completed
+
+        Returns:
+            True if the rounds completed, False if the timeout expired
+        """
+        with self.__round_completed:
+            return self.__round_completed.wait_for(
+                lambda: self.rounds_completed >= rounds, timeout
+            )
+
+    def __record_measurements(self, backends_with_latency: list[dict]):
+        for backend in backends_with_latency:
+            user_class = f"LatencyProbe ({backend['backend-id']})"
+            for measurement in backend["measurements"]:
+                if not math.isfinite(measurement.total):
+                    self.latency_report.record_failure(user_class, "-")
+                    continue
+                self.latency_report.record(
+                    user_class, "-", "response_time", measurement.total
+                )
+                if math.isfinite(measurement.time_to_first_token):
+                    self.latency_report.record(
+                        user_class,
+                        "-",
+                        "time_to_first_token",
+                        measurement.time_to_first_token,
+                    )
+
+    def __next_delay(self) -> float:
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def __get_backoff(self, response: requests.Response) -> float:
+        retry_after = response.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            retry_after = 0
+        backoff = max(self.__backoff * 2, retry_after, 1)
+        return min(backoff, self.max_backoff)
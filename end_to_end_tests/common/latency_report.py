@@ -0,0 +1,306 @@
+import json
+import logging
+import math
+import os
+import threading
+from datetime import UTC, datetime
+
+import asciichartpy as asciichart
+from tabulate import tabulate
+
+from .charts import format_legend, get_chart_colors, render_chart
+from .config import latency_report_dir
+from .distributed import add_final_report_listener, add_worker_data_transfer
+from .request_metrics import LatencyHistogram
+from .table import Table
+from .users import get_request_priority
+
+#
+# Local latency report: HDR-style histograms of the request latencies per user class
+# and priority, written when the test stops (without waiting for App Insights ingestion).
+#
+# The user class comes from LoadTestUser.context() and the priority from the request
+# context (client.post(..., context={"priority": "low"})) or the x-priority header.
+#
+
+# 128 buckets per doubling keeps the reported percentiles within ~0.3% of the recorded values
+REPORT_BUCKETS_PER_DOUBLING = 128
+
+REPORT_PERCENTILES = {
+    "p50": 0.5,
+    "p90": 0.9,
+    "p99": 0.99,
+    "p99.9": 0.999,
+}
+
+REPORT_METRICS = ["response_time", "time_to_first_token"]
+
+# key for the report data sent from the workers to the master
+REPORT_DATA_KEY = "latency_report"
+
+# number of points in the percentile chart (from p0 to p99.9, spaced evenly in "nines")
+CHART_POINTS = 60
+
+
+def get_chart_quantiles(
+    points: int = CHART_POINTS, max_nines: float = 3
+) -> list[float]:
+    """
+    Get the quantiles to chart: evenly spaced in "nines" from 0 to max_nines (p99.9 for 3)
+    so that the tail of the distribution gets as much of the chart as the median
+    """
+    return [1 - 10 ** (-max_nines * i / (points - 1)) for i in range(points)]
+
+
+class LatencyReport:
+    """
+    Latency histograms (see request_metrics.LatencyHistogram) for each user class, priority
+    and metric ("response_time", or "time_to_first_token" for streaming requests)
+    """
+
+    def __init__(self):
+        self.__histograms: dict[tuple[str, str, str], LatencyHistogram] = {}
+        self.__failures: dict[tuple[str, str], int] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, user_class: str, priority: str, metric: str, seconds: float):
+        """
+        Record a latency in seconds
+        """
+        key = (user_class, priority, metric)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = LatencyHistogram(REPORT_BUCKETS_PER_DOUBLING)
+                self.__histograms[key] = histogram
+            histogram.record(seconds)
+
+    def record_failure(self, user_class: str, priority: str):
+        key = (user_class, priority)
+        with self.__lock:
+            self.__failures[key] = self.__failures.get(key, 0) + 1
+
+    def on_request(
+        self,
+        request_type,
+        name,
+        response_time,
+        response_length,
+        exception,
+        response=None,
+        context=None,
+        **kwargs,
+    ):
+        """
+        Request event listener: failed requests are counted and the response time of
+        successful requests is recorded (response_time is in milliseconds)
+        """
+        user_class = (context or {}).get("user_class", "")
+        priority = get_request_priority(response, context)
+        if exception:
+            self.record_failure(user_class, priority)
+        else:
+            self.record(user_class, priority, "response_time", response_time / 1000)
+
+    def pop_data(self) -> dict:
+        """
+        Get the data recorded since the last call (for sending to the master) and reset the report
+        """
+        with self.__lock:
+            histograms, self.__histograms = self.__histograms, {}
+            failures, self.__failures = self.__failures, {}
+        return {
+            "histograms": [
+                [*key, histogram.to_dict()] for key, histogram in histograms.items()
+            ],
+            "failures": [[*key, count] for key, count in failures.items()],
+        }
+
+    def merge_data(self, data: dict):
+        """
+        Merge data from pop_data (e.g. from a worker) into the report
+        """
+        with self.__lock:
+            for user_class, priority, metric, histogram_data in data["histograms"]:
+                key = (user_class, priority, metric)
+                histogram = LatencyHistogram.from_dict(histogram_data)
+                if key in self.__histograms:
+                    self.__histograms[key].merge(histogram)
+                else:
+                    self.__histograms[key] = histogram
+            for user_class, priority, count in data["failures"]:
+                key = (user_class, priority)
+                self.__failures[key] = self.__failures.get(key, 0) + count
+
+    def get_histograms(self) -> dict[tuple[str, str, str], LatencyHistogram]:
+        with self.__lock:
+            return dict(sorted(self.__histograms.items()))
+
+    def to_dict(self) -> dict:
+        """
+        Get the report as a JSON-serializable dict
+        """
+        histograms = self.get_histograms()
+        with self.__lock:
+            failures = dict(self.__failures)
+        groups = []
+        for user_class, priority in sorted(
+            {key[:2] for key in histograms} | set(failures)
+        ):
+            group = {
+                "user_class": user_class,
+                "priority": priority,
+                "failures": failures.get((user_class, priority), 0),
+            }
+            for metric in REPORT_METRICS:
+                histogram = histograms.get((user_class, priority, metric))
+                if histogram is None:
+                    continue
+                group[metric] = {
+                    "count": histogram.count,
+                    "mean": histogram.mean(),
+                    "min": histogram.min,
+                    **{
+                        name: histogram.quantile(q)
+                        for name, q in REPORT_PERCENTILES.items()
+                    },
+                    "max": histogram.max,
+                    "histogram": histogram.to_dict(),
+                }
+            groups.append(group)
+        return {"created": datetime.now(UTC).isoformat(), "groups": groups}
+
+    def format_summary(self) -> str:
+        """
+        Format the percentiles (in milliseconds) as a table
+        """
+        histograms = self.get_histograms()
+        with self.__lock:
+            failures = dict(self.__failures)
+        rows = [
+            [
+                user_class,
+                priority,
+                metric,
+                histogram.count,
+                (
+                    failures.get((user_class, priority), 0)
+                    if metric == "response_time"
+                    else ""
+                ),
+                *[histogram.quantile(q) * 1000 for q in REPORT_PERCENTILES.values()],
+                histogram.max * 1000,
+            ]
+            for (user_class, priority, metric), histogram in histograms.items()
+        ]
+        return tabulate(
+            rows,
+            [
+                "User class",
+                "Priority",
+                "Metric",
+                "Count",
+                "Failures",
+                *[f"{name} (ms)" for name in REPORT_PERCENTILES],
+                "max (ms)",
+            ],
+            floatfmt=".1f",
+        )
+
+    def render_percentile_chart(self, metric: str = "response_time") -> str | None:
+        """
+        Render the latency (in milliseconds) by percentile for each user class and priority
+        (None if there are no latencies for the metric)
+        """
+        histograms = {
+            f"{user_class} ({priority})": histogram
+            for (
+                user_class,
+                priority,
+                key_metric,
+            ), histogram in self.get_histograms().items()
+            if key_metric == metric
+        }
+        if not histograms:
+            return None
+        quantiles = get_chart_quantiles()
+        columns = list(histograms)
+        table = Table(
+            columns=["quantile", *columns],
+            column_values=[
+                quantiles,
+                *[
+                    [histogram.quantile(q) * 1000 for q in quantiles]
+                    for histogram in histograms.values()
+                ],
+            ],
+        )
+        colors = get_chart_colors(len(columns))
+        legend = format_legend(columns, colors)
+        chart = render_chart(
+            table,
+            columns,
+            math.nan,
+            {"height": 15, "min": 0, "colors": colors, "format": "{:8.0f} "},
+        )
+        return f"{legend}\n{chart}\n{' ' * 10}p0{'p90'.center(CHART_POINTS // 3 - 2)}{'p99'.center(CHART_POINTS // 3)}{'p99.9'.rjust(CHART_POINTS // 3)}"
+
+    def write(self, directory: str) -> str:
+        """
+        Write the report as JSON to a timestamped file in a directory
+
+        Returns:
+            The path of the file
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory,
+            f"latency-report-{datetime.now(UTC).strftime('%Y%m%dT%H%M%SZ')}.json",
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+    def output(self, directory: str | None = None):
+        """
+        Print the report (and write it as JSON if directory is set)
+        """
+        if not self.get_histograms():
+            logging.info("No requests for the latency report")
+            return
+        print()
+        print(f"{asciichart.yellow}Latency report{asciichart.reset}")
+        print(self.format_summary())
+        for metric in REPORT_METRICS:
+            chart = self.render_percentile_chart(metric)
+            if chart:
+                print()
+                print(
+                    f"{asciichart.yellow}{metric} (ms) by percentile{asciichart.reset}"
+                )
+                print(chart)
+        if directory:
+            path = self.write(directory)
+            print()
+            print(f"📄 Latency report saved to {path}")
+        print()
+
+
+# per-process report (the master's report includes the data from the workers)
+latency_report = LatencyReport()
+
+
+def add_latency_report(environment):
+    """
+    Collect the request latencies for the latency report and output it when the test stops.
+    Call from an init event listener.
+    """
+    environment.events.request.add_listener(latency_report.on_request)
+
+    add_worker_data_transfer(
+        environment, REPORT_DATA_KEY, latency_report.pop_data, latency_report.merge_data
+    )
+
+    add_final_report_listener(
+        environment, lambda environment: latency_report.output(latency_report_dir)
+    )
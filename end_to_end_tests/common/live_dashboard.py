@@ -0,0 +1,333 @@
+import logging
+import sys
+import threading
+import time
+from collections import deque
+
+import asciichartpy as asciichart
+import gevent
+import locust.runners
+from tabulate import tabulate
+
+from .backend_metrics import get_remaining_tokens, get_response_backend
+from .charts import format_legend, get_chart_colors
+from .config import live_dashboard
+from .distributed import add_worker_data_transfer, coordinator_only, is_worker
+from .users import get_request_priority
+
+#
+# Live terminal dashboard (LIVE_DASHBOARD=true): requests per second by priority,
+# 429s, the remaining tokens and the split between the backends, redrawn every second
+# from counters kept in-process (see backend_metrics for the response headers used).
+#
+# Recording a request is a dictionary lookup and a couple of additions, and the
+# refresh interval is increased if rendering takes more than MAX_RENDER_CPU_FRACTION
+# of the time.
+#
+
+REFRESH_INTERVAL_SECONDS = 1
+# number of samples (one per refresh) shown in the chart
+HISTORY_SAMPLES = 60
+# number of samples that the rates are averaged over (the workers report every second
+# when the dashboard is enabled, so this smooths out uneven arrivals from the workers)
+RATE_WINDOW_SAMPLES = 5
+MAX_RENDER_CPU_FRACTION = 0.01
+
+# key for the dashboard data sent from the workers to the master
+DASHBOARD_DATA_KEY = "live_dashboard"
+
+# move the cursor to the top left and clear the screen
+CLEAR_SCREEN = "\x1b[H\x1b[J"
+
+
+class DashboardCounts:
+    """
+    Request counts for a priority and backend
+    """
+
+    __slots__ = ["requests", "throttled", "min_remaining_tokens"]
+
+    def __init__(self):
+        self.requests = 0
+        self.throttled = 0
+        self.min_remaining_tokens: float | None = None
+
+    def add(self, requests: int, throttled: int, min_remaining_tokens: float | None):
+        self.requests += requests
+        self.throttled += throttled
+        if min_remaining_tokens is not None and (
+            self.min_remaining_tokens is None
+            or min_remaining_tokens < self.min_remaining_tokens
+        ):
+            self.min_remaining_tokens = min_remaining_tokens
+
+
+class DashboardSample:
+    """
+    Request counts for each (priority, backend) over one refresh interval
+    """
+
+    def __init__(self, counts: dict[tuple[str, str], DashboardCounts], seconds: float):
+        self.counts = counts
+        self.seconds = seconds
+
+
+def _sum_counts(
+    samples: list[DashboardSample], key_index: int
+) -> dict[str, DashboardCounts]:
+    """
+    Sum the counts in samples by priority (key_index 0) or backend (key_index 1)
+    """
+    totals: dict[str, DashboardCounts] = {}
+    for sample in samples:
+        for key, counts in sample.counts.items():
+            total = totals.get(key[key_index])
+            if total is None:
+                total = DashboardCounts()
+                totals[key[key_index]] = total
+            total.add(counts.requests, counts.throttled, counts.min_remaining_tokens)
+    return dict(sorted(totals.items()))
+
+
+class LiveDashboard:
+    """
+    Request counts by priority and backend, sampled every refresh interval and
+    rendered as a chart of the request rates and tables of the last RATE_WINDOW_SAMPLES
+    """
+
+    def __init__(self):
+        # counts since the last sample
+        self.__counts: dict[tuple[str, str], DashboardCounts] = {}
+        self.__samples: deque[DashboardSample] = deque(maxlen=HISTORY_SAMPLES)
+        self.__sample_time = time.monotonic()
+        self.__lock = threading.Lock()
+        # CPU time spent rendering since run was called
+        self.render_seconds = 0.0
+        self.frame_count = 0
+        self.__run_start_time: float | None = None
+
+    def record(
+        self,
+        priority: str,
+        backend: str,
+        requests: int = 1,
+        throttled: int = 0,
+        min_remaining_tokens: float | None = None,
+    ):
+        key = (priority, backend)
+        with self.__lock:
+            counts = self.__counts.get(key)
+            if counts is None:
+                counts = DashboardCounts()
+                self.__counts[key] = counts
+            counts.add(requests, throttled, min_remaining_tokens)
+
+    def on_request(
+        self,
+        request_type,
+        name,
+        response_time,
+        response_length,
+        exception,
+        response=None,
+        context=None,
+        **kwargs,
+    ):
+        """
+        Request event listener
+        """
+        headers = getattr(response, "headers", None) or {}
+        self.record(
+            get_request_priority(response, context),
+            get_response_backend(headers),
+            1,
+            1 if getattr(response, "status_code", None) == 429 else 0,
+            get_remaining_tokens(headers),
+        )
+
+    def pop_data(self) -> list:
+        """
+        Get the counts since the last call (for sending to the master)
+        """
+        with self.__lock:
+            counts, self.__counts = self.__counts, {}
+        return [
+            [priority, backend, c.requests, c.throttled, c.min_remaining_tokens]
+            for (priority, backend), c in counts.items()
+        ]
+
+    def merge_data(self, data: list):
+        """
+        Merge counts from pop_data (e.g. from a worker)
+        """
+        for priority, backend, requests, throttled, min_remaining_tokens in data:
+            self.record(priority, backend, requests, throttled, min_remaining_tokens)
+
+    def take_sample(self):
+        """
+        Add the counts since the last sample to the history
+        """
+        now = time.monotonic()
+        with self.__lock:
+            counts, self.__counts = self.__counts, {}
+            seconds, self.__sample_time = now - self.__sample_time, now
+        self.__samples.append(DashboardSample(counts, seconds))
+
+    def render(self) -> str:
+        """
+        Render the dashboard as text
+        """
+        samples = list(self.__samples)
+        window = samples[-RATE_WINDOW_SAMPLES:]
+        window_seconds = sum(sample.seconds for sample in window) or 1
+        lines = [
+            f"{asciichart.yellow}Live dashboard{asciichart.reset}"
+            f" - {time.strftime('%H:%M:%S')}"
+            f" (rates over the last {window_seconds:.0f}s)",
+            "",
+        ]
+
+        priorities = list(_sum_counts(samples, 0))
+        if len(samples) > 1 and priorities:
+            lines.append(f"Requests/s by priority (last {len(samples)} samples)")
+            lines.append(self.__render_rate_chart(samples, priorities))
+            lines.append("")
+
+        for title, key_index in [("Priority", 0), ("Backend", 1)]:
+            totals = _sum_counts(window, key_index)
+            total_requests = sum(counts.requests for counts in totals.values())
+            rows = [
+                [
+                    name,
+                    counts.requests / window_seconds,
+                    counts.requests / total_requests * 100 if total_requests else 0,
+                    counts.throttled / window_seconds,
+                    counts.throttled / counts.requests * 100 if counts.requests else 0,
+                    (
+                        ""
+                        if counts.min_remaining_tokens is None
+                        else f"{counts.min_remaining_tokens:.0f}"
+                    ),
+                ]
+                for name, counts in totals.items()
+            ]
+            lines.append(
+                tabulate(
+                    rows,
+                    [
+                        title,
+                        "RPS",
+                        "Share %",
+                        "429/s",
+                        "429 %",
+                        "Min remaining tokens",
+                    ],
+                    floatfmt=".1f",
+                )
+            )
+            lines.append("")
+
+        lines.append(
+            f"Rendering: {self.get_render_cpu_fraction() * 100:.2f}% of the time"
+        )
+        return "\n".join(lines)
+
+    def get_render_cpu_fraction(self) -> float:
+        """
+        Get the CPU time spent rendering as a fraction of the time since run was called
+        """
+        if self.__run_start_time is None:
+            return 0
+        return self.render_seconds / max(
+            time.monotonic() - self.__run_start_time, REFRESH_INTERVAL_SECONDS
+        )
+
+    def run(self, output=sys.stdout):
+        """
+        Sample and redraw the dashboard until killed
+        """
+        self.__run_start_time = time.monotonic()
+        refresh_interval = REFRESH_INTERVAL_SECONDS
+        while True:
+            gevent.sleep(refresh_interval)
+            self.take_sample()
+            start = time.thread_time()
+            output.write(CLEAR_SCREEN + self.render() + "\n")
+            output.flush()
+            render_seconds = time.thread_time() - start
+            self.render_seconds += render_seconds
+            self.frame_count += 1
+            # refresh less often rather than going over the CPU budget
+            refresh_interval = max(
+                REFRESH_INTERVAL_SECONDS, render_seconds / MAX_RENDER_CPU_FRACTION
+            )
+
+    def __render_rate_chart(
+        self, samples: list[DashboardSample], priorities: list[str]
+    ) -> str:
+        sample_requests = [
+            {
+                priority: counts.requests
+                for priority, counts in _sum_counts([sample], 0).items()
+            }
+            for sample in samples
+        ]
+        series = []
+        for priority in priorities:
+            rates = []
+            for end in range(1, len(samples) + 1):
+                start = max(0, end - RATE_WINDOW_SAMPLES)
+                requests = sum(
+                    counts.get(priority, 0) for counts in sample_requests[start:end]
+                )
+                seconds = sum(sample.seconds for sample in samples[start:end])
+                rates.append(requests / (seconds or 1))
+            series.append(rates)
+        colors = get_chart_colors(len(priorities))
+        chart = asciichart.plot(
+            series, {"height": 10, "min": 0, "colors": colors, "format": "{:8.1f} "}
+        )
+        return f"{format_legend(priorities, colors)}\n{chart}"
+
+
+# per-process dashboard (the master's dashboard includes the counts from the workers)
+dashboard = LiveDashboard()
+
+
+def add_live_dashboard(environment):
+    """
+    Show the live dashboard while the test runs if LIVE_DASHBOARD is set.
+    Call from an init event listener.
+    """
+    if not live_dashboard:
+        return
+
+    environment.events.request.add_listener(dashboard.on_request)
+    add_worker_data_transfer(
+        environment, DASHBOARD_DATA_KEY, dashboard.pop_data, dashboard.merge_data
+    )
+    if is_worker(environment):
+        # report to the master every refresh rather than every 3 seconds
+        locust.runners.WORKER_REPORT_INTERVAL = REFRESH_INTERVAL_SECONDS
+        return
+
+    dashboard_greenlet: gevent.Greenlet | None = None
+
+    @coordinator_only
+    def on_test_start(environment, **kwargs):
+        nonlocal dashboard_greenlet
+        dashboard.take_sample()
+        dashboard_greenlet = gevent.spawn(dashboard.run)
+
+    @coordinator_only
+    def on_test_stop(environment, **kwargs):
+        if dashboard_greenlet is not None:
+            dashboard_greenlet.kill(block=False)
+            logging.info(
+                "📺 Live dashboard rendering took %.2f%% of the time (%s frames)",
+                dashboard.get_render_cpu_fraction() * 100,
+                dashboard.frame_count,
+            )
+
+    environment.events.test_start.add_listener(on_test_start)
+    environment.events.test_stop.add_listener(on_test_stop)
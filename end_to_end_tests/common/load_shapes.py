@@ -0,0 +1,254 @@
+import logging
+import math
+import random
+import time
+
+import gevent
+from locust import LoadTestShape, events
+from locust.runners import MasterRunner
+
+from .config import arrival_process
+from .distributed import is_worker
+from .users import LoadTestUser
+
+#
+# Open-loop load: requests are sent at a target arrival rate regardless of how long
+# the responses take (unlike wait_time=constant(1), where a slow gateway reduces the load)
+#
+
+# "poisson" gives exponentially distributed gaps between requests, "uniform" evenly spaced requests
+ARRIVAL_PROCESSES = ["poisson", "uniform"]
+
+# custom message used to send the per-worker rates from the master to the workers
+ARRIVAL_RATES_MESSAGE = "arrival_rates"
+
+
+class ArrivalSchedule:
+    """
+    Hands out request arrival times for a stream of requests at a target rate
+    """
+
+    def __init__(self, process: str = "poisson", seed: int | None = None):
+        if process not in ARRIVAL_PROCESSES:
+            raise ValueError(f"Unhandled arrival process: {process}")
+        self.process = process
+        self.rate = 0
+        # incremented on each rate change so that arrivals claimed at the old rate can be dropped
+        self.generation = 0
+        self.missed_arrivals = 0
+        self.__random = random.Random(seed)
+        self.__next_arrival: float | None = None
+
+    def set_rate(self, rate: float):
+        """
+        Set the target rate (requests per second)
+        """
+        if rate != self.rate:
+            self.rate = rate
+            self.generation += 1
+            # restart the schedule from the next claim so that the new rate applies immediately
+            self.__next_arrival = None
+
+    def claim_arrival(self, now: float, max_lag: float) -> float | None:
+        """
+        Claim the next arrival time
+
+        Arrivals more than max_lag seconds in the past are skipped (and counted in
+        missed_arrivals) - this happens when there aren't enough users to keep up
+
+        Returns:
+            The arrival time (time.monotonic() based) or None if the rate is zero
+        """
+        if self.rate <= 0:
+            return None
+        if self.__next_arrival is None:
+            self.__next_arrival = now + self.__get_interval()
+        while self.__next_arrival < now - max_lag:
+            self.missed_arrivals += 1
+            self.__next_arrival += self.__get_interval()
+        arrival = self.__next_arrival
+        self.__next_arrival += self.__get_interval()
+        return arrival
+
+    def __get_interval(self) -> float:
+        if self.process == "poisson":
+            return self.__random.expovariate(self.rate)
+        return 1 / self.rate
+
+
+arrival_schedules: dict[str, ArrivalSchedule] = {}
+
+
+def get_arrival_schedule(stream: str) -> ArrivalSchedule:
+    """
+    Get the (per-process) arrival schedule for a stream of requests, e.g. "high"/"low" priority
+    """
+    schedule = arrival_schedules.get(stream)
+    if schedule is None:
+        schedule = ArrivalSchedule(arrival_process)
+        arrival_schedules[stream] = schedule
+    return schedule
+
+
+def set_arrival_rates(rates: dict[str, float]):
+    """
+    Set the target rates (requests per second) for this process, keyed by stream.
+    Streams that aren't in rates are stopped (rate 0).
+    """
+    for stream, schedule in arrival_schedules.items():
+        if stream not in rates:
+            schedule.set_rate(0)
+    for stream, rate in rates.items():
+        get_arrival_schedule(stream).set_rate(rate)
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    if is_worker(environment):
+
+        def on_arrival_rates(environment, msg, **kwargs):
+            set_arrival_rates(msg.data)
+
+        environment.runner.register_message(ARRIVAL_RATES_MESSAGE, on_arrival_rates)
+
+
+class ArrivalRateUser(LoadTestUser):
+    """
+    Base class for users that send requests for an arrival stream.
+
+    Rather than waiting a fixed time between requests, each user waits for the next
+    arrival in its stream, so the request rate is set by the ArrivalRateShape. The
+    users are a pool to send the requests with: a user that is waiting on a slow
+    response doesn't reduce the rate as long as there are other idle users.
+    """
+
+    abstract = True
+
+    arrival_stream: str = None
+    # arrivals that no user could send within this many seconds are skipped
+    max_lag: float = 1
+    # how often a waiting user checks for a rate change
+    rate_check_interval: float = 1
+
+    def on_start(self):
+        # wait for an arrival before the first task (rather than sending on spawn)
+        self.wait_time()
+
+    def wait_time(self) -> float:
+        # the waiting is done here rather than by returning the delay so that an arrival
+        # claimed at the previous rate can be dropped when the rate changes (otherwise the
+        # idle users would send the old rate's arrivals on top of the new rate)
+        schedule = get_arrival_schedule(self.arrival_stream)
+        while True:
+            generation = schedule.generation
+            arrival = schedule.claim_arrival(time.monotonic(), self.max_lag)
+            if arrival is None:
+                # no requests for this stream in the current stage
+                gevent.sleep(self.rate_check_interval)
+                continue
+            while schedule.generation == generation:
+                delay = arrival - time.monotonic()
+                if delay <= 0:
+                    return 0
+                gevent.sleep(min(delay, self.rate_check_interval))
+
+
+def get_stage_rates(
+    stage: dict, tokens_per_request: dict[str, float]
+) -> dict[str, float]:
+    """
+    Get the target rates (requests per second) for a stage, keyed by stream
+
+    Stages specify the rates in one of "rps", "rpm" or "tpm" (requests per second,
+    requests per minute or tokens per minute) as a dict keyed by stream.
+    "tpm" rates are converted using tokens_per_request for the stream.
+    """
+    if "rps" in stage:
+        return dict(stage["rps"])
+    if "rpm" in stage:
+        return {stream: rate / 60 for stream, rate in stage["rpm"].items()}
+    if "tpm" in stage:
+        return {
+            stream: rate / 60 / tokens_per_request[stream]
+            for stream, rate in stage["tpm"].items()
+        }
+    raise ValueError(f"Stage has no rps, rpm or tpm rates: {stage}")
+
+
+class ArrivalRateShape(LoadTestShape):
+    """
+    LoadTestShape that drives open-loop load from stages of arrival rates, e.g.
+
+        stages = [
+            {"duration": 120, "rpm": {"high": 600, "low": 300}},
+            {"duration": 240, "tpm": {"high": 60000, "low": 0}},
+        ]
+
+    As with the user based stages, "duration" is the run time at which the stage ends.
+
+    The users for every stream are kept running for the whole test (users for a stream with
+    no arrivals are idle) so changing rates doesn't require re-spawning users. The number of
+    users is the stage's "users" value if set, otherwise enough for target_latency seconds
+    of requests for the busiest stream.
+
+    In distributed runs the rates are split evenly between the workers.
+    """
+
+    abstract = True
+
+    stages: list[dict] = []
+    # user class (ArrivalRateUser) for each stream
+    stream_user_classes: dict[str, type[ArrivalRateUser]] = {}
+    # estimated tokens per request for each stream (required for "tpm" rates)
+    tokens_per_request: dict[str, float] = {}
+    # expected maximum response time, used to size the user pool
+    target_latency: float = 10
+
+    def __init__(self):
+        super().__init__()
+        self.__published_rates = None
+
+    def tick(self):
+        run_time = self.get_run_time()
+
+        for stage in self.stages:
+            if run_time < stage["duration"]:
+                # streams that the stage doesn't list have no arrivals
+                rates = {
+                    stream: 0 for stream in self.stream_user_classes
+                } | get_stage_rates(stage, self.tokens_per_request)
+                self.__publish_rates(rates)
+                users = stage.get("users") or self.get_user_count(rates)
+                return (
+                    users,
+                    stage.get("spawn_rate", users),
+                    list(self.stream_user_classes.values()),
+                )
+
+        return None
+
+    def get_user_count(self, rates: dict[str, float]) -> int:
+        """
+        Get the number of users needed for the rates.
+        Users are split evenly between the stream user classes, so each stream gets
+        enough users for the busiest stream.
+        """
+        max_rate = max(rates.values(), default=0)
+        users_per_stream = max(1, math.ceil(max_rate * self.target_latency))
+        return users_per_stream * len(self.stream_user_classes)
+
+    def __publish_rates(self, rates: dict[str, float]):
+        if isinstance(self.runner, MasterRunner):
+            worker_count = max(1, self.runner.worker_count)
+            worker_rates = {
+                stream: rate / worker_count for stream, rate in rates.items()
+            }
+            # re-send when the worker count changes so that late workers get the rates
+            if (worker_rates, worker_count) != self.__published_rates:
+                logging.info("⚙️ Setting arrival rates (per worker): %s", worker_rates)
+                self.runner.send_message(ARRIVAL_RATES_MESSAGE, worker_rates)
+                self.__published_rates = (worker_rates, worker_count)
+        elif rates != self.__published_rates:
+            logging.info("⚙️ Setting arrival rates: %s", rates)
+            set_arrival_rates(rates)
+            self.__published_rates = rates
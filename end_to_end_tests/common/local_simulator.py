@@ -0,0 +1,493 @@
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import uuid
+
+from .simulator_config import load_deployment_config
+from .token_estimation import TokenEstimator, get_token_estimator
+
+# Default latencies (milliseconds per generated token, or per request for embeddings)
+DEFAULT_LATENCIES = {
+    "open_ai_completions": 15,
+    "open_ai_chat_completions": 19,
+    "open_ai_embeddings": 100,
+}
+
+EMBEDDING_SIZE = 1536
+
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    429: "Too Many Requests",
+}
+
+_generated_words = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously up to its capacity
+    """
+
+    def __init__(self, capacity: float, period_seconds: float):
+        self.capacity = capacity
+        self.rate = capacity / period_seconds
+        self.available = capacity
+        self.updated = time.monotonic()
+
+    def try_consume(self, amount: float) -> float:
+        """
+        Consume from the bucket if there is enough available
+
+        Returns:
+            0 if consumed, otherwise the number of seconds until there will be enough available
+        """
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        if amount <= self.available:
+            self.available -= amount
+            return 0
+        if amount > self.capacity:
+            # can never be satisfied - report a full refill period
+            return self.capacity / self.rate
+        return (amount - self.available) / self.rate
+
+
+class _Deployment:
+    def __init__(self, name: str, model: str, tokens_per_minute: int):
+        self.name = name
+        self.model = model
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens = TokenBucket(tokens_per_minute, 60)
+        # Azure OpenAI allows 6 requests per minute per 1000 TPM (enforced over 10s windows)
+        self.requests = TokenBucket(max(1, tokens_per_minute / 1000), 10)
+
+
+class _HttpError(Exception):
+    def __init__(self, status: int, message: str, headers: dict | None = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class LocalSimulator:
+    """
+    An in-process stand-in for the OpenAI API simulator, for running scenarios
+    without the deployed simulators.
+
+    Serves completions, chat completions (including streaming) and embeddings for the
+    deployments in simulator_deployment_config.json, enforces the tokensPerMinute limits
+    and supports the /++/config endpoint for changing latencies and deployments.
+    Everything runs on a single asyncio event loop so that it can hold thousands of
+    concurrent connections.
+    """
+
+    def __init__(
+        self,
+        deployments: dict | None = None,
+        api_key: str | None = None,
+        latencies: dict | None = None,
+        token_estimator: TokenEstimator | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            deployments (dict): Deployments in the simulator_deployment_config.json format
+                                (defaults to the contents of that file)
+            api_key (str): API key that requests must send in the api-key header (None to allow all)
+            latencies (dict): Latencies in milliseconds keyed by operation (see DEFAULT_LATENCIES)
+            token_estimator (TokenEstimator): Used to count prompt tokens (defaults to the shared estimator)
+        """
+        if deployments is None:
+            deployments = load_deployment_config()
+        self.api_key = api_key
+        self.token_estimator = token_estimator or get_token_estimator()
+        self.latencies = dict(DEFAULT_LATENCIES)
+        if latencies:
+            self.latencies.update(latencies)
+        self.deployments: dict[str, _Deployment] = {}
+        for name, deployment in deployments.items():
+            self.deployments[name] = _Deployment(
+                name, deployment["model"], deployment["tokensPerMinute"]
+            )
+        # the embedding vector is the same for every request, so serialise it once
+        self.__embedding_json = json.dumps(
+            [round(random.uniform(-1, 1), 6) for _ in range(EMBEDDING_SIZE)]
+        )
+        self.__server: asyncio.Server | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000) -> int:
+        """
+        Start listening for requests
+
+        Returns:
+            The port the simulator is listening on (useful when port is 0)
+        """
+        self.__server = await asyncio.start_server(
+            self.__handle_connection, host, port, backlog=4096
+        )
+        return self.__server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    async def serve_forever(self, host: str = "127.0.0.1", port: int = 8000):
+        port = await self.start(host, port)
+        logging.info("Local simulator listening on http://%s:%s", host, port)
+        async with self.__server:
+            await self.__server.serve_forever()
+
+    async def __handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.split(" ", 2)
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError(f"Invalid content-length: {content_length}")
+                except ValueError as e:
+                    # the rest of the request can't be framed, so close the connection
+                    await self.__write_json(
+                        writer,
+                        400,
+                        {"error": {"message": f"Malformed request: {e}"}},
+                        {"connection": "close"},
+                    )
+                    return
+                body = b""
+                if content_length:
+                    body = await reader.readexactly(content_length)
+
+                keep_alive = headers.get("connection", "").lower() != "close" and (
+                    version == "HTTP/1.1"
+                    or headers.get("connection", "").lower() == "keep-alive"
+                )
+                await self.__handle_request(method, target, headers, body, writer)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def __handle_request(
+        self,
+        method: str,
+        target: str,
+        headers: dict,
+        body: bytes,
+        writer: asyncio.StreamWriter,
+    ):
+        path = target.split("?", 1)[0]
+        try:
+            if self.api_key and headers.get("api-key") != self.api_key:
+                raise _HttpError(401, "Missing or invalid api-key header")
+
+            if path == "/++/config":
+                if method == "GET":
+                    await self.__write_json(writer, 200, self.get_config())
+                elif method == "PATCH":
+                    self.update_config(self.__parse_json_object(body))
+                    await self.__write_json(writer, 200, self.get_config())
+                else:
+                    raise _HttpError(405, "Method not allowed")
+                return
+
+            # /openai/deployments/{deployment}/{operation}
+            parts = path.strip("/").split("/")
+            if len(parts) < 4 or parts[0] != "openai" or parts[1] != "deployments":
+                raise _HttpError(404, "Not found")
+            if method != "POST":
+                raise _HttpError(405, "Method not allowed")
+            deployment = self.deployments.get(parts[2])
+            if deployment is None:
+                raise _HttpError(404, f"Deployment {parts[2]} not found")
+            operation = "/".join(parts[3:])
+            request_body = self.__parse_json_object(body)
+
+            if operation == "embeddings":
+                await self.__handle_embeddings(deployment, request_body, writer)
+            elif operation in ("completions", "chat/completions"):
+                await self.__handle_completions(
+                    deployment, operation == "chat/completions", request_body, writer
+                )
+            else:
+                raise _HttpError(404, f"Operation {operation} not supported")
+        except _HttpError as e:
+            await self.__write_json(
+                writer, e.status, {"error": {"message": str(e)}}, e.headers
+            )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # json.JSONDecodeError is a ValueError
+            await self.__write_json(writer, 400, {"error": {"message": str(e)}})
+
+    @staticmethod
+    def __parse_json_object(body: bytes) -> dict:
+        """
+        Parse a JSON request body, which must be an object (an empty body is treated as {})
+        """
+        value = json.loads(body or b"{}")
+        if not isinstance(value, dict):
+            raise _HttpError(400, "The request body must be a JSON object")
+        return value
+
+    def get_config(self) -> dict:
+        return {
+            "latency": {
+                operation: {"mean": latency}
+                for operation, latency in self.latencies.items()
+            },
+            "openai_deployments": {
+                name: {
+                    "name": name,
+                    "model": deployment.model,
+                    "tokens_per_minute": deployment.tokens_per_minute,
+                }
+                for name, deployment in self.deployments.items()
+            },
+        }
+
+    def update_config(self, config: dict):
+        """
+        Apply a /++/config PATCH body (same format as the deployed simulator)
+        """
+        for operation, latency in config.get("latency", {}).items():
+            if operation not in self.latencies:
+                raise ValueError(f"Unknown latency setting: {operation}")
+            self.latencies[operation] = latency["mean"]
+        for name, deployment in config.get("openai_deployments", {}).items():
+            self.deployments[name] = _Deployment(
+                name, deployment["model"], deployment["tokens_per_minute"]
+            )
+
+    def __check_limits(self, deployment: _Deployment, tokens: int) -> dict:
+        retry_after = deployment.requests.try_consume(1)
+        if retry_after == 0:
+            retry_after = deployment.tokens.try_consume(tokens)
+            if retry_after > 0:
+                # give back the request so that only admitted requests count
+                deployment.requests.available += 1
+        if retry_after > 0:
+            raise _HttpError(
+                429,
+                "Requests to the deployment have exceeded the rate limit",
+                {
+                    "retry-after": str(math.ceil(retry_after)),
+                    "retry-after-ms": str(math.ceil(retry_after * 1000)),
+                },
+            )
+        return {
+            "x-ratelimit-remaining-tokens": str(int(deployment.tokens.available)),
+            "x-ratelimit-remaining-requests": str(int(deployment.requests.available)),
+        }
+
+    async def __handle_embeddings(
+        self, deployment: _Deployment, request_body: dict, writer: asyncio.StreamWriter
+    ):
+        inputs = request_body["input"]
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        prompt_tokens = max(1, self.token_estimator.count_prompt_tokens(request_body))
+        headers = self.__check_limits(deployment, prompt_tokens)
+
+        await asyncio.sleep(self.latencies["open_ai_embeddings"] / 1000)
+        data = ",".join(
+            f'{{"object":"embedding","index":{index},"embedding":{self.__embedding_json}}}'
+            for index in range(len(inputs))
+        )
+        usage = json.dumps(
+            {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+        )
+        body = (
+            f'{{"object":"list","data":[{data}],"model":"{deployment.model}",'
+            f'"usage":{usage}}}'
+        )
+        await self.__write_response(
+            writer, 200, body.encode("utf-8"), "application/json", headers
+        )
+
+    async def __handle_completions(
+        self,
+        deployment: _Deployment,
+        is_chat: bool,
+        request_body: dict,
+        writer: asyncio.StreamWriter,
+    ):
+        prompt_tokens = max(1, self.token_estimator.count_prompt_tokens(request_body))
+        max_tokens = request_body.get("max_tokens") or 16
+        completion_tokens = max(1, int(max_tokens))
+        headers = self.__check_limits(deployment, prompt_tokens + completion_tokens)
+
+        latency_key = "open_ai_chat_completions" if is_chat else "open_ai_completions"
+        token_latency = self.latencies[latency_key] / 1000
+        response_id = ("chatcmpl-" if is_chat else "cmpl-") + uuid.uuid4().hex
+        created = int(time.time())
+        words = [
+            " " + _generated_words[i % len(_generated_words)]
+            for i in range(completion_tokens)
+        ]
+
+        if request_body.get("stream"):
+            await self.__stream_completion(
+                writer,
+                is_chat,
+                deployment,
+                response_id,
+                created,
+                words,
+                token_latency,
+                headers,
+            )
+            return
+
+        await asyncio.sleep(token_latency * completion_tokens)
+        text = "".join(words)
+        if is_chat:
+            choice = {
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "length",
+            }
+        else:
+            choice = {
+                "index": 0,
+                "text": text,
+                "logprobs": None,
+                "finish_reason": "length",
+            }
+        response = {
+            "id": response_id,
+            "object": "chat.completion" if is_chat else "text_completion",
+            "created": created,
+            "model": deployment.model,
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+        await self.__write_json(writer, 200, response, headers)
+
+    async def __stream_completion(
+        self,
+        writer: asyncio.StreamWriter,
+        is_chat: bool,
+        deployment: _Deployment,
+        response_id: str,
+        created: int,
+        words: list[str],
+        token_latency: float,
+        headers: dict,
+    ):
+        writer.write(
+            self.__build_head(
+                200,
+                "text/event-stream",
+                {**headers, "transfer-encoding": "chunked"},
+            )
+        )
+
+        def chunk(content: str | None, finish_reason: str | None) -> bytes:
+            if is_chat:
+                choice = {
+                    "index": 0,
+                    "delta": {"content": content} if content is not None else {},
+                    "finish_reason": finish_reason,
+                }
+            else:
+                choice = {
+                    "index": 0,
+                    "text": content or "",
+                    "finish_reason": finish_reason,
+                }
+            event = {
+                "id": response_id,
+                "object": "chat.completion.chunk" if is_chat else "text_completion",
+                "created": created,
+                "model": deployment.model,
+                "choices": [choice],
+            }
+            data = f"data: {json.dumps(event)}\n\n".encode("utf-8")
+            return b"%x\r\n%s\r\n" % (len(data), data)
+
+        for word in words:
+            await asyncio.sleep(token_latency)
+            writer.write(chunk(word, None))
+            await writer.drain()
+        writer.write(chunk(None, "length"))
+        done = b"data: [DONE]\n\n"
+        writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(done), done))
+        await writer.drain()
+
+    def __build_head(
+        self, status: int, content_type: str, headers: dict | None = None
+    ) -> bytes:
+        lines = [
+            f"HTTP/1.1 {status} {STATUS_REASONS.get(status, 'Unknown')}",
+            f"content-type: {content_type}",
+        ]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def __write_response(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: bytes,
+        content_type: str,
+        headers: dict | None = None,
+    ):
+        writer.write(
+            self.__build_head(
+                status,
+                content_type,
+                {**(headers or {}), "content-length": str(len(body))},
+            )
+            + body
+        )
+        await writer.drain()
+
+    async def __write_json(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: dict,
+        headers: dict | None = None,
+    ):
+        await self.__write_response(
+            writer,
+            status,
+            json.dumps(body).encode("utf-8"),
+            "application/json",
+            headers,
+        )
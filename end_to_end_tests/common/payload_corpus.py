@@ -0,0 +1,102 @@
+import itertools
+import json
+import random
+from collections.abc import Callable
+from typing import NamedTuple
+
+from .token_estimation import TokenEstimator, get_token_estimator
+
+# Content-Type header to send with PreparedPayload.body (as client.post(data=...) doesn't set it)
+JSON_CONTENT_TYPE = "application/json"
+
+
+class PreparedPayload(NamedTuple):
+    """
+    A request body serialized ahead of time
+    """
+
+    body: bytes
+    max_tokens: int | None
+    estimated_tokens: int
+
+
+class PayloadCorpus:
+    """
+    A weighted mix of request bodies that are serialized once up front.
+
+    The mix is expanded into a shuffled schedule when the corpus is created, so
+    next_payload() just steps through the schedule - there is no per-request
+    serialization or allocation in the Locust tasks.
+    """
+
+    def __init__(
+        self,
+        payloads: list[tuple[dict, float]],
+        schedule_size: int = 1000,
+        seed: int | None = 0,
+        token_estimator: TokenEstimator | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            payloads (list[tuple[dict, float]]): Request bodies and their relative weights
+            schedule_size (int): Approximate number of entries in the schedule (more gives a closer match to the weights)
+            seed (int): Seed for shuffling the schedule (None for a different order each run)
+            token_estimator (TokenEstimator): Used to estimate the tokens for each body (defaults to the shared estimator)
+        """
+        if len(payloads) == 0:
+            raise ValueError("At least one payload is required")
+        total_weight = sum(weight for _, weight in payloads)
+        if total_weight <= 0:
+            raise ValueError("Payload weights must sum to more than zero")
+
+        token_estimator = token_estimator or get_token_estimator()
+        self.payloads: list[tuple[PreparedPayload, float]] = []
+        schedule = []
+        for body, weight in payloads:
+            if weight < 0:
+                raise ValueError("Payload weights must not be negative")
+            payload = PreparedPayload(
+                body=json.dumps(body, separators=(",", ":")).encode("utf-8"),
+                max_tokens=body.get("max_tokens"),
+                estimated_tokens=token_estimator.estimate_request_tokens(body),
+            )
+            self.payloads.append((payload, weight))
+            if weight > 0:
+                count = max(1, round(schedule_size * weight / total_weight))
+                schedule.extend([payload] * count)
+
+        random.Random(seed).shuffle(schedule)
+        self.schedule = schedule
+        self.__cycle = itertools.cycle(schedule)
+
+    @classmethod
+    def from_mix(
+        cls,
+        make_body: Callable[[str, int | None], dict],
+        prompts: list[tuple[str, float]],
+        max_tokens: list[tuple[int | None, float]],
+        **kwargs,
+    ) -> "PayloadCorpus":
+        """
+        Create a corpus from every combination of prompt and max_tokens value
+
+        :param make_body: Builds the request body for a prompt and max_tokens value (None to omit max_tokens)
+        :param prompts: Prompts and their relative weights
+        :param max_tokens: max_tokens values and their relative weights
+        :param kwargs: Passed to the constructor
+        """
+        payloads = [
+            (make_body(prompt, max_tokens_value), prompt_weight * max_tokens_weight)
+            for (prompt, prompt_weight), (max_tokens_value, max_tokens_weight) in (
+                itertools.product(prompts, max_tokens)
+            )
+        ]
+        return cls(payloads, **kwargs)
+
+    def next_payload(self) -> PreparedPayload:
+        """
+        Get the next payload in the schedule
+        """
+        return next(self.__cycle)
@@ -0,0 +1,594 @@
+import heapq
+import math
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field, replace
+from typing import NamedTuple
+
+from .token_estimation import TokenEstimator, get_token_estimator
+
+#
+# Python reference implementation of capabilities/prioritization/prioritization-token-calculating.xml
+# for tuning the limits and low-priority thresholds offline
+#
+
+REASON_DEPLOYMENT_NOT_FOUND = "deployment-not-found"
+REASON_TOKENS_LIMIT = "tokens-limit"
+REASON_REQUESTS_LIMIT = "requests-limit"
+REASON_TOKENS_BELOW_LOW_PRIORITY_THRESHOLD = "tokens-below-low-priority-threshold"
+REASON_REQUESTS_BELOW_LOW_PRIORITY_THRESHOLD = "requests-below-low-priority-threshold"
+
+DEFAULT_MAX_TOKENS = 16
+
+# "policy" uses the policy's consumed-tokens expression, "tokenizer" counts the prompt tokens
+TOKEN_ESTIMATES = ["policy", "tokenizer"]
+
+
+@dataclass(frozen=True)
+class DeploymentLimits:
+    """
+    An entry in the policy's list-deployments table
+    """
+
+    deployment_id: str
+    tpm_limit: int
+    low_priority_tpm_threshold: int
+    rp10s_limit: int
+    low_priority_rp10s_threshold: int
+
+
+# The list-deployments table from prioritization-token-calculating.xml
+default_deployments = [
+    DeploymentLimits("embedding", 10000, 3000, 10, 3),
+    DeploymentLimits("embedding100k", 100000, 30000, 100, 30),
+    DeploymentLimits("gpt-35-turbo-10k-token", 10000, 3000, 10, 3),
+    DeploymentLimits("gpt-35-turbo-100k-token", 100000, 30000, 100, 30),
+]
+
+
+def estimate_consumed_tokens(request_body: dict, operation_id: str) -> int:
+    """
+    Estimate the tokens a request will consume, as the policy's consumed-tokens variable does
+
+    :param request_body: The request body
+    :param operation_id: The APIM operation id (e.g. "embeddings_create", "ChatCompletions_Create")
+    """
+    if operation_id == "embeddings_create" or request_body.get("model") == "embedding":
+        return math.ceil(len(request_body["input"]) * 0.25)
+    if "max_tokens" in request_body and "best_of" in request_body:
+        return request_body["max_tokens"] * request_body["best_of"]
+    if "max_tokens" in request_body:
+        return request_body["max_tokens"]
+    return DEFAULT_MAX_TOKENS
+
+
+def get_consumed_tokens(
+    request_body: dict,
+    operation_id: str,
+    token_estimate: str = "policy",
+    estimator: TokenEstimator | None = None,
+) -> int:
+    """
+    Get the consumed tokens for a request using one of the TOKEN_ESTIMATES
+
+    :param request_body: The request body
+    :param operation_id: The APIM operation id
+    :param token_estimate: "policy" to match the current policy expression or "tokenizer" to
+                           count the prompt tokens plus the requested completion tokens
+    :param estimator: The TokenEstimator to use for "tokenizer" (defaults to the shared estimator)
+    """
+    if token_estimate == "policy":
+        return estimate_consumed_tokens(request_body, operation_id)
+    if token_estimate == "tokenizer":
+        return (estimator or get_token_estimator()).estimate_request_tokens(
+            request_body
+        )
+    raise ValueError(f"Unhandled token estimate: {token_estimate}")
+
+
+class SlidingWindowCounter:
+    """
+    Counter for a rate-limit-by-key key: the total over a sliding window of
+    renewal_period seconds, tracked in buckets of resolution seconds
+    """
+
+    __slots__ = (
+        "calls",
+        "renewal_period",
+        "resolution",
+        "__buckets",
+        "__bucket_count",
+        "__current",
+        "__total",
+    )
+
+    def __init__(self, calls: int, renewal_period: float, resolution: float = 1):
+        self.calls = calls
+        self.renewal_period = renewal_period
+        self.resolution = resolution
+        self.__bucket_count = max(1, math.ceil(renewal_period / resolution))
+        self.__buckets = [0] * self.__bucket_count
+        self.__current = None
+        self.__total = 0
+
+    def __advance(self, now: float):
+        bucket = int(now // self.resolution)
+        current = self.__current
+        if current is None or bucket - current >= self.__bucket_count:
+            if self.__total:
+                self.__buckets = [0] * self.__bucket_count
+                self.__total = 0
+            self.__current = bucket
+            return
+        if bucket <= current:
+            return
+        buckets = self.__buckets
+        count = self.__bucket_count
+        for expired in range(current + 1, bucket + 1):
+            index = expired % count
+            self.__total -= buckets[index]
+            buckets[index] = 0
+        self.__current = bucket
+
+    def remaining(self, now: float) -> int:
+        """
+        Get the number of calls remaining in the window
+        """
+        self.__advance(now)
+        return self.calls - self.__total
+
+    def increment(self, now: float, amount: int = 1):
+        self.__advance(now)
+        self.__buckets[self.__current % self.__bucket_count] += amount
+        self.__total += amount
+
+    def retry_after(self, now: float, amount: int = 1) -> float:
+        """
+        Get the number of seconds until amount calls would be allowed
+        """
+        self.__advance(now)
+        excess = self.__total + amount - self.calls
+        if excess <= 0:
+            return 0
+        if amount > self.calls:
+            return self.renewal_period
+        # walk the buckets from the oldest until enough calls have expired
+        offset_in_bucket = now - self.__current * self.resolution
+        for age in range(self.__bucket_count):
+            bucket = self.__current + 1 + age
+            excess -= self.__buckets[bucket % self.__bucket_count]
+            if excess <= 0:
+                return (age + 1) * self.resolution - offset_in_bucket
+        return self.renewal_period
+
+
+class CounterStore:
+    """
+    In-memory store of rate-limit-by-key counters, keyed by counter-key
+    """
+
+    def __init__(self, resolution: float = 1):
+        self.resolution = resolution
+        self.__counters: dict[str, SlidingWindowCounter] = {}
+
+    def get(self, key: str, calls: int, renewal_period: float) -> SlidingWindowCounter:
+        counter = self.__counters.get(key)
+        if counter is None:
+            counter = SlidingWindowCounter(calls, renewal_period, self.resolution)
+            self.__counters[key] = counter
+        return counter
+
+    def clear(self):
+        self.__counters.clear()
+
+
+class PolicyDecision(NamedTuple):
+    """
+    The outcome of a request passing through the policy
+
+    status_code is the status returned to the client: the policy's 404/429 if it
+    rejected the request, otherwise the backend status
+    """
+
+    status_code: int
+    reason: str | None
+    remaining_tokens: int
+    remaining_requests: int
+    retry_after: float = 0
+
+
+class _DeploymentCounters:
+    __slots__ = ("limits", "tokens", "requests")
+
+    def __init__(self, limits: DeploymentLimits, counters: CounterStore):
+        self.limits = limits
+        self.tokens = counters.get(
+            f"{limits.deployment_id}|tokens-limit", limits.tpm_limit, 60
+        )
+        self.requests = counters.get(
+            f"{limits.deployment_id}|requests-limit", limits.rp10s_limit, 10
+        )
+
+
+class PrioritizationPolicy:
+    """
+    Applies the prioritization-token-calculating policy to requests:
+
+    - the tokens (per 60s) and requests (per 10s) rate-limit-by-key counters for the deployment,
+      which are only incremented when the response isn't a 429
+    - rejection of low-priority requests when the remaining tokens/requests are below the
+      deployment's low-priority thresholds
+
+    Time is passed in explicitly (seconds) so that synthetic traffic can be replayed
+    faster than real time.
+    """
+
+    def __init__(
+        self,
+        deployments: list[DeploymentLimits] | None = None,
+        counters: CounterStore | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            deployments (list[DeploymentLimits]): The list-deployments table (defaults to the policy's table)
+            counters (CounterStore): Store for the rate-limit-by-key counters
+        """
+        self.counters = counters or CounterStore()
+        self.__deployments = {
+            limits.deployment_id: _DeploymentCounters(limits, self.counters)
+            for limits in (
+                deployments if deployments is not None else default_deployments
+            )
+        }
+
+    def evaluate(
+        self,
+        now: float,
+        deployment_id: str,
+        consumed_tokens: int,
+        low_priority: bool,
+        backend_status_code: int = 200,
+        include_retry_after: bool = True,
+    ) -> PolicyDecision:
+        """
+        Pass a request through the policy
+
+        :param now: The request time in seconds
+        :param deployment_id: The deployment-id from the request URL
+        :param consumed_tokens: The consumed-tokens estimate (see estimate_consumed_tokens)
+        :param low_priority: Whether the request is low priority (priority=low or x-priority: low)
+        :param backend_status_code: The status the backend returns if the request is forwarded
+        :param include_retry_after: Calculate the retry-after for rate-limited requests
+                                    (skipped when replaying as it isn't needed for the summary)
+        """
+        deployment = self.__deployments.get(deployment_id)
+        if deployment is None:
+            return PolicyDecision(404, REASON_DEPLOYMENT_NOT_FOUND, 0, 0)
+
+        tokens = deployment.tokens
+        requests = deployment.requests
+        remaining_tokens = tokens.remaining(now)
+        remaining_requests = requests.remaining(now)
+
+        if consumed_tokens > remaining_tokens:
+            return PolicyDecision(
+                429,
+                REASON_TOKENS_LIMIT,
+                remaining_tokens,
+                remaining_requests,
+                tokens.retry_after(now, consumed_tokens) if include_retry_after else 0,
+            )
+        if remaining_requests < 1:
+            return PolicyDecision(
+                429,
+                REASON_REQUESTS_LIMIT,
+                remaining_tokens,
+                remaining_requests,
+                requests.retry_after(now) if include_retry_after else 0,
+            )
+
+        if low_priority:
+            limits = deployment.limits
+            if remaining_tokens < limits.low_priority_tpm_threshold:
+                return PolicyDecision(
+                    429,
+                    REASON_TOKENS_BELOW_LOW_PRIORITY_THRESHOLD,
+                    remaining_tokens,
+                    remaining_requests,
+                )
+            if remaining_requests < limits.low_priority_rp10s_threshold:
+                return PolicyDecision(
+                    429,
+                    REASON_REQUESTS_BELOW_LOW_PRIORITY_THRESHOLD,
+                    remaining_tokens,
+                    remaining_requests,
+                )
+
+        if backend_status_code != 429:
+            tokens.increment(now, consumed_tokens)
+            requests.increment(now)
+        return PolicyDecision(
+            backend_status_code, None, remaining_tokens, remaining_requests
+        )
+
+
+class SyntheticRequest(NamedTuple):
+    timestamp: float
+    deployment_id: str
+    consumed_tokens: int
+    low_priority: bool
+
+
+@dataclass
+class ReplaySummary:
+    """
+    Request counts from a replay, keyed by priority ("high"/"low")
+    """
+
+    requests: dict[str, int] = field(default_factory=lambda: {"high": 0, "low": 0})
+    accepted: dict[str, int] = field(default_factory=lambda: {"high": 0, "low": 0})
+    accepted_tokens: dict[str, int] = field(
+        default_factory=lambda: {"high": 0, "low": 0}
+    )
+    rejections: dict[tuple[str, str], int] = field(default_factory=dict)
+    duration: float = 0
+
+    def get_rows(self) -> list[list]:
+        """
+        Get a row per priority: priority, requests, accepted, accepted %, accepted TPM
+        """
+        rows = []
+        minutes = self.duration / 60 if self.duration > 0 else 1
+        for priority in ["high", "low"]:
+            requests = self.requests[priority]
+            accepted = self.accepted[priority]
+            rows.append(
+                [
+                    priority,
+                    requests,
+                    accepted,
+                    round(100 * accepted / requests, 1) if requests else 0,
+                    round(self.accepted_tokens[priority] / minutes),
+                ]
+            )
+        return rows
+
+
+def replay(
+    policy: PrioritizationPolicy, requests: Iterable[SyntheticRequest]
+) -> ReplaySummary:
+    """
+    Pass a stream of requests (ordered by timestamp) through the policy
+    """
+    summary = ReplaySummary()
+    evaluate = policy.evaluate
+    first_timestamp = None
+    timestamp = 0
+    for timestamp, deployment_id, consumed_tokens, low_priority in requests:
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        priority = "low" if low_priority else "high"
+        summary.requests[priority] += 1
+        decision = evaluate(
+            timestamp, deployment_id, consumed_tokens, low_priority, 200, False
+        )
+        if decision.reason is None:
+            summary.accepted[priority] += 1
+            summary.accepted_tokens[priority] += consumed_tokens
+        else:
+            key = (priority, decision.reason)
+            summary.rejections[key] = summary.rejections.get(key, 0) + 1
+    if first_timestamp is not None:
+        summary.duration = timestamp - first_timestamp
+    return summary
+
+
+class RequestStream(NamedTuple):
+    """
+    Requests with the same consumed tokens and priority within a RequestBatch
+    """
+
+    consumed_tokens: int
+    low_priority: bool
+    timestamps: list[float]  # in order
+
+
+class RequestBatch(NamedTuple):
+    """
+    The requests to a deployment within one counter bucket (see CounterStore.resolution).
+    Requests from different streams with the same timestamp arrive in stream order.
+    """
+
+    deployment_id: str
+    streams: list[RequestStream]
+
+
+def replay_batches(
+    policy: PrioritizationPolicy, batches: Iterable[RequestBatch]
+) -> ReplaySummary:
+    """
+    Pass batches of requests (ordered by time) through the policy, with the same result
+    as replay() for the same requests
+
+    The counters only change when a request is accepted, and the accepted requests are
+    bounded by the limits, so rather than evaluating each request this evaluates the next
+    request from each stream, accepts the earliest request that would be accepted and counts
+    the requests before it from the other streams as rejected (with their stream's reason)
+    """
+    summary = ReplaySummary()
+    evaluate = policy.evaluate
+    first_timestamp = None
+    last_timestamp = 0
+    for deployment_id, streams in batches:
+        streams = [stream for stream in streams if stream.timestamps]
+        if not streams:
+            continue
+        if first_timestamp is None:
+            first_timestamp = min(stream.timestamps[0] for stream in streams)
+        last_timestamp = max(stream.timestamps[-1] for stream in streams)
+        # the counters only depend on the bucket, so any time in the batch will do
+        now = streams[0].timestamps[0]
+        priorities = ["low" if stream.low_priority else "high" for stream in streams]
+        for stream, priority in zip(streams, priorities):
+            summary.requests[priority] += len(stream.timestamps)
+        positions = [0] * len(streams)
+        while True:
+            # the outcome for the next request from each stream in the current state
+            # (a backend 429 doesn't increment the counters)
+            reasons = []
+            accepted_index = None
+            accepted_time = 0
+            for index, stream in enumerate(streams):
+                if positions[index] == len(stream.timestamps):
+                    reasons.append(None)
+                    continue
+                reason = evaluate(
+                    now,
+                    deployment_id,
+                    stream.consumed_tokens,
+                    stream.low_priority,
+                    429,
+                    False,
+                ).reason
+                reasons.append(reason)
+                timestamp = stream.timestamps[positions[index]]
+                if reason is None and (
+                    accepted_index is None or timestamp < accepted_time
+                ):
+                    accepted_index = index
+                    accepted_time = timestamp
+
+            # the requests before the accepted request are rejected
+            for index, stream in enumerate(streams):
+                if reasons[index] is None:
+                    continue
+                if accepted_index is None:
+                    end = len(stream.timestamps)
+                elif index < accepted_index:
+                    end = bisect_right(
+                        stream.timestamps, accepted_time, positions[index]
+                    )
+                else:
+                    end = bisect_left(
+                        stream.timestamps, accepted_time, positions[index]
+                    )
+                if end > positions[index]:
+                    key = (priorities[index], reasons[index])
+                    summary.rejections[key] = (
+                        summary.rejections.get(key, 0) + end - positions[index]
+                    )
+                    positions[index] = end
+
+            if accepted_index is None:
+                break
+            stream = streams[accepted_index]
+            evaluate(
+                now,
+                deployment_id,
+                stream.consumed_tokens,
+                stream.low_priority,
+                200,
+                False,
+            )
+            summary.accepted[priorities[accepted_index]] += 1
+            summary.accepted_tokens[
+                priorities[accepted_index]
+            ] += stream.consumed_tokens
+            positions[accepted_index] += 1
+    if first_timestamp is not None:
+        summary.duration = last_timestamp - first_timestamp
+    return summary
+
+
+def generate_requests(
+    deployment_id: str,
+    duration: float,
+    high_priority_rps: float,
+    low_priority_rps: float,
+    consumed_tokens: int,
+    start_time: float = 0,
+) -> Iterator[SyntheticRequest]:
+    """
+    Generate evenly spaced high- and low-priority requests, ordered by timestamp
+    """
+
+    def generate(rps: float, low_priority: bool) -> Iterator[SyntheticRequest]:
+        if rps <= 0:
+            return
+        for i in range(int(duration * rps)):
+            yield SyntheticRequest(
+                start_time + i / rps, deployment_id, consumed_tokens, low_priority
+            )
+
+    return heapq.merge(
+        generate(high_priority_rps, False),
+        generate(low_priority_rps, True),
+    )
+
+
+def generate_request_batches(
+    deployment_id: str,
+    duration: float,
+    high_priority_rps: float,
+    low_priority_rps: float,
+    consumed_tokens: int,
+    start_time: float = 0,
+    resolution: float = 1,
+) -> Iterator[RequestBatch]:
+    """
+    Generate the same requests as generate_requests as a RequestBatch per counter bucket
+    (resolution must match the CounterStore's resolution)
+    """
+    rates = [
+        (rps, low_priority, int(duration * rps) if rps > 0 else 0)
+        for rps, low_priority in [(high_priority_rps, False), (low_priority_rps, True)]
+    ]
+    rates = [(rps, low_priority, count) for rps, low_priority, count in rates if count]
+    if not rates:
+        return
+
+    def first_index_at(rps: float, count: int, time: float) -> int:
+        # the first request at or after time (with the same timestamps as generate_requests)
+        index = min(count, max(0, math.ceil((time - start_time) * rps)))
+        while index > 0 and start_time + (index - 1) / rps >= time:
+            index -= 1
+        while index < count and start_time + index / rps < time:
+            index += 1
+        return index
+
+    last_timestamp = max(start_time + (count - 1) / rps for rps, _, count in rates)
+    for bucket in range(
+        int(start_time // resolution), int(last_timestamp // resolution) + 1
+    ):
+        bucket_start = bucket * resolution
+        bucket_end = bucket_start + resolution
+        streams = []
+        for rps, low_priority, count in rates:
+            first = first_index_at(rps, count, bucket_start)
+            end = first_index_at(rps, count, bucket_end)
+            streams.append(
+                RequestStream(
+                    consumed_tokens,
+                    low_priority,
+                    [start_time + index / rps for index in range(first, end)],
+                )
+            )
+        yield RequestBatch(deployment_id, streams)
+
+
+def with_thresholds(
+    limits: DeploymentLimits,
+    low_priority_tpm_threshold: int | None = None,
+    low_priority_rp10s_threshold: int | None = None,
+) -> DeploymentLimits:
+    """
+    Get a copy of a deployment's limits with different low-priority thresholds
+    """
+    changes = {}
+    if low_priority_tpm_threshold is not None:
+        changes["low_priority_tpm_threshold"] = low_priority_tpm_threshold
+    if low_priority_rp10s_threshold is not None:
+        changes["low_priority_rp10s_threshold"] = low_priority_rp10s_threshold
+    return replace(limits, **changes)
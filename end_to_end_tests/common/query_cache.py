@@ -0,0 +1,196 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any
+
+from .table import Table
+
+#
+# Persistent cache of query results, stored as one gzipped JSON file per result:
+#
+#   {"columns": ["TimeGenerated", "request_count"], "types": ["datetime", null],
+#    "column_values": [["2024-06-01T09:00:00+00:00", ...], [12, ...]]}
+#
+# Values are stored a column at a time, and datetime columns are stored as ISO 8601 strings
+# (with "datetime" in "types" so that they are loaded back as datetimes).
+#
+
+RESULT_FILE_EXTENSION = ".json.gz"
+
+DEFAULT_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_SIZE_BYTES = 256 * 1024 * 1024
+
+
+def _get_column_type(values: list[Any]) -> str | None:
+    has_datetimes = False
+    for value in values:
+        if isinstance(value, datetime):
+            has_datetimes = True
+        elif value is not None:
+            return None
+    return "datetime" if has_datetimes else None
+
+
+def _encode_column(values: list[Any], column_type: str | None) -> list[Any]:
+    if column_type == "datetime":
+        return [None if value is None else value.isoformat() for value in values]
+    return values
+
+
+def _decode_column(values: list[Any], column_type: str | None) -> list[Any]:
+    if column_type == "datetime":
+        return [
+            None if value is None else datetime.fromisoformat(value) for value in values
+        ]
+    return values
+
+
+def write_table(path: str, table: Table, metadata: dict | None = None):
+    """
+    Write a table to a gzipped columnar JSON file (written to a temporary file
+    and renamed so that readers never see a partial file)
+
+    :param path: The file to write
+    :param table: The table to write
+    :param metadata: Extra JSON-serializable values to store with the table (e.g. the query)
+    """
+    column_values = [table.get_column(column) for column in table.columns]
+    types = [_get_column_type(values) for values in column_values]
+    data = {
+        **(metadata or {}),
+        "columns": table.columns,
+        "types": types,
+        "column_values": [
+            _encode_column(values, column_type)
+            for values, column_type in zip(column_values, types)
+        ],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_table(path: str) -> Table:
+    """
+    Read a table written with write_table
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    types = data.get("types") or [None] * len(data["columns"])
+    return Table(
+        columns=data["columns"],
+        column_values=[
+            _decode_column(values, column_type)
+            for values, column_type in zip(data["column_values"], types)
+        ],
+    )
+
+
+class DiskResultCache:
+    """
+    Query result cache that keeps the results in a directory (see write_table), so that
+    reports can be re-run or re-rendered without querying the data source again.
+
+    Entries older than max_age_seconds are ignored and removed, and the oldest entries
+    are removed when the total size is over max_size_bytes.
+    Has the same get/put interface as analysis.ResultCache.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+        max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            directory (str): The directory to store the results in
+            max_age_seconds (float): Maximum age of an entry (0 for no limit)
+            max_size_bytes (int): Maximum total size of the entries (0 for no limit)
+        """
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + RESULT_FILE_EXTENSION)
+
+    def get(self, key: str) -> Table | None:
+        path = self.get_path(key)
+        try:
+            if self.__is_expired(os.path.getmtime(path), time.time()):
+                self.misses += 1
+                return None
+            table = read_table(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Ignoring unreadable cached query result %s: %s", path, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return table
+
+    def put(self, key: str, table: Table):
+        try:
+            write_table(self.get_path(key), table)
+        except (OSError, TypeError) as e:
+            # results that can't be stored aren't cached
+            logging.warning("Failed to cache query result: %s", e)
+            return
+        self.remove_expired()
+
+    def remove_expired(self):
+        """
+        Remove entries that are older than max_age_seconds, then the oldest entries
+        until the total size is no more than max_size_bytes
+        """
+        with self.__lock:
+            now = time.time()
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(RESULT_FILE_EXTENSION):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if self.__is_expired(stat.st_mtime, now):
+                    self.__remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            if self.max_size_bytes <= 0:
+                return
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                self.__remove(path)
+                total_size -= size
+
+    def __is_expired(self, mtime: float, now: float) -> bool:
+        return self.max_age_seconds > 0 and now - mtime > self.max_age_seconds
+
+    def __remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,274 @@
+import math
+import threading
+from collections.abc import Iterable
+
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+#
+# Request metrics that are aggregated in-process and exported by the OpenTelemetry
+# metric reader (a background thread that collects the observable instruments at
+# the export interval - see METRICS_EXPORT_INTERVAL).
+#
+# Recording a request is a dictionary lookup and a few additions: the attribute
+# dictionaries are built once per distinct set of attribute values (keyed by a tuple
+# of the values), rather than on every request.
+#
+
+# Latency histogram buckets are log-linear: BUCKETS_PER_DOUBLING buckets between each power
+# of two from LATENCY_MIN_SECONDS up to LATENCY_MAX_SECONDS, so a bucket's value is within
+# ~2% of the recorded values (values outside the range go in the first/last bucket)
+LATENCY_MIN_SECONDS = 0.001
+LATENCY_MAX_SECONDS = 3600
+BUCKETS_PER_DOUBLING = 16
+
+# statistics exported for each set of attributes in the latency histograms
+LATENCY_STATISTICS = {
+    "p50": 0.5,
+    "p90": 0.9,
+    "p99": 0.99,
+}
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket (log-linear) histogram of latencies in seconds
+    """
+
+    def __init__(self, buckets_per_doubling: int = BUCKETS_PER_DOUBLING):
+        """
+        Constructor
+
+        Parameters:
+            buckets_per_doubling (int): Number of buckets between each power of two (more buckets are more precise)
+        """
+        self.buckets_per_doubling = buckets_per_doubling
+        self.__scale = buckets_per_doubling / math.log(2)
+        bucket_count = (
+            math.ceil(
+                math.log(LATENCY_MAX_SECONDS / LATENCY_MIN_SECONDS) * self.__scale
+            )
+            + 1
+        )
+        self.bucket_counts = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def record(self, value: float):
+        if value > LATENCY_MIN_SECONDS:
+            index = min(
+                int(math.log(value / LATENCY_MIN_SECONDS) * self.__scale),
+                len(self.bucket_counts) - 1,
+            )
+        else:
+            index = 0
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def get_bucket_value(self, index: int) -> float:
+        """
+        Get the value that a bucket represents (the midpoint of the bucket)
+        """
+        return LATENCY_MIN_SECONDS * math.exp((index + 0.5) / self.__scale)
+
+    def merge(self, other: "LatencyHistogram"):
+        """
+        Add the values recorded in another histogram (with the same buckets_per_doubling) to this one
+        """
+        if other.buckets_per_doubling != self.buckets_per_doubling:
+            raise ValueError("Cannot merge histograms with different buckets")
+        for index, count in enumerate(other.bucket_counts):
+            if count:
+                self.bucket_counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        """
+        Get the value at a quantile, e.g. 0.99 for p99 (NaN if there are no values)
+        """
+        if self.count == 0:
+            return math.nan
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                # the bucket value is an estimate - keep it within the recorded range
+                return min(max(self.get_bucket_value(index), self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        """
+        Get the histogram as a JSON-serializable dict (with the non-empty buckets only)
+        """
+        return {
+            "buckets_per_doubling": self.buckets_per_doubling,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "buckets": {
+                str(index): count
+                for index, count in enumerate(self.bucket_counts)
+                if count
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        """
+        Create a histogram from a dict created with to_dict
+        """
+        histogram = cls(data["buckets_per_doubling"])
+        for index, count in data["buckets"].items():
+            histogram.bucket_counts[int(index)] = count
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        if data["count"]:
+            histogram.min = data["min"]
+            histogram.max = data["max"]
+        return histogram
+
+
+class AggregatedCounter:
+    """
+    Counter that is summed in-process and exported as an OpenTelemetry ObservableCounter
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attribute_names: list[str],
+        unit: str = "",
+        description: str = "",
+        meter: metrics.Meter | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            name (str): Metric name
+            attribute_names (list[str]): Names of the attributes, in the order the values are passed to add
+            unit (str): Metric unit
+            description (str): Metric description
+            meter (Meter): Meter to create the instrument with (defaults to a meter for this module)
+        """
+        self.name = name
+        self.attribute_names = attribute_names
+        self.__totals: dict[tuple, float] = {}
+        self.__attributes: dict[tuple, dict[str, str]] = {}
+        self.__lock = threading.Lock()
+        (meter or metrics.get_meter(__name__)).create_observable_counter(
+            name, callbacks=[self.__observe], unit=unit, description=description
+        )
+
+    def add(self, value: float, attribute_values: tuple):
+        """
+        Add to the counter for a set of attribute values (in attribute_names order)
+        """
+        with self.__lock:
+            total = self.__totals.get(attribute_values)
+            if total is None:
+                self.__attributes[attribute_values] = dict(
+                    zip(self.attribute_names, attribute_values)
+                )
+                total = 0
+            self.__totals[attribute_values] = total + value
+
+    def __observe(self, options: CallbackOptions) -> Iterable[Observation]:
+        # observable counters report the cumulative total
+        with self.__lock:
+            return [
+                Observation(total, self.__attributes[attribute_values])
+                for attribute_values, total in self.__totals.items()
+            ]
+
+
+class AggregatedLatencyHistogram:
+    """
+    Latency histograms (one per set of attribute values) that are aggregated in-process.
+
+    Each export interval, the count, mean, max and LATENCY_STATISTICS percentiles for the
+    requests recorded since the previous export are exported as an OpenTelemetry
+    ObservableGauge (with a "statistic" attribute), instead of recording every request.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        attribute_names: list[str],
+        description: str = "",
+        meter: metrics.Meter | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            name (str): Metric name
+            attribute_names (list[str]): Names of the attributes, in the order the values are passed to record
+            description (str): Metric description
+            meter (Meter): Meter to create the instrument with (defaults to a meter for this module)
+        """
+        self.name = name
+        self.attribute_names = attribute_names
+        # histograms since the last export
+        self.__interval_histograms: dict[tuple, LatencyHistogram] = {}
+        self.__attributes: dict[tuple, dict[str, dict[str, str]]] = {}
+        self.__lock = threading.Lock()
+        (meter or metrics.get_meter(__name__)).create_observable_gauge(
+            name, callbacks=[self.__observe], unit="s", description=description
+        )
+
+    def record(self, value: float, attribute_values: tuple):
+        """
+        Record a latency (in seconds) for a set of attribute values (in attribute_names order)
+        """
+        with self.__lock:
+            histogram = self.__interval_histograms.get(attribute_values)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self.__interval_histograms[attribute_values] = histogram
+            histogram.record(value)
+
+    def __get_attributes(self, attribute_values: tuple) -> dict[str, dict[str, str]]:
+        """
+        Get the attributes to export for each statistic for a set of attribute values
+        """
+        attributes = self.__attributes.get(attribute_values)
+        if attributes is None:
+            base_attributes = dict(zip(self.attribute_names, attribute_values))
+            attributes = {
+                statistic: {**base_attributes, "statistic": statistic}
+                for statistic in ["count", "mean", "max", *LATENCY_STATISTICS]
+            }
+            self.__attributes[attribute_values] = attributes
+        return attributes
+
+    def __observe(self, options: CallbackOptions) -> Iterable[Observation]:
+        with self.__lock:
+            interval_histograms = self.__interval_histograms
+            self.__interval_histograms = {}
+        observations = []
+        for attribute_values, histogram in interval_histograms.items():
+            attributes = self.__get_attributes(attribute_values)
+            observations.append(Observation(histogram.count, attributes["count"]))
+            observations.append(Observation(histogram.mean(), attributes["mean"]))
+            observations.append(Observation(histogram.max, attributes["max"]))
+            for statistic, q in LATENCY_STATISTICS.items():
+                observations.append(
+                    Observation(histogram.quantile(q), attributes[statistic])
+                )
+        return observations
@@ -0,0 +1,55 @@
+import logging
+import os
+
+from opentelemetry import metrics
+from azure.monitor.opentelemetry import configure_azure_monitor
+
+from .backend_metrics import BACKEND_HEADER
+from .config import app_insights_connection_string, metrics_export_interval
+from .request_metrics import AggregatedLatencyHistogram
+from .users import get_request_priority
+
+#
+# Request metrics sent to App Insights by the locust scenarios (this module imports
+# locust, so it is kept separate from the latency probe code in latency.py, which
+# also runs as a standalone service - see latency_probe_service.py)
+#
+
+if app_insights_connection_string:
+    # Options: https://github.com/Azure/azure-sdk-for-python/tree/main/sdk/monitor/azure-monitor-opentelemetry#usage
+    logging.getLogger("azure").setLevel(logging.WARNING)
+    # the metric reader collects the (pre-aggregated) request metrics at this interval
+    os.environ.setdefault(
+        "OTEL_METRIC_EXPORT_INTERVAL", str(int(metrics_export_interval * 1000))
+    )
+    configure_azure_monitor(connection_string=app_insights_connection_string)
+
+# request latencies aggregated per (priority, status_code, backend)
+histogram_request_latency = AggregatedLatencyHistogram(
+    "locust.request_latency",
+    ["priority", "status_code", "backend"],
+    description="Request latency",
+    meter=metrics.get_meter(__name__),
+)
+
+
+def report_request_metric(
+    request_type,
+    name,
+    response_time,
+    response_length,
+    exception,
+    response=None,
+    context=None,
+    **kwargs,
+):
+    # response_time is in milliseconds
+    response_headers = getattr(response, "headers", None)
+    histogram_request_latency.record(
+        response_time / 1000,
+        (
+            get_request_priority(response, context),
+            str(getattr(response, "status_code", 0)),
+            (response_headers.get(BACKEND_HEADER) if response_headers else None) or "",
+        ),
+    )
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from .config import simulator_api_key
+from .http_client import get_session
+
+default_deployment_config_path = os.path.join(
+    os.path.dirname(__file__),
+    "../../infra/simulators/simulator_file_content/simulator_deployment_config.json",
+)
+
+
+@dataclass
+class SimulatorConfigDelta:
+    """
+    Changes to apply to a simulator's configuration (None leaves a value unchanged)
+
+    Latencies are in milliseconds per generated token.
+    Deployments use the simulator_deployment_config.json format,
+    i.e. {name: {"model": ..., "tokensPerMinute": ...}}
+    """
+
+    completions_latency: float | None = None
+    chat_completions_latency: float | None = None
+    deployments: dict[str, dict] | None = None
+
+    def to_patch(self) -> dict:
+        """
+        Build the body for the simulator's /++/config PATCH endpoint
+        """
+        patch = {}
+        latency = {}
+        if self.completions_latency is not None:
+            latency["open_ai_completions"] = {"mean": self.completions_latency}
+        if self.chat_completions_latency is not None:
+            latency["open_ai_chat_completions"] = {
+                "mean": self.chat_completions_latency
+            }
+        if latency:
+            patch["latency"] = latency
+        if self.deployments is not None:
+            patch["openai_deployments"] = {
+                name: {
+                    "name": name,
+                    "model": deployment["model"],
+                    "tokens_per_minute": deployment["tokensPerMinute"],
+                }
+                for name, deployment in self.deployments.items()
+            }
+        return patch
+
+
+class SimulatorConfigError(Exception):
+    """
+    Raised when one or more simulators couldn't be reconfigured
+    """
+
+    def __init__(self, failures: dict[str, Exception]):
+        self.failures = failures
+        details = ", ".join(f"{endpoint}: {e}" for endpoint, e in failures.items())
+        super().__init__(f"Failed to configure simulators: {details}")
+
+
+def load_deployment_config(path: str = default_deployment_config_path) -> dict:
+    """
+    Load the simulator deployment config (deployment name -> model and tokensPerMinute)
+    """
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def apply_simulator_config(
+    endpoint: str, delta: SimulatorConfigDelta, timeout: float = 10
+):
+    """
+    Apply a configuration delta to a single simulator
+
+    :param endpoint: The simulator endpoint to configure
+    :param delta: The configuration changes to apply
+    :param timeout: The request timeout in seconds
+    """
+    response = get_session().patch(
+        url=f"{endpoint}/++/config",
+        headers={"api-key": simulator_api_key, "Content-Type": "application/json"},
+        json=delta.to_patch(),
+        timeout=timeout,
+    )
+    response.raise_for_status()
+
+
+def configure_simulators(
+    deltas: dict[str, SimulatorConfigDelta],
+    timeout: float = 10,
+    raise_on_error: bool = True,
+) -> dict[str, Exception]:
+    """
+    Apply configuration deltas to multiple simulators in parallel
+
+    :param deltas: The configuration changes to apply, keyed by simulator endpoint
+    :param timeout: The request timeout in seconds
+    :param raise_on_error: Raise a SimulatorConfigError if any simulator fails
+    :return: The errors for the simulators that failed, keyed by endpoint
+    """
+    if len(deltas) == 0:
+        return {}
+
+    with ThreadPoolExecutor(
+        max_workers=len(deltas), thread_name_prefix="simulator-config"
+    ) as executor:
+        futures = {
+            endpoint: executor.submit(apply_simulator_config, endpoint, delta, timeout)
+            for endpoint, delta in deltas.items()
+        }
+        failures = {
+            endpoint: future.exception()
+            for endpoint, future in futures.items()
+            if future.exception() is not None
+        }
+
+    for endpoint, e in failures.items():
+        logging.warning("Failed to configure simulator %s: %s", endpoint, e)
+    if failures and raise_on_error:
+        raise SimulatorConfigError(failures)
+    return failures
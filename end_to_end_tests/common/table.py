@@ -0,0 +1,135 @@
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class GroupDefinition:
+    id_column: str
+    group_column: str
+    value_column: str
+    missing_value: Any = None
+
+
+class Table:
+    """
+    Query result table stored as one list of values per column.
+
+    Tables can be created from rows (e.g. the rows of a LogsTable or a JSON response),
+    in which case the rows are only converted to columns when a column is first used,
+    or directly from columns. The rows property is available in both cases.
+    """
+
+    def __init__(
+        self,
+        columns: list[str],
+        rows: Iterable[Sequence[Any]] | None = None,
+        column_values: list[list[Any]] | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            columns (list[str]): Column names
+            rows (Iterable[Sequence[Any]]): Rows of values (e.g. LogsTable.rows)
+            column_values (list[list[Any]]): Values for each column (instead of rows)
+        """
+        if rows is not None and column_values is not None:
+            raise ValueError("Specify rows or column_values, not both")
+        if column_values is not None and len(column_values) != len(columns):
+            raise ValueError("column_values must have a list of values for each column")
+        self.columns = list(columns)
+        self.__column_indexes = {name: i for i, name in enumerate(self.columns)}
+        if column_values is not None:
+            # rows are built from the columns if needed
+            self.__source_rows = None
+        else:
+            self.__source_rows = rows if rows is not None else []
+        self.__column_values = column_values
+
+    @classmethod
+    def from_logs_table(cls, logs_table) -> "Table":
+        """
+        Create a table from an azure-monitor-query LogsTable (converted to columns on first use)
+        """
+        return cls(columns=logs_table.columns, rows=logs_table.rows)
+
+    @property
+    def rows(self) -> list[Sequence[Any]]:
+        if self.__source_rows is None:
+            self.__source_rows = [list(row) for row in zip(*self.__get_column_values())]
+        elif not isinstance(self.__source_rows, list):
+            self.__source_rows = list(self.__source_rows)
+        return self.__source_rows
+
+    def __len__(self) -> int:
+        if self.__column_values is not None:
+            return len(self.__column_values[0]) if self.__column_values else 0
+        return len(self.rows)
+
+    def column_index(self, column: str) -> int:
+        """
+        Get the index of a column
+        """
+        try:
+            return self.__column_indexes[column]
+        except KeyError:
+            raise ValueError(
+                f"Column '{column}' not found in table columns: "
+                + ",".join(self.columns)
+            )
+
+    def get_column(self, column: str) -> list[Any]:
+        """
+        Get the values for a column
+        """
+        return self.__get_column_values()[self.column_index(column)]
+
+    def __get_column_values(self) -> list[list[Any]]:
+        if self.__column_values is None:
+            rows = self.rows
+            if len(rows) == 0:
+                self.__column_values = [[] for _ in self.columns]
+            else:
+                self.__column_values = [list(values) for values in zip(*rows)]
+        return self.__column_values
+
+    def group_by(
+        self,
+        id_column: str,
+        group_column: str,
+        value_column: str,
+        missing_value: Any = None,
+    ) -> "Table":
+        """
+        Pivot the table to have a row for each id_column value and a column of
+        value_column values for each distinct value in group_column.
+
+        Rows are assumed to be sorted on id_column (a new output row is started
+        each time the id_column value changes)
+        """
+        ids = self.get_column(id_column)
+        groups = self.get_column(group_column)
+        values = self.get_column(value_column)
+
+        # dictionary encode the group column: one output column per distinct group value
+        distinct_groups = sorted(set(groups))
+        group_codes = {group: code for code, group in enumerate(distinct_groups)}
+
+        new_ids = []
+        new_values = [[] for _ in distinct_groups]
+        previous_id = None
+        for id, group, value in zip(ids, groups, values):
+            if not new_ids or id != previous_id:
+                # start new row
+                new_ids.append(id)
+                for group_values in new_values:
+                    group_values.append(missing_value)
+                previous_id = id
+            new_values[group_codes[group]][-1] = value
+
+        return Table(
+            columns=[id_column]
+            + [f"{value_column}_{name}" for name in distinct_groups],
+            column_values=[new_ids] + new_values,
+        )
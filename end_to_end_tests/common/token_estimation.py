@@ -0,0 +1,251 @@
+import base64
+import hashlib
+import json
+import math
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+try:
+    # the regex module supports the unicode classes used by the cl100k_base pattern
+    import regex
+except ImportError:
+    regex = None
+
+from .config import tokenizer_vocabulary_path
+
+# Pre-tokenization pattern for cl100k_base (used by gpt-35-turbo, gpt-4 and text-embedding-ada-002)
+CL100K_PATTERN = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+# Approximation of CL100K_PATTERN for the standard library re module
+FALLBACK_PATTERN = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\w]?[^\W\d_]+|\d{1,3}| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+
+# Token overheads for chat messages (see the OpenAI cookbook "How to count tokens with tiktoken")
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+DEFAULT_MAX_TOKENS = 16
+
+
+class Tokenizer(ABC):
+    """
+    Base class for tokenizers used by TokenEstimator
+    """
+
+    @abstractmethod
+    def count_tokens(self, text: str) -> int:
+        pass
+
+
+class HeuristicTokenizer(Tokenizer):
+    """
+    Estimates tokens as one per chars_per_token characters (used when no vocabulary is available)
+    """
+
+    def __init__(self, chars_per_token: float = 4):
+        self.chars_per_token = chars_per_token
+
+    def count_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+
+class BpeTokenizer(Tokenizer):
+    """
+    Byte pair encoding tokenizer using a tiktoken-format vocabulary file
+    (one "<base64 token> <rank>" per line, e.g. cl100k_base.tiktoken), so no network access is needed
+    """
+
+    def __init__(self, mergeable_ranks: dict[bytes, int], pattern: str | None = None):
+        """
+        Constructor
+
+        Parameters:
+            mergeable_ranks (dict[bytes, int]): Token bytes to rank (lower ranks are merged first)
+            pattern (str): Pre-tokenization pattern (defaults to CL100K_PATTERN, or FALLBACK_PATTERN without the regex module)
+        """
+        self.mergeable_ranks = mergeable_ranks
+        if pattern is None:
+            pattern = CL100K_PATTERN if regex is not None else FALLBACK_PATTERN
+        self.__pattern = (regex or re).compile(pattern)
+
+    @classmethod
+    def from_file(cls, path: str, pattern: str | None = None) -> "BpeTokenizer":
+        mergeable_ranks = {}
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    token, rank = line.split()
+                    mergeable_ranks[base64.b64decode(token)] = int(rank)
+        return cls(mergeable_ranks, pattern)
+
+    def encode(self, text: str) -> list[int]:
+        tokens = []
+        for piece in self.__pattern.findall(text):
+            tokens.extend(self.__encode_piece(piece.encode("utf-8")))
+        return tokens
+
+    def count_tokens(self, text: str) -> int:
+        count = 0
+        for piece in self.__pattern.findall(text):
+            piece_bytes = piece.encode("utf-8")
+            if piece_bytes in self.mergeable_ranks:
+                count += 1
+            else:
+                count += len(self.__encode_piece(piece_bytes))
+        return count
+
+    def __encode_piece(self, piece: bytes) -> list[int]:
+        ranks = self.mergeable_ranks
+        rank = ranks.get(piece)
+        if rank is not None:
+            return [rank]
+
+        # repeatedly merge the adjacent pair with the lowest rank
+        parts = [piece[i : i + 1] for i in range(len(piece))]
+        while len(parts) > 1:
+            min_rank = None
+            min_index = None
+            for i in range(len(parts) - 1):
+                rank = ranks.get(parts[i] + parts[i + 1])
+                if rank is not None and (min_rank is None or rank < min_rank):
+                    min_rank = rank
+                    min_index = i
+            if min_index is None:
+                break
+            parts[min_index : min_index + 2] = [parts[min_index] + parts[min_index + 1]]
+        # bytes that aren't in the vocabulary count as one token each
+        return [ranks.get(part, -1) for part in parts]
+
+
+class TokenEstimator:
+    """
+    Counts the prompt tokens for completions, chat completions and embeddings requests.
+
+    Prompts repeat heavily in the load tests, so counts are cached (LRU) keyed by a
+    hash of the content rather than the content itself.
+    """
+
+    def __init__(self, tokenizer: Tokenizer | None = None, cache_size: int = 4096):
+        """
+        Constructor
+
+        Parameters:
+            tokenizer (Tokenizer): Tokenizer to count with (defaults to HeuristicTokenizer)
+            cache_size (int): Maximum number of cached counts (0 to disable caching)
+        """
+        self.tokenizer = tokenizer or HeuristicTokenizer()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.__cache: OrderedDict[bytes, int] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def count_text(self, text: str) -> int:
+        """
+        Count the tokens in a piece of text
+        """
+        if self.cache_size == 0:
+            return self.tokenizer.count_tokens(text)
+
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self.__lock:
+            count = self.__cache.get(key)
+            if count is not None:
+                self.__cache.move_to_end(key)
+                self.cache_hits += 1
+                return count
+            self.cache_misses += 1
+
+        count = self.tokenizer.count_tokens(text)
+        with self.__lock:
+            self.__cache[key] = count
+            if len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+        return count
+
+    def count_chat_messages(self, messages: list[dict]) -> int:
+        """
+        Count the prompt tokens for a chat completions messages array
+        """
+        count = TOKENS_PER_REPLY
+        for message in messages:
+            count += TOKENS_PER_MESSAGE
+            for key, value in message.items():
+                if isinstance(value, list):
+                    # content parts - only the text parts are counted
+                    value = "".join(
+                        part.get("text", "") for part in value if isinstance(part, dict)
+                    )
+                elif not isinstance(value, str):
+                    value = json.dumps(value)
+                count += self.count_text(value)
+                if key == "name":
+                    count += TOKENS_PER_NAME
+        return count
+
+    def count_prompt(self, prompt: str | list[str]) -> int:
+        """
+        Count the tokens for a completions prompt (a string or list of strings)
+        """
+        if isinstance(prompt, str):
+            return self.count_text(prompt)
+        return sum(self.count_text(item) for item in prompt)
+
+    def count_embeddings_input(self, input: str | list) -> int:
+        """
+        Count the tokens for an embeddings input (a string, list of strings or pre-tokenized input)
+        """
+        if isinstance(input, str):
+            return self.count_text(input)
+        count = 0
+        for item in input:
+            if isinstance(item, str):
+                count += self.count_text(item)
+            elif isinstance(item, list):
+                count += len(item)
+            else:
+                count += 1  # a single token id
+        return count
+
+    def count_prompt_tokens(self, request_body: dict) -> int:
+        """
+        Count the prompt tokens for a completions, chat completions or embeddings request body
+        """
+        if "messages" in request_body:
+            return self.count_chat_messages(request_body["messages"])
+        if "input" in request_body:
+            return self.count_embeddings_input(request_body["input"])
+        return self.count_prompt(request_body.get("prompt", ""))
+
+    def estimate_request_tokens(self, request_body: dict) -> int:
+        """
+        Estimate the total tokens a request will consume: the prompt tokens plus the
+        requested completion tokens (max_tokens for each of best_of/n completions)
+        """
+        prompt_tokens = self.count_prompt_tokens(request_body)
+        if "input" in request_body:
+            return prompt_tokens
+        completions = max(request_body.get("best_of") or 1, request_body.get("n") or 1)
+        max_tokens = request_body.get("max_tokens") or DEFAULT_MAX_TOKENS
+        return prompt_tokens + max_tokens * completions
+
+
+_estimator_lock = threading.Lock()
+_token_estimator: TokenEstimator | None = None
+
+
+def get_token_estimator() -> TokenEstimator:
+    """
+    Get the shared TokenEstimator, using the BPE vocabulary from TOKENIZER_VOCABULARY_PATH
+    if set (otherwise the heuristic tokenizer)
+    """
+    global _token_estimator
+    with _estimator_lock:
+        if _token_estimator is None:
+            if tokenizer_vocabulary_path:
+                tokenizer = BpeTokenizer.from_file(tokenizer_vocabulary_path)
+            else:
+                tokenizer = HeuristicTokenizer()
+            _token_estimator = TokenEstimator(tokenizer)
+        return _token_estimator
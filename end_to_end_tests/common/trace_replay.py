@@ -0,0 +1,451 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+from collections.abc import Iterator
+from datetime import datetime
+from typing import NamedTuple
+
+import gevent
+from locust import LoadTestShape, events
+from locust.exception import StopUser
+from locust.runners import MasterRunner
+
+from .config import (
+    apim_subscription_one_key,
+    apim_subscription_two_key,
+    apim_subscription_three_key,
+)
+from .distributed import is_worker
+from .payload_corpus import JSON_CONTENT_TYPE
+from .token_estimation import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+from .users import LoadTestUser
+
+#
+# Replay of recorded request traces: one JSON object per line, e.g.
+#
+#   {"timestamp": "2024-06-01T09:00:00.250Z", "deployment": "gpt-35-turbo-prod", "priority": "low",
+#    "prompt_tokens": 1200, "max_tokens": 200, "subscription_key": "team-a"}
+#
+# "timestamp" is an ISO 8601 string or seconds since the epoch, and the records must be in
+# timestamp order. "priority", "max_tokens" and "subscription_key" are optional.
+#
+
+# tokens for the role in a single user message (on top of TOKENS_PER_MESSAGE and TOKENS_PER_REPLY)
+CHAT_ROLE_TOKENS = 1
+# a piece of text that is one token with both the heuristic and cl100k_base tokenizers
+PROMPT_TOKEN_TEXT = " abc"
+
+# how many bytes from the end of the trace to search for the last record
+TRACE_TAIL_BYTES = 64 * 1024
+
+# custom message used to send each worker its partition of the trace from the master
+TRACE_PARTITION_MESSAGE = "trace_partition"
+
+
+class TraceRecord(NamedTuple):
+    """
+    A recorded request
+    """
+
+    timestamp: float  # seconds since the epoch
+    deployment: str
+    priority: str | None
+    prompt_tokens: int
+    max_tokens: int | None
+    subscription_key: str | None
+
+
+def parse_timestamp(value: str | float) -> float:
+    """
+    Parse a trace timestamp (ISO 8601 string or seconds since the epoch) to seconds since the epoch
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
+
+
+def parse_trace_record(line: str | bytes) -> TraceRecord:
+    """
+    Parse a line from a trace file
+    """
+    data = json.loads(line)
+    try:
+        return TraceRecord(
+            timestamp=parse_timestamp(data["timestamp"]),
+            deployment=data["deployment"],
+            priority=data.get("priority"),
+            prompt_tokens=int(data["prompt_tokens"]),
+            max_tokens=data.get("max_tokens"),
+            subscription_key=data.get("subscription_key"),
+        )
+    except KeyError as e:
+        raise ValueError(f"Trace record is missing {e}: {line!r}") from e
+
+
+def read_trace(
+    path: str, partition: int = 0, partition_count: int = 1
+) -> Iterator[TraceRecord]:
+    """
+    Stream the records from a trace file (the file is read a line at a time, not loaded into memory)
+
+    :param path: The path to the JSONL trace file
+    :param partition: The partition of records to return (records are assigned to partitions in turn)
+    :param partition_count: The number of partitions (e.g. one per locust worker)
+    """
+    with open(path, "rb") as f:
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if index % partition_count == partition:
+                yield parse_trace_record(line)
+            index += 1
+
+
+def get_trace_time_range(path: str) -> tuple[float, float]:
+    """
+    Get the timestamps of the first and last records in a trace file
+    (the last record is found by reading the end of the file rather than the whole file)
+    """
+    first = next(read_trace(path), None)
+    if first is None:
+        raise ValueError(f"Trace file has no records: {path}")
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - TRACE_TAIL_BYTES))
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    last = parse_trace_record(lines[-1])
+    return first.timestamp, last.timestamp
+
+
+def parse_deployment_mapping(value: str | None) -> dict[str, str]:
+    """
+    Parse a deployment mapping in the form "trace-name=deployment-name,other-name=deployment-name"
+    """
+    mapping = {}
+    if value:
+        for item in value.split(","):
+            trace_name, sep, deployment_name = item.partition("=")
+            if not sep:
+                raise ValueError(
+                    f"Invalid deployment mapping (expected name=name): {item}"
+                )
+            mapping[trace_name.strip()] = deployment_name.strip()
+    return mapping
+
+
+class DeploymentMapper:
+    """
+    Maps the deployment names in a trace to the deployments in the simulator deployment config
+    """
+
+    def __init__(
+        self,
+        deployment_config: dict,
+        mapping: dict[str, str] | None = None,
+        default_deployment: str | None = None,
+    ):
+        """
+        Constructor
+
+        Parameters:
+            deployment_config (dict): Simulator deployment config (see simulator_config.load_deployment_config)
+            mapping (dict[str, str]): Trace deployment name to simulator deployment name
+            default_deployment (str): Simulator deployment for trace deployments that aren't in the mapping or config
+        """
+        self.deployment_config = deployment_config
+        self.mapping = mapping or {}
+        self.default_deployment = default_deployment
+        self.__deployments: dict[str, str] = {}
+        for name in [*self.mapping.values(), default_deployment]:
+            if name is not None and name not in deployment_config:
+                raise ValueError(f"Deployment not in simulator config: {name}")
+
+    def get_deployment(self, trace_deployment: str) -> str:
+        """
+        Get the simulator deployment for a trace deployment name
+        """
+        deployment = self.__deployments.get(trace_deployment)
+        if deployment is None:
+            deployment = self.__map_deployment(trace_deployment)
+            self.__deployments[trace_deployment] = deployment
+        return deployment
+
+    def __map_deployment(self, trace_deployment: str) -> str:
+        deployment = self.mapping.get(trace_deployment)
+        if deployment is not None:
+            return deployment
+        if trace_deployment in self.deployment_config:
+            return trace_deployment
+        if self.default_deployment is not None:
+            return self.default_deployment
+        raise ValueError(
+            f"No simulator deployment for trace deployment {trace_deployment} (add a mapping or default deployment)"
+        )
+
+    def is_embeddings(self, deployment: str) -> bool:
+        """
+        Check whether a simulator deployment is an embeddings model
+        """
+        return self.deployment_config[deployment]["model"].startswith("text-embedding")
+
+
+@functools.lru_cache(maxsize=1024)
+def make_prompt(tokens: int) -> str:
+    """
+    Make prompt text with the given number of tokens
+    """
+    return PROMPT_TOKEN_TEXT * max(1, tokens)
+
+
+def get_subscription_key(trace_key: str | None) -> str:
+    """
+    Map a trace subscription key to one of the APIM subscription keys.
+    The same trace key always maps to the same subscription, so per-subscription
+    behaviour (e.g. usage tracking) follows the trace.
+    """
+    keys = [
+        apim_subscription_one_key,
+        apim_subscription_two_key,
+        apim_subscription_three_key,
+    ]
+    if trace_key is None:
+        return keys[0]
+    digest = hashlib.blake2b(trace_key.encode("utf-8"), digest_size=8).digest()
+    return keys[int.from_bytes(digest, "big") % len(keys)]
+
+
+class TraceRequest(NamedTuple):
+    """
+    A request built from a trace record
+    """
+
+    url: str
+    body: bytes
+    headers: dict[str, str]
+
+
+def build_trace_request(record: TraceRecord, mapper: DeploymentMapper) -> TraceRequest:
+    """
+    Build the request to send for a trace record.
+    The prompt is generated to have the recorded number of prompt tokens.
+    """
+    deployment = mapper.get_deployment(record.deployment)
+    if mapper.is_embeddings(deployment):
+        url = f"openai/deployments/{deployment}/embeddings?api-version=2023-05-15"
+        body = {"input": make_prompt(record.prompt_tokens), "model": deployment}
+    else:
+        url = f"openai/deployments/{deployment}/chat/completions?api-version=2023-05-15"
+        content_tokens = (
+            record.prompt_tokens
+            - TOKENS_PER_REPLY
+            - TOKENS_PER_MESSAGE
+            - CHAT_ROLE_TOKENS
+        )
+        body = {
+            "messages": [{"role": "user", "content": make_prompt(content_tokens)}],
+            "model": deployment,
+        }
+        if record.max_tokens:
+            body["max_tokens"] = record.max_tokens
+
+    headers = {
+        "ocp-apim-subscription-key": get_subscription_key(record.subscription_key),
+        "Content-Type": JSON_CONTENT_TYPE,
+    }
+    if record.priority == "low":
+        headers["x-priority"] = "low"
+    return TraceRequest(
+        url=url,
+        body=json.dumps(body, separators=(",", ":")).encode("utf-8"),
+        headers=headers,
+    )
+
+
+class TraceReplayer:
+    """
+    Hands out trace records at their recorded times (scaled by the speed factor)
+    """
+
+    def __init__(
+        self, records: Iterator[TraceRecord], trace_start: float, speed: float = 1
+    ):
+        """
+        Constructor
+
+        Parameters:
+            records (Iterator[TraceRecord]): The records to replay (in timestamp order)
+            trace_start (float): Timestamp of the start of the trace (replayed at the first claim)
+            speed (float): Speed factor, e.g. 10 to replay 10 minutes of the trace per minute
+        """
+        if speed <= 0:
+            raise ValueError("Replay speed must be greater than zero")
+        self.trace_start = trace_start
+        self.speed = speed
+        self.records_claimed = 0
+        # records that were sent more than a second later than their scaled time
+        self.late_records = 0
+        self.__records = records
+        self.__replay_start: float | None = None
+
+    def claim_next(self, now: float) -> tuple[TraceRecord, float] | None:
+        """
+        Claim the next record to send
+
+        Returns:
+            The record and the time to send it at (time.monotonic() based), or None when the trace is finished
+        """
+        record = next(self.__records, None)
+        if record is None:
+            return None
+        if self.__replay_start is None:
+            self.__replay_start = now
+        self.records_claimed += 1
+        due = self.__replay_start + (record.timestamp - self.trace_start) / self.speed
+        if due < now - 1:
+            self.late_records += 1
+        return record, due
+
+
+trace_replayer: TraceReplayer | None = None
+# (partition, partition_count) assigned by the master in distributed runs
+trace_partition: tuple[int, int] | None = None
+
+
+def get_trace_replayer(environment, path: str, speed: float) -> TraceReplayer:
+    """
+    Get the (per-process) TraceReplayer for a trace file.
+    In distributed runs each worker replays its share of the records.
+    """
+    global trace_replayer
+    if trace_replayer is None:
+        partition, partition_count = 0, 1
+        if is_worker(environment):
+            if trace_partition is None:
+                raise RuntimeError(
+                    "No trace partition received from the master - workers must connect before the test starts"
+                )
+            partition, partition_count = trace_partition
+        trace_start, _ = get_trace_time_range(path)
+        trace_replayer = TraceReplayer(
+            read_trace(path, partition, partition_count), trace_start, speed
+        )
+    return trace_replayer
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    if is_worker(environment):
+
+        def on_trace_partition(environment, msg, **kwargs):
+            global trace_partition
+            trace_partition = (msg.data["partition"], msg.data["partition_count"])
+
+        environment.runner.register_message(TRACE_PARTITION_MESSAGE, on_trace_partition)
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    runner = environment.runner
+    if isinstance(runner, MasterRunner):
+        # partition the trace between the workers connected now (the worker indexes
+        # are assigned by the master across all machines, and aren't contiguous if
+        # workers have reconnected), before the users are spawned on the workers
+        clients = sorted(
+            runner.clients.ready + runner.clients.spawning + runner.clients.running,
+            key=lambda client: runner.get_worker_index(client.id),
+        )
+        for partition, client in enumerate(clients):
+            runner.send_message(
+                TRACE_PARTITION_MESSAGE,
+                {"partition": partition, "partition_count": len(clients)},
+                client.id,
+            )
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    if trace_replayer is not None and trace_replayer.late_records > 0:
+        logging.warning(
+            f"⌚ {trace_replayer.late_records} of {trace_replayer.records_claimed} trace requests were sent more than 1s late - consider increasing the user count"
+        )
+
+
+class TraceReplayUser(LoadTestUser):
+    """
+    Base class for users that send the requests from a trace.
+
+    Each user claims the next record from the trace and waits until its (scaled) time
+    before running its task, which sends self.trace_record. The users are a pool to send
+    the requests with, so there need to be enough users to cover the requests that are
+    in flight at the busiest point of the trace. The users stop once the trace is finished.
+    """
+
+    abstract = True
+
+    trace_path: str = None
+    speed: float = 1
+
+    trace_record: TraceRecord | None = None
+
+    def on_start(self):
+        # wait for a record before the first task
+        delay = self.__claim_next_record()
+        if delay is None:
+            self.stop()
+        else:
+            gevent.sleep(delay)
+
+    def wait_time(self) -> float:
+        delay = self.__claim_next_record()
+        if delay is None:
+            raise StopUser()
+        return delay
+
+    def __claim_next_record(self) -> float | None:
+        """
+        Claim the next record from the trace
+
+        Returns:
+            The time to wait before sending it, or None when the trace is finished
+        """
+        replayer = get_trace_replayer(self.environment, self.trace_path, self.speed)
+        claim = replayer.claim_next(time.monotonic())
+        if claim is None:
+            self.trace_record = None
+            return None
+        self.trace_record, due = claim
+        return max(0, due - time.monotonic())
+
+
+class TraceReplayShape(LoadTestShape):
+    """
+    LoadTestShape that runs the users for a trace replay until the trace has been replayed
+    (the trace duration scaled by the speed factor, plus drain_time for the last responses)
+    """
+
+    abstract = True
+
+    trace_path: str = None
+    speed: float = 1
+    user_count: int = 100
+    user_classes: list[type[TraceReplayUser]] = []
+    # seconds to keep running after the last record is due
+    drain_time: float = 30
+
+    def __init__(self):
+        super().__init__()
+        if not self.trace_path:
+            raise ValueError("Trace path not set")
+        trace_start, trace_end = get_trace_time_range(self.trace_path)
+        self.replay_duration = (trace_end - trace_start) / self.speed + self.drain_time
+
+    def tick(self):
+        if self.get_run_time() < self.replay_duration:
+            return (self.user_count, self.user_count, self.user_classes)
+        return None
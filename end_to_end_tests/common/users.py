@@ -0,0 +1,69 @@
+from locust import FastHttpUser, HttpUser, User
+from locust.clients import HttpSession
+from locust.contrib.fasthttp import FastHttpSession
+
+from .config import load_generator_client
+
+# "http" uses Locust's requests-based HttpUser,
+# "fasthttp" uses the geventhttpclient-based FastHttpUser for higher throughput per core
+LOAD_GENERATOR_CLIENTS = ["http", "fasthttp"]
+
+LoadTestClient = HttpSession | FastHttpSession
+
+
+def get_user_base_class(client: str) -> type[User]:
+    """
+    Get the Locust user class for a load generator client (one of LOAD_GENERATOR_CLIENTS)
+    """
+    if client == "http":
+        return HttpUser
+    if client == "fasthttp":
+        return FastHttpUser
+    raise ValueError(f"Unhandled load generator client: {client}")
+
+
+def get_response_reason(response) -> str:
+    """
+    Get the reason phrase from an HttpUser or FastHttpUser response
+    (the policies return custom reasons such as "Too Many Tokens")
+    """
+    reason = getattr(response, "reason", None)
+    if reason is None:
+        # FastResponse exposes the status message on the underlying geventhttpclient response
+        reason = getattr(getattr(response, "_response", None), "status_message", None)
+    return reason or ""
+
+
+def get_request_priority(response, context: dict | None) -> str:
+    """
+    Get the priority of a request: the "priority" in the request context if set
+    (e.g. client.post(..., context={"priority": "low"})), otherwise "low" for
+    requests sent with the x-priority: low header
+    """
+    priority = context.get("priority") if context else None
+    if priority:
+        return priority
+    request_headers = getattr(getattr(response, "request", None), "headers", None)
+    if request_headers and request_headers.get("x-priority") == "low":
+        return "low"
+    return "high"
+
+
+class LoadTestUser(get_user_base_class(load_generator_client)):
+    """
+    Base class for the scenario users.
+
+    Set LOAD_GENERATOR_CLIENT=fasthttp to generate load with FastHttpUser. The request
+    events (and so report_request_metric) are the same for both clients.
+    """
+
+    abstract = True
+
+    def context(self) -> dict:
+        # passed to the request event listeners (e.g. for the latency report)
+        return {"user_class": type(self).__name__}
+
+    if load_generator_client == "fasthttp":
+        # completions can take a while with the higher simulator latencies
+        network_timeout = 300.0
+        connection_timeout = 60.0
@@ -0,0 +1,83 @@
+import argparse
+import logging
+import signal
+
+from common.config import (
+    latency_probe_metric,
+    latency_probe_mode,
+    latency_ranking_statistic,
+    latency_republish_interval,
+)
+from common.latency_estimator import LatencyEstimator
+from common.latency_probe import LatencyProbeService
+
+
+def main():
+    """
+    Run the latency probe continuously alongside the gateway
+    """
+    parser = argparse.ArgumentParser(
+        description="Measure backend latencies and keep the APIM preferred backends up to date"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="Seconds between measurement rounds",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.1,
+        help="Random variation applied to the interval (fraction of the interval)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=30,
+        help="Seconds allowed for each measurement round",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=3,
+        help="Samples per backend in each measurement round",
+    )
+    parser.add_argument(
+        "--republish-interval",
+        type=float,
+        default=latency_republish_interval,
+        help="Seconds after which an unchanged ranking is sent to APIM again",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    service = LatencyProbeService(
+        interval=args.interval,
+        jitter=args.jitter,
+        deadline=args.deadline,
+        samples_per_backend=args.samples,
+        republish_interval=args.republish_interval,
+        probe_mode=latency_probe_mode,
+        metric=latency_probe_metric,
+        estimator=LatencyEstimator(
+            statistic=latency_ranking_statistic, failure_latency=args.deadline
+        ),
+    )
+
+    def handle_signal(signum, frame):
+        logging.info("Stopping latency probe service")
+        service.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    logging.info("⌚ Starting latency probe service (interval %ss)", args.interval)
+    try:
+        service.run_forever()
+    except KeyboardInterrupt:
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import logging
+
+from common.config import simulator_api_key
+from common.local_simulator import LocalSimulator
+from common.simulator_config import (
+    default_deployment_config_path,
+    load_deployment_config,
+)
+
+
+async def run(host: str, ports: list[int], deployment_config_path: str):
+    deployments = load_deployment_config(deployment_config_path)
+    # one independent simulator per port (e.g. PTU1, PAYG1 and PAYG2)
+    simulators = [
+        LocalSimulator(deployments, api_key=simulator_api_key or None) for _ in ports
+    ]
+    await asyncio.gather(
+        *(
+            simulator.serve_forever(host, port)
+            for simulator, port in zip(simulators, ports)
+        )
+    )
+
+
+def main():
+    """
+    Run local stand-ins for the OpenAI API simulators so that scenarios can run offline
+    """
+    parser = argparse.ArgumentParser(
+        description="Run local OpenAI API simulators (one per port)"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument(
+        "--ports",
+        type=lambda value: [int(port) for port in value.split(",")],
+        default=[8001, 8002, 8003],
+        help="Comma-separated ports to run simulators on",
+    )
+    parser.add_argument(
+        "--deployment-config",
+        default=default_deployment_config_path,
+        help="Path to the simulator deployment config",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    try:
+        # uvloop is optional but roughly doubles the requests per second on one core
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
+    logging.info("⚙️ Starting local simulators on ports %s", args.ports)
+    try:
+        asyncio.run(run(args.host, args.ports, args.deployment_config))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
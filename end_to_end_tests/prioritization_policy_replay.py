@@ -0,0 +1,123 @@
+import argparse
+import json
+import time
+
+from tabulate import tabulate
+
+from common.prioritization_policy import (
+    TOKEN_ESTIMATES,
+    PrioritizationPolicy,
+    default_deployments,
+    generate_request_batches,
+    get_consumed_tokens,
+    replay_batches,
+    with_thresholds,
+)
+
+
+def main():
+    """
+    Replay synthetic traffic through the prioritization-token-calculating policy
+    to tune the low-priority thresholds offline
+    """
+    deployments = {limits.deployment_id: limits for limits in default_deployments}
+    parser = argparse.ArgumentParser(
+        description="Replay synthetic traffic through the prioritization policy"
+    )
+    parser.add_argument(
+        "--deployment",
+        default="gpt-35-turbo-100k-token",
+        choices=deployments.keys(),
+        help="Deployment to send requests to",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=600, help="Simulated seconds of traffic"
+    )
+    parser.add_argument(
+        "--high-rps", type=float, default=1, help="High priority requests per second"
+    )
+    parser.add_argument(
+        "--low-rps", type=float, default=1, help="Low priority requests per second"
+    )
+    parser.add_argument(
+        "--tokens", type=int, default=500, help="Consumed tokens per request"
+    )
+    parser.add_argument(
+        "--request-file",
+        help="JSON request body to calculate the consumed tokens from (overrides --tokens)",
+    )
+    parser.add_argument(
+        "--token-estimate",
+        default="policy",
+        choices=TOKEN_ESTIMATES,
+        help="How to calculate the consumed tokens for --request-file",
+    )
+    parser.add_argument(
+        "--low-priority-tpm-threshold",
+        type=int,
+        help="Override the deployment's low priority TPM threshold",
+    )
+    parser.add_argument(
+        "--low-priority-rp10s-threshold",
+        type=int,
+        help="Override the deployment's low priority RP10s threshold",
+    )
+    args = parser.parse_args()
+
+    limits = with_thresholds(
+        deployments[args.deployment],
+        args.low_priority_tpm_threshold,
+        args.low_priority_rp10s_threshold,
+    )
+    consumed_tokens = args.tokens
+    if args.request_file:
+        with open(args.request_file, encoding="utf-8") as f:
+            request_body = json.load(f)
+        operation_id = (
+            "embeddings_create" if "input" in request_body else "ChatCompletions_Create"
+        )
+        consumed_tokens = get_consumed_tokens(
+            request_body, operation_id, args.token_estimate
+        )
+        print(f"Consumed tokens ({args.token_estimate}): {consumed_tokens}")
+
+    policy = PrioritizationPolicy([limits])
+    batches = generate_request_batches(
+        args.deployment,
+        args.duration,
+        args.high_rps,
+        args.low_rps,
+        consumed_tokens,
+        resolution=policy.counters.resolution,
+    )
+
+    start = time.perf_counter()
+    summary = replay_batches(policy, batches)
+    elapsed = time.perf_counter() - start
+
+    print(f"Deployment: {limits}")
+    print(
+        tabulate(
+            summary.get_rows(),
+            headers=["Priority", "Requests", "Accepted", "Accepted %", "Accepted TPM"],
+        )
+    )
+    print()
+    print(
+        tabulate(
+            sorted(
+                [priority, reason, count]
+                for (priority, reason), count in summary.rejections.items()
+            ),
+            headers=["Priority", "Rejection reason", "Count"],
+        )
+    )
+    total = sum(summary.requests.values())
+    print()
+    print(
+        f"Replayed {total} requests in {elapsed:.2f}s ({total / max(elapsed, 1e-9):,.0f} requests/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+from azure.identity import DefaultAzureCredential
+
+from common.analysis import (
+    REPORTS_DIRECTORY,
+    LogAnalyticsBackend,
+    ResultCache,
+    load_report_manifest,
+)
+from common.config import (
+    log_analytics_workspace_id,
+    log_analytics_workspace_name,
+    query_cache_dir,
+    resource_group_name,
+    subscription_id,
+    tenant_id,
+)
+from common.query_cache import DiskResultCache
+
+
+def main():
+    """
+    Re-render the results of a past test run from the query cache, without querying
+    Log Analytics/Application Insights (the scenarios save a report manifest to the
+    query cache directory when they show their results)
+    """
+    parser = argparse.ArgumentParser(
+        description="Re-render a saved test report from the query cache"
+    )
+    parser.add_argument(
+        "manifest",
+        nargs="?",
+        help="Report manifest to render (defaults to the latest report in the query cache)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=query_cache_dir,
+        help="Query cache directory (defaults to QUERY_CACHE_DIR)",
+    )
+    parser.add_argument(
+        "--query-missing",
+        action="store_true",
+        help="Run queries that aren't in the query cache against Log Analytics (LOG_ANALYTICS_WORKSPACE_ID) and cache the results",
+    )
+    args = parser.parse_args()
+
+    if not args.cache_dir:
+        sys.exit("Query cache directory not set (QUERY_CACHE_DIR or --cache-dir)")
+
+    manifest_path = args.manifest
+    if manifest_path is None:
+        manifests = sorted(
+            glob.glob(os.path.join(args.cache_dir, REPORTS_DIRECTORY, "*.json"))
+        )
+        if not manifests:
+            sys.exit(f"No saved reports in {args.cache_dir}")
+        manifest_path = manifests[-1]
+
+    # saved results are used regardless of age when re-rendering
+    result_cache = ResultCache(
+        backing_cache=DiskResultCache(
+            args.cache_dir, max_age_seconds=0, max_size_bytes=0
+        )
+    )
+    backend = None
+    if args.query_missing:
+        if not log_analytics_workspace_id:
+            sys.exit("LOG_ANALYTICS_WORKSPACE_ID is required for --query-missing")
+        backend = LogAnalyticsBackend(
+            log_analytics_workspace_id,
+            DefaultAzureCredential(),
+            tenant_id=tenant_id,
+            subscription_id=subscription_id,
+            resource_group_name=resource_group_name,
+            workspace_name=log_analytics_workspace_name,
+        )
+    try:
+        query_processor = load_report_manifest(manifest_path, result_cache, backend)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    print(f"Report: {manifest_path}")
+    start = time.perf_counter()
+    query_error_count = query_processor.run_queries()
+    elapsed = time.perf_counter() - start
+    print()
+    if args.query_missing:
+        print(
+            f"Rendered in {elapsed * 1000:.0f}ms ({result_cache.misses} queries run against Log Analytics, validation not re-run)"
+        )
+    else:
+        print(
+            f"Rendered from the query cache in {elapsed * 1000:.0f}ms ({result_cache.misses} queries not cached, validation not re-run)"
+        )
+    sys.exit(1 if query_error_count else 0)
+
+
+if __name__ == "__main__":
+    main()
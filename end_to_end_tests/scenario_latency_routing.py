@@ -3,21 +3,31 @@ import logging
 import time
 
 import asciichartpy as asciichart
+import gevent
 from azure.identity import DefaultAzureCredential
-from locust import HttpUser, task, constant, events
+from locust import task, constant, events
 
+from common.distributed import coordinator_only
+from common.users import LoadTestUser
 from common.log_analytics import (
     GroupDefinition,
+    IngestionCheck,
     QueryProcessor,
 )
-from common.latency import (
-    measure_latency_and_update_apim,
-    set_simulator_completions_latency,
-    report_request_metric,
-)
+from common.request_reporting import report_request_metric
+from common.backend_metrics import add_backend_matrix
+from common.latency_report import add_latency_report, latency_report
+from common.live_dashboard import add_live_dashboard
+from common.simulator_config import SimulatorConfigDelta, configure_simulators
+from common.latency_estimator import LatencyEstimator
+from common.latency_probe import LatencyProbeService
 from common.config import (
     apim_subscription_one_key,
     app_insights_connection_string,
+    latency_probe_metric,
+    latency_probe_mode,
+    latency_ranking_statistic,
+    latency_republish_interval,
     simulator_endpoint_payg1,
     simulator_endpoint_payg2,
     tenant_id,
@@ -28,10 +38,14 @@ from common.config import (
 )
 
 test_start_time = None
+probe_service: LatencyProbeService | None = None
+orchestration_greenlet: gevent.Greenlet | None = None
 deployment_name = "gpt-35-turbo-100m-token"
+# seconds allowed for each latency measurement round
+probe_deadline = 30
 
 
-class CompletionUser(HttpUser):
+class CompletionUser(LoadTestUser):
     """
     CompletionUser makes calls to the OpenAI Completions endpoint to show traffic via APIM
     """
@@ -53,53 +67,31 @@ class CompletionUser(HttpUser):
         )
 
 
-class TestCoordinationUser(HttpUser):
-    """
-    TestCoordinationUser controls the request latencies etc to automate the demo
+def orchestrate_test():
     """
+    Controls the request latencies etc to automate the demo
 
-    fixed_count = 1  # ensure we only have a single instance of this user
-
-    @task
-    def orchestrate_test(self):
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        # The load test repeatedly does this to simulate the scheduled task that would run in production
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        # Reverse the latencies
-        # Note that this happening _after_ the latency measurement
-        # means that we will see the latency increase in the front-end requests
-        # until the next measure/update cycle
-        logging.info("⚙️ Updating simulator latencies (PAYG1 slow, PAYG2 fast)")
-        set_simulator_completions_latency(simulator_endpoint_payg1, 100)
-        set_simulator_completions_latency(simulator_endpoint_payg2, 10)
-
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        # Run for 1 minute
-        time.sleep(60)
-
-        # Measure the latencies and update APIM
-        logging.info("⌚ Measuring latencies and updating APIM")
-        measure_latency_and_update_apim()
-
-        time.sleep(60)  # sleep for 2 minutes
+    This runs in a greenlet on the master (or the single process) rather than as a
+    user so that it has access to the probe service in distributed runs
+    """
+    # The probe service measures the latencies and updates APIM every minute
+    # to simulate the scheduled task that would run in production.
+    # Wait for the measurement at the 2 minute mark
+    # (the initial measurement is the first round)
+    probe_service.wait_for_rounds(3, timeout=300)
+
+    # Reverse the latencies
+    # Note that this happening _after_ the latency measurement
+    # means that we will see the latency increase in the front-end requests
+    # until the next measure/update cycle
+    logging.info("⚙️ Updating simulator latencies (PAYG1 slow, PAYG2 fast)")
+    configure_simulators(
+        {
+            simulator_endpoint_payg1: SimulatorConfigDelta(completions_latency=100),
+            simulator_endpoint_payg2: SimulatorConfigDelta(completions_latency=10),
+        }
+    )
+    # Nothing more to orchestrate - the probe service picks up the change
 
 
 @events.init.add_listener
@@ -114,33 +106,57 @@ def on_locust_init(environment, **kwargs):
         logging.warning(
             "App Insights connection string not found - request metrics disabled"
         )
+    add_latency_report(environment)
+    add_backend_matrix(environment)
+    add_live_dashboard(environment)
 
     # Tweak the logging output :-)
     logging.getLogger("locust").setLevel(logging.WARNING)
 
 
 @events.test_start.add_listener
+@coordinator_only
 def on_test_start(environment, **kwargs):
     """
     Initialize simulator/APIM
     """
-    global test_start_time
+    global test_start_time, probe_service, orchestration_greenlet
     test_start_time = datetime.now(UTC)
     logging.info("👟 Setting up test...")
 
     logging.info("⚙️ Setting initial simulator latencies (PAYG1 fast, PAYG2 slow)")
-    set_simulator_completions_latency(simulator_endpoint_payg1, 10)
-    set_simulator_completions_latency(simulator_endpoint_payg2, 100)
+    configure_simulators(
+        {
+            simulator_endpoint_payg1: SimulatorConfigDelta(completions_latency=10),
+            simulator_endpoint_payg2: SimulatorConfigDelta(completions_latency=100),
+        }
+    )
 
     time.sleep(1)
     logging.info("⌚ Measuring API latencies and updating APIM")
-    measure_latency_and_update_apim()
+    # No jitter so that the measurements line up with the test steps
+    probe_service = LatencyProbeService(
+        interval=60,
+        jitter=0,
+        deadline=probe_deadline,
+        probe_mode=latency_probe_mode,
+        metric=latency_probe_metric,
+        estimator=LatencyEstimator(
+            statistic=latency_ranking_statistic, failure_latency=probe_deadline
+        ),
+        republish_interval=latency_republish_interval,
+        latency_report=latency_report,
+    )
+    probe_service.run_once()
+    probe_service.start(run_immediately=False)
+    orchestration_greenlet = gevent.spawn(orchestrate_test)
 
     logging.info("👟 Test setup done")
     logging.info("🚀 Running test...")
 
 
 @events.test_stop.add_listener
+@coordinator_only
 def on_test_stop(environment, **kwargs):
     """
     Collect metrics and show results
@@ -148,6 +164,11 @@ def on_test_stop(environment, **kwargs):
     test_stop_time = datetime.now(UTC)
     logging.info("✔️ Test finished")
 
+    if orchestration_greenlet:
+        orchestration_greenlet.kill()
+    if probe_service:
+        probe_service.stop()
+
     query_processor = QueryProcessor(
         workspace_id=log_analytics_workspace_id,
         token_credential=DefaultAzureCredential(),
@@ -158,12 +179,15 @@ def on_test_stop(environment, **kwargs):
     )
 
     metric_check_time = test_stop_time - timedelta(seconds=10)
-    check_results_query = f"""
-    AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
-    | count
-    """
-    query_processor.wait_for_non_zero_count(check_results_query)
+    ingestion_checks = [IngestionCheck("ApiManagementGatewayLogs", metric_check_time)]
+    if app_insights_connection_string:
+        # the request metrics are only sent when App Insights is configured
+        ingestion_checks.append(
+            IngestionCheck(
+                "AppMetrics", metric_check_time, metric_name="locust.request_latency"
+            )
+        )
+    query_processor.wait_for_ingestion(ingestion_checks)
 
     time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
 
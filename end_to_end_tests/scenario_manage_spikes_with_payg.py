@@ -1,18 +1,25 @@
 from datetime import datetime, timedelta, UTC
 import logging
+import os
 
 import asciichartpy as asciichart
 from azure.identity import DefaultAzureCredential
-from locust import HttpUser, LoadTestShape, task, constant, events
+from locust import LoadTestShape, task, constant, events
 
+from common.distributed import coordinator_only
+from common.users import LoadTestUser
+from common.load_shapes import ArrivalRateShape, ArrivalRateUser
 from common.log_analytics import (
     GroupDefinition,
+    IngestionCheck,
     QueryProcessor,
 )
-from common.latency import (
-    set_simulator_chat_completions_latency,
-    report_request_metric,
-)
+from common.request_reporting import report_request_metric
+from common.backend_metrics import add_backend_matrix
+from common.latency_report import add_latency_report
+from common.live_dashboard import add_live_dashboard
+from common.payload_corpus import JSON_CONTENT_TYPE, PayloadCorpus
+from common.simulator_config import SimulatorConfigDelta, configure_simulators
 from common.config import (
     apim_subscription_one_key,
     simulator_endpoint_ptu1,
@@ -25,15 +32,74 @@ from common.config import (
     log_analytics_workspace_name,
 )
 
+# "users" for a fixed number of users (closed loop) or "rate" for fixed request rates (open loop)
+load_pattern = os.getenv("LOAD_PATTERN", "users")
 test_start_time = None
 deployment_name = "gpt-35-turbo-100k-token"
 
+request_headers = {
+    "ocp-apim-subscription-key": apim_subscription_one_key,
+    "Content-Type": JSON_CONTENT_TYPE,
+}
+chat_payload = {
+    "messages": [
+        {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Ut enim ad minim veniam?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Ut enim ad minim veniam?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Ut enim ad minim veniam?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Ut enim ad minim veniam?"},
+        {
+            "role": "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
+        },
+        {"role": "user", "content": "Duis aute irure dolor in reprehenderit?"},
+    ],
+    "model": "gpt-5-turbo-1",
+    "max_tokens": 1000,
+}
+# serialize the request body once rather than on every request
+chat_corpus = PayloadCorpus([(chat_payload, 1)])
+
 
 class StagesShape(LoadTestShape):
     """
     Custom LoadTestShape to simulate a spike in traffic part way through the test
     """
 
+    # ArrivalStagesShape is used for the "rate" load pattern
+    abstract = load_pattern != "users"
+
     # See https://docs.locust.io/en/stable/custom-load-shape.html
     stages = [
         {"duration": 180, "users": 2, "spawn_rate": 0.1},
@@ -45,12 +111,28 @@ class StagesShape(LoadTestShape):
 
         for stage in self.stages:
             if run_time < stage["duration"]:
-                return (stage["users"], stage["spawn_rate"])
+                return (stage["users"], stage["spawn_rate"], [ChatCompletionUser])
 
         return None
 
 
-class ChatCompletionUser(HttpUser):
+def send_chat_request(client):
+    url = (
+        f"openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15"
+    )
+    try:
+        client.post(
+            url,
+            data=chat_corpus.next_payload().body,
+            headers=request_headers,
+        )
+    except Exception as e:
+        print()
+        logging.error(e)
+        raise
+
+
+class ChatCompletionUser(LoadTestUser):
     """
     CompletionUser makes calls to the OpenAI Chat Completions endpoint to show traffic via APIM
     """
@@ -59,64 +141,37 @@ class ChatCompletionUser(HttpUser):
 
     @task
     def get_completion(self):
-        url = f"openai/deployments/{deployment_name}/chat/completions?api-version=2023-05-15"
-        payload = {
-            "messages": [
-                {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Ut enim ad minim veniam?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Ut enim ad minim veniam?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Ut enim ad minim veniam?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Ut enim ad minim veniam?"},
-                {
-                    "role": "assistant",
-                    "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-                },
-                {"role": "user", "content": "Duis aute irure dolor in reprehenderit?"},
-            ],
-            "model": "gpt-5-turbo-1",
-            "max_tokens": 1000,
-        }
-        try:
-            self.client.post(
-                url,
-                json=payload,
-                headers={"ocp-apim-subscription-key": apim_subscription_one_key},
-            )
-        except Exception as e:
-            print()
-            logging.error(e)
-            raise
+        send_chat_request(self.client)
+
+
+class ChatCompletionArrivalRateUser(ArrivalRateUser):
+    """
+    ChatCompletionArrivalRateUser makes calls to the OpenAI Chat Completions endpoint
+    at the rate set by ArrivalStagesShape
+    """
+
+    arrival_stream = "chat"
+
+    @task
+    def get_completion(self):
+        send_chat_request(self.client)
+
+
+class ArrivalStagesShape(ArrivalRateShape):
+    """
+    Open-loop LoadTestShape to simulate a spike in traffic part way through the test.
+    The request rate is maintained regardless of the response times
+    """
+
+    # StagesShape is used for the "users" load pattern
+    abstract = load_pattern != "rate"
+
+    # roughly the rates the users in StagesShape send at
+    stages = [
+        {"duration": 180, "rpm": {"chat": 60}},
+        {"duration": 360, "rpm": {"chat": 180}},
+    ]
+    stream_user_classes = {"chat": ChatCompletionArrivalRateUser}
 
 
 @events.init.add_listener
@@ -131,12 +186,16 @@ def on_locust_init(environment, **kwargs):
         logging.warning(
             "App Insights connection string not found - request metrics disabled"
         )
+    add_latency_report(environment)
+    add_backend_matrix(environment)
+    add_live_dashboard(environment)
 
     # Tweak the logging output :-)
     # logging.getLogger("locust").setLevel(logging.WARNING)
 
 
 @events.test_start.add_listener
+@coordinator_only
 def on_test_start(environment, **kwargs):
     """
     Initialize simulator/APIM
@@ -146,14 +205,19 @@ def on_test_start(environment, **kwargs):
     logging.info("👟 Setting up test...")
 
     logging.info("⚙️ Resetting simulator latencies")
-    set_simulator_chat_completions_latency(simulator_endpoint_ptu1, 1)
-    set_simulator_chat_completions_latency(simulator_endpoint_payg1, 1)
+    configure_simulators(
+        {
+            simulator_endpoint_ptu1: SimulatorConfigDelta(chat_completions_latency=1),
+            simulator_endpoint_payg1: SimulatorConfigDelta(chat_completions_latency=1),
+        }
+    )
 
     logging.info("👟 Test setup done")
     logging.info("🚀 Running test...")
 
 
 @events.test_stop.add_listener
+@coordinator_only
 def on_test_stop(environment, **kwargs):
     """
     Collect metrics and show results
@@ -171,12 +235,15 @@ def on_test_stop(environment, **kwargs):
     )
 
     metric_check_time = test_stop_time - timedelta(seconds=10)
-    check_results_query = f"""
-    AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
-    | count
-    """
-    query_processor.wait_for_non_zero_count(check_results_query)
+    ingestion_checks = [IngestionCheck("ApiManagementGatewayLogs", metric_check_time)]
+    if app_insights_connection_string:
+        # the request metrics are only sent when App Insights is configured
+        ingestion_checks.append(
+            IngestionCheck(
+                "AppMetrics", metric_check_time, metric_name="locust.request_latency"
+            )
+        )
+    query_processor.wait_for_ingestion(ingestion_checks)
 
     time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
 
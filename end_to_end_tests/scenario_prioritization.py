@@ -4,18 +4,24 @@ import os
 
 import asciichartpy as asciichart
 from azure.identity import DefaultAzureCredential
-from locust import HttpUser, LoadTestShape, task, constant, events
-from locust.clients import HttpSession
+from locust import LoadTestShape, task, constant, events
 from opentelemetry import metrics
 
+from common.distributed import coordinator_only
+from common.users import LoadTestClient, LoadTestUser, get_response_reason
+from common.load_shapes import ArrivalRateShape, ArrivalRateUser
 from common.log_analytics import (
     GroupDefinition,
+    IngestionCheck,
     QueryProcessor,
 )
-from common.latency import (
-    set_simulator_chat_completions_latency,
-    report_request_metric,
-)
+from common.latency import set_simulator_chat_completions_latency
+from common.request_reporting import report_request_metric
+from common.backend_metrics import add_backend_matrix
+from common.latency_report import add_latency_report
+from common.live_dashboard import add_live_dashboard
+from common.payload_corpus import JSON_CONTENT_TYPE, PayloadCorpus
+from common.request_metrics import AggregatedCounter
 from common.config import (
     apim_subscription_one_key,
     simulator_endpoint_payg1,
@@ -31,6 +37,8 @@ load_pattern = os.getenv("LOAD_PATTERN", "cycle")
 ramp_rate = int(os.getenv("RAMP_RATE", 1))
 request_type = os.getenv("REQUEST_TYPE", "embeddings")
 max_tokens = int(os.getenv("MAX_TOKENS", "-1"))
+high_priority_rpm = float(os.getenv("HIGH_PRIORITY_RPM", 600))
+low_priority_rpm = float(os.getenv("LOW_PRIORITY_RPM", 300))
 endpoint_path = os.getenv("ENDPOINT_PATH")
 
 test_start_time = None
@@ -44,15 +52,71 @@ print(f"Ramp rate: {ramp_rate}")
 print(f"Embedding deployment name: {embedding_deployment_name}")
 print(f"Chat deployment name: {chat_deployment_name}")
 print(f"Request type: {request_type}")
+if load_pattern == "rate-mixed":
+    print(f"High priority RPM: {high_priority_rpm}")
+    print(f"Low priority RPM: {low_priority_rpm}")
 print(f"Endpoint path: {endpoint_path}")
 if request_type == "chat":
     print(f"Max tokens: {max_tokens}")
 elif max_tokens > 0:
     raise ValueError("Max tokens should not be set for non-chat requests")
 
-histogram_request_result = metrics.get_meter(__name__).create_histogram(
-    "locust.request_result", "Request Response", "count"
+counter_request_result = AggregatedCounter(
+    "locust.request_result",
+    ["status_code", "priority", "request_type", "reason"],
+    unit="count",
+    description="Request Response",
+    meter=metrics.get_meter(__name__),
+)
+# estimated token cost of the requests sent (prompt tokens + max_tokens),
+# to compare against the ConsumedTokens metric emitted by the policy
+counter_estimated_tokens = AggregatedCounter(
+    "locust.estimated_tokens",
+    ["status_code", "priority", "request_type"],
+    unit="tokens",
+    description="Estimated request tokens",
+    meter=metrics.get_meter(__name__),
+)
+
+high_priority_headers = {
+    "ocp-apim-subscription-key": apim_subscription_one_key,
+    "Content-Type": JSON_CONTENT_TYPE,
+}
+low_priority_headers = {**high_priority_headers, "x-priority": "low"}
+
+# request bodies are serialized once up front rather than on every request
+embedding_corpus = PayloadCorpus(
+    [
+        (
+            {
+                "input": "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Habitant morbi tristique senectus et netus et malesuada. Bibendum neque egestas congue quisque egestas diam. Rutrum quisque non tellus orci ac auctor augue. Diam in arcu cursus euismod quis. Euismod elementum nisi quis eleifend quam adipiscing. Posuere lorem ipsum dolor sit amet consectetur adipiscing elit duis. Pretium vulputate sapien nec sagittis aliquam malesuada bibendum arcu. Adipiscing diam donec adipiscing tristique risus nec. Nec ultrices dui sapien eget mi proin. Odio facilisis mauris sit amet. Eget aliquet nibh praesent tristique magna. Malesuada nunc vel risus commodo viverra maecenas accumsan lacus vel. Maecenas volutpat blandit aliquam etiam erat velit scelerisque in dictum. Venenatis tellus in metus vulputate. Aliquet enim tortor at auctor urna nunc id cursus metus. Sed velit dignissim sodales ut eu sem integer vitae justo.",
+                "model": "embedding",
+            },
+            1,
+        )
+    ]
 )
+chat_corpora: dict[int, PayloadCorpus] = {}
+
+
+def get_chat_corpus(max_tokens: int) -> PayloadCorpus:
+    """
+    Get the chat request corpus for a max_tokens value (0 or less to omit max_tokens)
+    """
+    corpus = chat_corpora.get(max_tokens)
+    if corpus is None:
+        payload = {
+            "messages": [
+                {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
+            ],
+            "model": "gpt-35-turbo",
+        }
+        if max_tokens > 0:
+            payload["max_tokens"] = max_tokens
+        corpus = PayloadCorpus([(payload, 1)])
+        chat_corpora[max_tokens] = corpus
+    return corpus
+
 
 # TODO - this file is getting large - consider splitting
 
@@ -63,7 +127,7 @@ histogram_request_result = metrics.get_meter(__name__).create_histogram(
 #  - 600 RPM (10 RPS)
 
 
-def make_request(client: HttpSession, low_priority: bool):
+def make_request(client: LoadTestClient, low_priority: bool):
     if request_type == "embeddings":
         make_embedding_request(client, low_priority)
     elif request_type == "chat":
@@ -72,69 +136,49 @@ def make_request(client: HttpSession, low_priority: bool):
         raise ValueError(f"Unhandled request type: {request_type}")
 
 
-def make_embedding_request(client: HttpSession, low_priority: bool):
+def make_embedding_request(client: LoadTestClient, low_priority: bool):
     url = f"openai/deployments/{embedding_deployment_name}/embeddings?api-version=2023-05-15"
-    input_text = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Habitant morbi tristique senectus et netus et malesuada. Bibendum neque egestas congue quisque egestas diam. Rutrum quisque non tellus orci ac auctor augue. Diam in arcu cursus euismod quis. Euismod elementum nisi quis eleifend quam adipiscing. Posuere lorem ipsum dolor sit amet consectetur adipiscing elit duis. Pretium vulputate sapien nec sagittis aliquam malesuada bibendum arcu. Adipiscing diam donec adipiscing tristique risus nec. Nec ultrices dui sapien eget mi proin. Odio facilisis mauris sit amet. Eget aliquet nibh praesent tristique magna. Malesuada nunc vel risus commodo viverra maecenas accumsan lacus vel. Maecenas volutpat blandit aliquam etiam erat velit scelerisque in dictum. Venenatis tellus in metus vulputate. Aliquet enim tortor at auctor urna nunc id cursus metus. Sed velit dignissim sodales ut eu sem integer vitae justo."
-    payload = {
-        "input": input_text,
-        "model": "embedding",
-    }
+    payload = embedding_corpus.next_payload()
     try:
-        headers = {
-            "ocp-apim-subscription-key": apim_subscription_one_key,
-        }
-        if low_priority:
-            headers["x-priority"] = "low"
-
-        r = client.post(url, json=payload, headers=headers)
-        histogram_request_result.record(
-            1,
-            {
-                "status_code": str(r.status_code),
-                "priority": "low" if low_priority else "high",
-                "request_type": "embeddings",
-                "reason": r.reason,
-            },
+        headers = low_priority_headers if low_priority else high_priority_headers
+        priority = "low" if low_priority else "high"
+        r = client.post(
+            url, data=payload.body, headers=headers, context={"priority": priority}
+        )
+        status_code = str(r.status_code)
+        counter_request_result.add(
+            1, (status_code, priority, "embeddings", get_response_reason(r))
+        )
+        counter_estimated_tokens.add(
+            payload.estimated_tokens, (status_code, priority, "embeddings")
         )
     except Exception as e:
         logging.error(e)
         raise
 
 
-def make_chat_request(client: HttpSession, low_priority: bool, max_tokens: int = 0):
+def make_chat_request(client: LoadTestClient, low_priority: bool, max_tokens: int = 0):
     url = f"openai/deployments/{chat_deployment_name}/chat/completions?api-version=2023-05-15"
-    payload = {
-        "messages": [
-            {"role": "user", "content": "Lorem ipsum dolor sit amet?"},
-        ],
-        "model": "gpt-35-turbo",
-    }
-    if max_tokens > 0:
-        payload["max_tokens"] = max_tokens
+    payload = get_chat_corpus(max_tokens).next_payload()
     try:
-        headers = {
-            "ocp-apim-subscription-key": apim_subscription_one_key,
-        }
-
-        if low_priority:
-            headers["x-priority"] = "low"
-
-        r = client.post(url, json=payload, headers=headers)
-        histogram_request_result.record(
-            1,
-            {
-                "status_code": str(r.status_code),
-                "priority": "low" if low_priority else "high",
-                "request_type": "chat",
-                "reason": r.reason,
-            },
+        headers = low_priority_headers if low_priority else high_priority_headers
+        priority = "low" if low_priority else "high"
+        r = client.post(
+            url, data=payload.body, headers=headers, context={"priority": priority}
+        )
+        status_code = str(r.status_code)
+        counter_request_result.add(
+            1, (status_code, priority, "chat", get_response_reason(r))
+        )
+        counter_estimated_tokens.add(
+            payload.estimated_tokens, (status_code, priority, "chat")
         )
     except Exception as e:
         logging.error(e)
         raise
 
 
-class HighPriorityUser(HttpUser):
+class HighPriorityUser(LoadTestUser):
     """
     HighPriorityUser makes calls to the OpenAI endpoint to show traffic via APIM
     """
@@ -146,7 +190,7 @@ class HighPriorityUser(HttpUser):
         make_request(self.client, False)
 
 
-class LowPriorityUser(HttpUser):
+class LowPriorityUser(LoadTestUser):
     """
     LowPriorityUser makes calls to the OpenAI endpoint to show traffic via APIM and sets the x-priority header to "low"
     """
@@ -158,7 +202,7 @@ class LowPriorityUser(HttpUser):
         make_request(self.client, True)
 
 
-class MixedUser_1_1(HttpUser):
+class MixedUser_1_1(LoadTestUser):
     """
     MixedUser_1_1 makes calls to the OpenAI endpoint to show traffic via APIM.
     It has a 1:1 ratio of high to low priority requests.
@@ -175,7 +219,7 @@ class MixedUser_1_1(HttpUser):
         make_request(self.client, True)
 
 
-class HighPriorityLowTokenChatUser(HttpUser):
+class HighPriorityLowTokenChatUser(LoadTestUser):
     wait_time = constant(1)  # wait 1 second between requests
 
     @task
@@ -183,7 +227,7 @@ class HighPriorityLowTokenChatUser(HttpUser):
         make_chat_request(self.client, False, 200)
 
 
-class HighPriorityHighTokenChatUser(HttpUser):
+class HighPriorityHighTokenChatUser(LoadTestUser):
     wait_time = constant(1)  # wait 1 second between requests
 
     @task
@@ -191,7 +235,7 @@ class HighPriorityHighTokenChatUser(HttpUser):
         make_chat_request(self.client, False, 1000)
 
 
-class LowPriorityLowTokenChatUser(HttpUser):
+class LowPriorityLowTokenChatUser(LoadTestUser):
     wait_time = constant(1)  # wait 1 second between requests
 
     @task
@@ -199,7 +243,7 @@ class LowPriorityLowTokenChatUser(HttpUser):
         make_chat_request(self.client, True, 200)
 
 
-class MixedPriorityLowTokenChatUser(HttpUser):
+class MixedPriorityLowTokenChatUser(LoadTestUser):
     wait_time = constant(1)  # wait 1 second between requests
 
     @task
@@ -211,7 +255,7 @@ class MixedPriorityLowTokenChatUser(HttpUser):
         make_chat_request(self.client, True, 200)
 
 
-class MixedPriorityHighTokenChatUser(HttpUser):
+class MixedPriorityHighTokenChatUser(LoadTestUser):
     wait_time = constant(1)  # wait 1 second between requests
 
     @task
@@ -223,6 +267,30 @@ class MixedPriorityHighTokenChatUser(HttpUser):
         make_chat_request(self.client, True, 1000)
 
 
+class HighPriorityArrivalRateUser(ArrivalRateUser):
+    """
+    HighPriorityArrivalRateUser sends high priority requests at the rate set by ArrivalStagesShape
+    """
+
+    arrival_stream = "high"
+
+    @task
+    def make_request_high_priority(self):
+        make_request(self.client, False)
+
+
+class LowPriorityArrivalRateUser(ArrivalRateUser):
+    """
+    LowPriorityArrivalRateUser sends low priority requests at the rate set by ArrivalStagesShape
+    """
+
+    arrival_stream = "low"
+
+    @task
+    def make_request_low_priority(self):
+        make_request(self.client, True)
+
+
 cycle_stages = [
     # Start with low priority
     {
@@ -279,12 +347,35 @@ high_priority_stages = [
     }
 ]
 
+# open-loop equivalents of the stages above (requests per minute for each priority):
+# the request rate is maintained even when the gateway slows down
+arrival_rate_stages = {
+    "rate-cycle": [
+        # Start with low priority
+        {"duration": 120, "rpm": {"high": 0, "low": 540}},
+        # Add high priority
+        {"duration": 240, "rpm": {"high": 540, "low": 540}},
+        # Stop low priority
+        {"duration": 360, "rpm": {"high": 540, "low": 0}},
+        # Add low priority back in
+        {"duration": 480, "rpm": {"high": 540, "low": 540}},
+        # Switch to only low priority
+        {"duration": 600, "rpm": {"high": 0, "low": 540}},
+    ],
+    "rate-mixed": [
+        {"duration": 600, "rpm": {"high": high_priority_rpm, "low": low_priority_rpm}},
+    ],
+}
+
 
 class StagesShape(LoadTestShape):
     """
     Custom LoadTestShape to simulate variations in high and low priority processing
     """
 
+    # ArrivalStagesShape is used for the arrival rate load patterns
+    abstract = load_pattern in arrival_rate_stages
+
     def __init__(self):
         super().__init__()
 
@@ -337,6 +428,24 @@ class StagesShape(LoadTestShape):
         return None
 
 
+class ArrivalStagesShape(ArrivalRateShape):
+    """
+    Open-loop LoadTestShape to simulate variations in high and low priority request rates
+    """
+
+    # StagesShape is used for the user based load patterns
+    abstract = load_pattern not in arrival_rate_stages
+
+    stream_user_classes = {
+        "high": HighPriorityArrivalRateUser,
+        "low": LowPriorityArrivalRateUser,
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.stages = arrival_rate_stages[load_pattern]
+
+
 @events.init.add_listener
 def on_locust_init(environment, **kwargs):
     """
@@ -349,9 +458,13 @@ def on_locust_init(environment, **kwargs):
         logging.warning(
             "App Insights connection string not found - request metrics disabled"
         )
+    add_latency_report(environment)
+    add_backend_matrix(environment)
+    add_live_dashboard(environment)
 
 
 @events.test_start.add_listener
+@coordinator_only
 def on_test_start(environment, **kwargs):
     """
     Initialize simulator/APIM
@@ -368,6 +481,7 @@ def on_test_start(environment, **kwargs):
 
 
 @events.test_stop.add_listener
+@coordinator_only
 def on_test_stop(environment, **kwargs):
     """
     Collect metrics and show results
@@ -389,12 +503,15 @@ def on_test_stop(environment, **kwargs):
     logging.info(f"Query time range: {time_range}")
 
     metric_check_time = test_stop_time - timedelta(seconds=10)
-    check_results_query = f"""
-    ApiManagementGatewayLogs
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')})
-    | count
-    """
-    query_processor.wait_for_non_zero_count(check_results_query)
+    ingestion_checks = [IngestionCheck("ApiManagementGatewayLogs", metric_check_time)]
+    if app_insights_connection_string:
+        # the request metrics are only sent when App Insights is configured
+        ingestion_checks.append(
+            IngestionCheck(
+                "AppMetrics", metric_check_time, metric_name="locust.request_latency"
+            )
+        )
+    query_processor.wait_for_ingestion(ingestion_checks)
 
     query_processor.add_query(
         title="Overall request count",
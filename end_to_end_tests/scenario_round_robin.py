@@ -3,16 +3,20 @@ import logging
 
 import asciichartpy as asciichart
 from azure.identity import DefaultAzureCredential
-from locust import HttpUser, task, constant, events
+from locust import task, constant, events
 
+from common.distributed import coordinator_only
+from common.users import LoadTestUser
 from common.log_analytics import (
     GroupDefinition,
+    IngestionCheck,
     QueryProcessor,
 )
-from common.latency import (
-    set_simulator_completions_latency,
-    report_request_metric,
-)
+from common.request_reporting import report_request_metric
+from common.backend_metrics import add_backend_matrix
+from common.latency_report import add_latency_report
+from common.live_dashboard import add_live_dashboard
+from common.simulator_config import SimulatorConfigDelta, configure_simulators
 from common.config import (
     apim_subscription_one_key,
     simulator_endpoint_payg1,
@@ -29,7 +33,7 @@ test_start_time = None
 deployment_name = "gpt-35-turbo-100m-token"
 
 
-class CompletionUser(HttpUser):
+class CompletionUser(LoadTestUser):
     """
     CompletionUser makes calls to the OpenAI Completions endpoint to show traffic via APIM
     """
@@ -63,12 +67,16 @@ def on_locust_init(environment, **kwargs):
         logging.warning(
             "App Insights connection string not found - request metrics disabled"
         )
+    add_latency_report(environment)
+    add_backend_matrix(environment)
+    add_live_dashboard(environment)
 
     # Tweak the logging output :-)
     logging.getLogger("locust").setLevel(logging.WARNING)
 
 
 @events.test_start.add_listener
+@coordinator_only
 def on_test_start(environment, **kwargs):
     """
     Initialize simulator/APIM
@@ -78,14 +86,19 @@ def on_test_start(environment, **kwargs):
     logging.info("👟 Setting up test...")
 
     logging.info("⚙️ Resetting simulator latencies")
-    set_simulator_completions_latency(simulator_endpoint_payg1, 10)
-    set_simulator_completions_latency(simulator_endpoint_payg2, 10)
+    configure_simulators(
+        {
+            simulator_endpoint_payg1: SimulatorConfigDelta(completions_latency=10),
+            simulator_endpoint_payg2: SimulatorConfigDelta(completions_latency=10),
+        }
+    )
 
     logging.info("👟 Test setup done")
     logging.info("🚀 Running test...")
 
 
 @events.test_stop.add_listener
+@coordinator_only
 def on_test_stop(environment, **kwargs):
     """
     Collect metrics and show results
@@ -103,12 +116,15 @@ def on_test_stop(environment, **kwargs):
     )
 
     metric_check_time = test_stop_time - timedelta(seconds=10)
-    check_results_query = f"""
-    AppMetrics
-    | where TimeGenerated >= datetime({metric_check_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and Name == "locust.request_latency"
-    | count
-    """
-    query_processor.wait_for_non_zero_count(check_results_query)
+    ingestion_checks = [IngestionCheck("ApiManagementGatewayLogs", metric_check_time)]
+    if app_insights_connection_string:
+        # the request metrics are only sent when App Insights is configured
+        ingestion_checks.append(
+            IngestionCheck(
+                "AppMetrics", metric_check_time, metric_name="locust.request_latency"
+            )
+        )
+    query_processor.wait_for_ingestion(ingestion_checks)
 
     time_range = f"TimeGenerated > datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')}) and TimeGenerated < datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')})"
 
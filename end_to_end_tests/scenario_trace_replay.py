@@ -0,0 +1,246 @@
+from datetime import datetime, timedelta, UTC
+import logging
+import os
+
+import asciichartpy as asciichart
+from azure.identity import DefaultAzureCredential
+from locust import task, events
+from opentelemetry import metrics
+
+from common.distributed import coordinator_only
+from common.users import get_response_reason
+from common.trace_replay import (
+    DeploymentMapper,
+    TraceReplayShape,
+    TraceReplayUser,
+    build_trace_request,
+    get_trace_time_range,
+    parse_deployment_mapping,
+)
+from common.simulator_config import load_deployment_config
+from common.log_analytics import (
+    GroupDefinition,
+    IngestionCheck,
+    QueryProcessor,
+)
+from common.request_reporting import report_request_metric
+from common.backend_metrics import add_backend_matrix
+from common.latency_report import add_latency_report
+from common.live_dashboard import add_live_dashboard
+from common.request_metrics import AggregatedCounter
+from common.config import (
+    tenant_id,
+    subscription_id,
+    resource_group_name,
+    app_insights_connection_string,
+    log_analytics_workspace_id,
+    log_analytics_workspace_name,
+)
+
+trace_path = os.getenv("TRACE_PATH")
+trace_speed = float(os.getenv("TRACE_SPEED", 1))
+trace_user_count = int(os.getenv("TRACE_USER_COUNT", 100))
+trace_deployment_map = parse_deployment_mapping(os.getenv("TRACE_DEPLOYMENT_MAP"))
+trace_default_deployment = os.getenv("TRACE_DEFAULT_DEPLOYMENT")
+
+if not trace_path:
+    raise ValueError("TRACE_PATH not set")
+
+test_start_time = None
+
+trace_start, trace_end = get_trace_time_range(trace_path)
+print(f"Trace: {trace_path}")
+print(
+    f"Trace duration: {timedelta(seconds=trace_end - trace_start)} (replay duration: {timedelta(seconds=(trace_end - trace_start) / trace_speed)})"
+)
+print(f"Replay speed: {trace_speed}x")
+print(f"User count: {trace_user_count}")
+
+deployment_mapper = DeploymentMapper(
+    load_deployment_config(),
+    mapping=trace_deployment_map,
+    default_deployment=trace_default_deployment,
+)
+
+counter_request_result = AggregatedCounter(
+    "locust.request_result",
+    ["status_code", "priority", "deployment", "reason"],
+    unit="count",
+    description="Request Response",
+    meter=metrics.get_meter(__name__),
+)
+
+
+class ReplayUser(TraceReplayUser):
+    """
+    ReplayUser sends the requests from the trace to show recorded traffic via APIM
+    """
+
+    trace_path = trace_path
+    speed = trace_speed
+
+    @task
+    def send_trace_request(self):
+        record = self.trace_record
+        request = build_trace_request(record, deployment_mapper)
+        priority = record.priority or "high"
+        try:
+            r = self.client.post(
+                request.url,
+                data=request.body,
+                headers=request.headers,
+                context={"priority": priority},
+            )
+            counter_request_result.add(
+                1,
+                (
+                    str(r.status_code),
+                    priority,
+                    deployment_mapper.get_deployment(record.deployment),
+                    get_response_reason(r),
+                ),
+            )
+        except Exception as e:
+            logging.error(e)
+            raise
+
+
+class ReplayShape(TraceReplayShape):
+    """
+    Runs the ReplayUsers until the trace has been replayed
+    """
+
+    trace_path = trace_path
+    speed = trace_speed
+    user_count = trace_user_count
+    user_classes = [ReplayUser]
+
+
+@events.init.add_listener
+def on_locust_init(environment, **kwargs):
+    """
+    Configure logging/metric collection
+    """
+    if app_insights_connection_string:
+        logging.info("App Insights connection string found - enabling request metrics")
+        environment.events.request.add_listener(report_request_metric)
+    else:
+        logging.warning(
+            "App Insights connection string not found - request metrics disabled"
+        )
+    add_latency_report(environment)
+    add_backend_matrix(environment)
+    add_live_dashboard(environment)
+
+
+@events.test_start.add_listener
+@coordinator_only
+def on_test_start(environment, **kwargs):
+    """
+    Initialize test
+    """
+    global test_start_time
+    test_start_time = datetime.now(UTC)
+    logging.info("👟 Test setup done")
+    logging.info("🚀 Replaying trace...")
+
+
+@events.test_stop.add_listener
+@coordinator_only
+def on_test_stop(environment, **kwargs):
+    """
+    Collect metrics and show results
+    """
+    test_stop_time = datetime.now(UTC)
+    logging.info("✔️ Test finished")
+
+    query_processor = QueryProcessor(
+        workspace_id=log_analytics_workspace_id,
+        token_credential=DefaultAzureCredential(),
+        tenant_id=tenant_id,
+        subscription_id=subscription_id,
+        resource_group_name=resource_group_name,
+        workspace_name=log_analytics_workspace_name,
+    )
+
+    time_vars = f"let startTime = datetime({test_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')});\nlet endTime = datetime({test_stop_time.strftime('%Y-%m-%dT%H:%M:%SZ')});"
+
+    metric_check_time = test_stop_time - timedelta(seconds=10)
+    ingestion_checks = [IngestionCheck("ApiManagementGatewayLogs", metric_check_time)]
+    if app_insights_connection_string:
+        # the request metrics are only sent when App Insights is configured
+        ingestion_checks.append(
+            IngestionCheck(
+                "AppMetrics", metric_check_time, metric_name="locust.request_latency"
+            )
+        )
+    query_processor.wait_for_ingestion(ingestion_checks)
+
+    query_processor.add_query(
+        title="Request count by backend",
+        query=f"""
+{time_vars}
+ApiManagementGatewayLogs
+| where OperationName != "" and  TimeGenerated > startTime and TimeGenerated < endTime
+| where BackendId != ""
+| summarize request_count = count() by bin(TimeGenerated, 10s), BackendId
+| order by TimeGenerated asc
+| render timechart with (title="Request count by backend")
+        """,
+        is_chart=True,
+        chart_config={
+            "height": 15,
+            "min": 0,
+            "colors": [
+                asciichart.yellow,
+                asciichart.blue,
+                asciichart.green,
+            ],
+        },
+        group_definition=GroupDefinition(
+            id_column="TimeGenerated",
+            group_column="BackendId",
+            value_column="request_count",
+            missing_value=float("nan"),
+        ),
+        timespan=(test_start_time, test_stop_time),
+        show_query=True,
+        include_link=True,
+    )
+
+    query_processor.add_query(
+        title="Request count by response code",
+        query=f"""
+{time_vars}
+ApiManagementGatewayLogs
+| where OperationName != "" and  TimeGenerated > startTime and TimeGenerated < endTime
+| where BackendId != ""
+| summarize request_count = count() by bin(TimeGenerated, 10s), tostring(ResponseCode)
+| project TimeGenerated, request_count, ResponseCode
+| order by TimeGenerated asc
+| render timechart with (title="Request count by response code")
+        """,
+        is_chart=True,
+        chart_config={
+            "height": 15,
+            "min": 0,
+            "colors": [
+                asciichart.green,
+                asciichart.yellow,
+                asciichart.red,
+            ],
+        },
+        group_definition=GroupDefinition(
+            id_column="TimeGenerated",
+            group_column="ResponseCode",
+            value_column="request_count",
+            missing_value=float("nan"),
+        ),
+        timespan=(test_start_time, test_stop_time),
+        show_query=True,
+        include_link=True,
+    )
+
+    query_processor.run_queries(
+        all_queries_link_text="Show all queries in Log Analytics"
+    )
@@ -0,0 +1,22 @@
+#!/bin/bash
+set -e
+
+script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+if [[ -z "${TRACE_PATH}" ]]; then
+	echo "TRACE_PATH not set!"
+	exit 1
+fi
+# make the trace path absolute as the test runs from a different directory
+TRACE_PATH=$(realpath "$TRACE_PATH")
+export TRACE_PATH
+
+endpoint_path=${ENDPOINT_PATH:-prioritization-token-calculating}
+
+# NOTES:
+# USER_COUNT -1 to indicate a custom load shape
+
+USER_COUNT=-1 \
+ENDPOINT_PATH="$endpoint_path" \
+TEST_FILE="scenario_trace_replay.py" \
+"$script_dir/utils/run-end-to-end-test.sh"
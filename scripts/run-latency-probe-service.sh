@@ -0,0 +1,52 @@
+#!/bin/bash
+set -e
+
+#
+# Runs the latency probe service that keeps the preferred backends for the
+# latency-routing policy up to date (PROBE_INTERVAL defaults to 60 seconds)
+#
+
+script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+output_generated_keys="$script_dir/../infra/simulators/generated-keys.json"
+output_simulators="$script_dir/../infra/simulators/output-simulators.json"
+output_main="$script_dir/../infra/apim-genai/output.json"
+
+payg1_fqdn=$(jq -r '.payg1Fqdn // ""' < "$output_simulators")
+if [[ -z "${payg1_fqdn}" ]]; then
+	echo "PAYG1 Endpoint not found in simulator deployment output"
+	exit 1
+fi
+
+payg2_fqdn=$(jq -r '.payg2Fqdn // ""' < "$output_simulators")
+if [[ -z "${payg2_fqdn}" ]]; then
+	echo "PAYG2 Endpoint not found in simulator deployment output"
+	exit 1
+fi
+
+simulator_api_key=$(jq -r '.simulatorApiKey // ""'< "$output_generated_keys")
+if [[ -z "${simulator_api_key}" ]]; then
+	echo "Simulator API Key not found in generated keys file"
+	exit 1
+fi
+
+apim_subscription_one_key=$(jq -r '.apiManagementAzureOpenAIProductSubscriptionOneKey // ""'< "$output_main")
+if [[ -z "${apim_subscription_one_key}" ]]; then
+	echo "APIM Subscription One Key not found in deployment output file"
+	exit 1
+fi
+
+apim_name=$(jq -r '.apiManagementName // ""' < "$output_main")
+if [[ -z "${apim_name}" ]]; then
+	echo "APIM Name not found in output.json"
+	exit 1
+fi
+
+APIM_SUBSCRIPTION_ONE_KEY=$apim_subscription_one_key \
+APIM_ENDPOINT="https://${apim_name}.azure-api.net" \
+SIMULATOR_ENDPOINT_PAYG1="https://${payg1_fqdn}" \
+SIMULATOR_ENDPOINT_PAYG2="https://${payg2_fqdn}" \
+SIMULATOR_API_KEY=$simulator_api_key \
+python "$script_dir/../end_to_end_tests/latency_probe_service.py" \
+	--interval "${PROBE_INTERVAL:-60}" \
+	--jitter "${PROBE_JITTER:-0.1}"
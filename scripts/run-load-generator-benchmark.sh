@@ -0,0 +1,13 @@
+#!/bin/bash
+set -e
+
+#
+# Measures the requests per second (and per CPU core) that the HttpUser and
+# FastHttpUser load generator clients can drive against a local simulator
+#
+
+script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+python "$script_dir/../end_to_end_tests/benchmark_load_generator.py" \
+	--users "${BENCHMARK_USERS:-50}" \
+	--duration "${BENCHMARK_DURATION:-20}"
@@ -0,0 +1,15 @@
+#!/bin/bash
+set -e
+
+#
+# Runs local stand-ins for the PTU1, PAYG1 and PAYG2 simulators so that scenarios
+# can be run without the deployed simulators.
+# Point SIMULATOR_ENDPOINT_PTU1/PAYG1/PAYG2 at http://localhost:<port>
+#
+
+script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+SIMULATOR_API_KEY=${SIMULATOR_API_KEY:-} \
+python "$script_dir/../end_to_end_tests/local_simulator.py" \
+	--host "${LOCAL_SIMULATOR_HOST:-127.0.0.1}" \
+	--ports "${LOCAL_SIMULATOR_PORTS:-8001,8002,8003}"
@@ -127,54 +127,78 @@ tenant_id=$(az account show --output tsv --query tenantId)
 
 load_test_root="$script_dir/../../end_to_end_tests"
 
-if [[ $USER_COUNT == "-1" ]]; then
-	APIM_SUBSCRIPTION_ONE_KEY=$apim_subscription_one_key \
-	APIM_SUBSCRIPTION_TWO_KEY=$apim_subscription_two_key \
-	APIM_SUBSCRIPTION_THREE_KEY=$apim_subscription_three_key \
-	APIM_ENDPOINT=$apim_base_url \
-	APP_INSIGHTS_NAME=$app_insights_name \
-	TENANT_ID=$tenant_id \
-	SUBSCRIPTION_ID=$subscription_id \
-	RESOURCE_GROUP_NAME=$resource_group_name \
-	APP_INSIGHTS_CONNECTION_STRING=$app_insights_connection_string \
-	SIMULATOR_ENDPOINT_PTU1=$ptu1_base_url \
-	SIMULATOR_ENDPOINT_PAYG1=$payg1_base_url \
-	SIMULATOR_ENDPOINT_PAYG2=$payg2_base_url \
-	SIMULATOR_API_KEY=$simulator_api_key \
-	LOG_ANALYTICS_WORKSPACE_ID=$log_analytics_workspace_id \
-	LOG_ANALYTICS_WORKSPACE_NAME=$log_analytics_workspace_name \
-	OTEL_SERVICE_NAME=locust \
-	OTEL_METRIC_EXPORT_INTERVAL=10000 \
-	LOCUST_WEB_PORT=8091 \
-	locust \
-		-f "$load_test_root/$TEST_FILE" \
-		-H "$apim_base_url/$ENDPOINT_PATH/" \
+export APIM_SUBSCRIPTION_ONE_KEY=$apim_subscription_one_key
+export APIM_SUBSCRIPTION_TWO_KEY=$apim_subscription_two_key
+export APIM_SUBSCRIPTION_THREE_KEY=$apim_subscription_three_key
+export APIM_ENDPOINT=$apim_base_url
+export APP_INSIGHTS_NAME=$app_insights_name
+export TENANT_ID=$tenant_id
+export SUBSCRIPTION_ID=$subscription_id
+export RESOURCE_GROUP_NAME=$resource_group_name
+export APP_INSIGHTS_CONNECTION_STRING=$app_insights_connection_string
+export SIMULATOR_ENDPOINT_PTU1=$ptu1_base_url
+export SIMULATOR_ENDPOINT_PAYG1=$payg1_base_url
+export SIMULATOR_ENDPOINT_PAYG2=$payg2_base_url
+export SIMULATOR_API_KEY=$simulator_api_key
+export LOG_ANALYTICS_WORKSPACE_ID=$log_analytics_workspace_id
+export LOG_ANALYTICS_WORKSPACE_NAME=$log_analytics_workspace_name
+export OTEL_SERVICE_NAME=locust
+export LOCUST_WEB_PORT=8091
+
+locust_args=(
+	-f "$load_test_root/$TEST_FILE"
+	-H "$apim_base_url/$ENDPOINT_PATH/"
+)
+
+# Distributed runs (the default is a single locust process):
+#   WORKER_COUNT        - number of worker processes to run on this machine ("auto" for one per CPU core)
+#   REMOTE_WORKER_COUNT - number of additional workers on other machines for the master to wait for
+#   MASTER_HOST         - set on the other machines to only run WORKER_COUNT workers connecting to that master
+# Setup/teardown (test_start/test_stop) and load shapes only run on the master
+worker_count=${WORKER_COUNT:-0}
+if [[ "${worker_count}" == "auto" ]]; then
+	worker_count=$(nproc)
+fi
+remote_worker_count=${REMOTE_WORKER_COUNT:-0}
+# the total number of workers (used by the scenarios to split the load between workers)
+export WORKER_COUNT=$((worker_count + remote_worker_count))
+
+if [[ -n "${MASTER_HOST}" ]]; then
+	if [[ "${worker_count}" == "0" ]]; then
+		echo "WORKER_COUNT must be set when MASTER_HOST is set"
+		exit 1
+	fi
+	echo "Starting ${worker_count} workers for master ${MASTER_HOST}"
+	locust "${locust_args[@]}" --worker --master-host "${MASTER_HOST}" --processes "${worker_count}"
+	exit 0
+fi
+
+# USER_COUNT=-1 indicates a custom load shape class
+# skip setting user count, run time etc
+if [[ $USER_COUNT != "-1" ]]; then
+	locust_args+=(--users "$USER_COUNT" --run-time "$RUN_TIME")
+fi
+
+if [[ "${remote_worker_count}" != "0" ]]; then
+	if [[ "${worker_count}" != "0" ]]; then
+		locust "${locust_args[@]}" --worker --processes "${worker_count}" &
+		local_workers_pid=$!
+		trap 'kill "$local_workers_pid" 2>/dev/null || true' EXIT
+	fi
+	echo "Waiting for ${WORKER_COUNT} workers"
+	locust "${locust_args[@]}" \
+		--master \
+		--expect-workers "${WORKER_COUNT}" \
+		--autostart \
+		--autoquit 0
+elif [[ "${worker_count}" != "0" ]]; then
+	# --processes forks the workers and runs this process as the master
+	locust "${locust_args[@]}" \
+		--processes "${worker_count}" \
 		--autostart \
 		--autoquit 0
 else
-	APIM_SUBSCRIPTION_ONE_KEY=$apim_subscription_one_key \
-	APIM_SUBSCRIPTION_TWO_KEY=$apim_subscription_two_key \
-	APIM_SUBSCRIPTION_THREE_KEY=$apim_subscription_three_key \
-	APIM_ENDPOINT=$apim_base_url \
-	APP_INSIGHTS_NAME=$app_insights_name \
-	TENANT_ID=$tenant_id \
-	SUBSCRIPTION_ID=$subscription_id \
-	RESOURCE_GROUP_NAME=$resource_group_name \
-	APP_INSIGHTS_CONNECTION_STRING=$app_insights_connection_string \
-	SIMULATOR_ENDPOINT_PTU1=$ptu1_base_url \
-	SIMULATOR_ENDPOINT_PAYG1=$payg1_base_url \
-	SIMULATOR_ENDPOINT_PAYG2=$payg2_base_url \
-	SIMULATOR_API_KEY=$simulator_api_key \
-	LOG_ANALYTICS_WORKSPACE_ID=$log_analytics_workspace_id \
-	LOG_ANALYTICS_WORKSPACE_NAME=$log_analytics_workspace_name \
-	OTEL_SERVICE_NAME=locust \
-	OTEL_METRIC_EXPORT_INTERVAL=10000 \
-	LOCUST_WEB_PORT=8091 \
-	locust \
-		-f "$load_test_root/$TEST_FILE" \
-		-H "$apim_base_url/$ENDPOINT_PATH/" \
-		--users "$USER_COUNT" \
-		--run-time "$RUN_TIME" \
+	locust "${locust_args[@]}" \
 		--autostart \
 		--autoquit 0
-fi
\ No newline at end of file
+fi